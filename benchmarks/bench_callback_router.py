@@ -0,0 +1,212 @@
+"""
+Поиск обработчика нажатия: цепочка фильтров-лямбд против CallbackRouter.
+
+Цепочка повторяет прежнюю регистрацию обработчиков в bot.py: для каждого
+нажатия фильтры проверяются по очереди (состояние, затем лямбда по
+callback_data), пока какой-то не подойдёт. Роутер ищет маршрут в
+префиксном дереве. Нажатия берутся случайно из реальных форматов
+callback_data бота с той же частотой, что в обычной работе: в основном
+шаги формы Кирим/Чиқим.
+
+Два замера: «поиск» — только выбор обработчика в чистом Python;
+«aiogram» — полный Dispatcher.process_update с пустыми обработчиками, где
+цепочка — обычные callback_query_handler с фильтрами, как было в bot.py.
+Сеть не используется.
+
+    python benchmarks/bench_callback_router.py --lookups 200000 --updates 20000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher, types  # noqa: E402
+from aiogram.contrib.fsm_storage.memory import MemoryStorage  # noqa: E402
+
+from callback_router import ANY_STATE, CallbackRouter, normalize_states  # noqa: E402
+from callbacks import PAGE_PREFIX, SEPARATOR, reference_prefix  # noqa: E402
+
+# (префикс, состояние, точное совпадение) в порядке регистрации в bot.py
+ROUTES = [
+    ('approve_', ANY_STATE, False),
+    ('deny_', ANY_STATE, False),
+    ('type_', 'Form:type', False),
+    (PAGE_PREFIX + SEPARATOR, ['Form:object_name', 'Form:expense_type'], False),
+    (reference_prefix('object'), 'Form:object_name', False),
+    (reference_prefix('expense'), 'Form:expense_type', False),
+    ('currency_', 'Form:currency_type', False),
+    ('payment_', 'Form:payment_type', False),
+    ('skip_comment', 'Form:comment', True),
+    ('confirm_yes', 'confirm', True),
+    ('confirm_no', 'confirm', True),
+    ('approve_large_', ANY_STATE, False),
+    ('reject_large_', ANY_STATE, False),
+    (reference_prefix('del_tolov'), None, False),
+    (reference_prefix('edit_tolov'), None, False),
+    (reference_prefix('del_category'), None, False),
+    (reference_prefix('edit_category'), None, False),
+    (reference_prefix('del_object'), None, False),
+    (reference_prefix('del_expense'), None, False),
+    ('blockuser_', None, False),
+    ('approveuser_', None, False),
+    ('removeadmin_', None, False),
+    ('pending_page_', ANY_STATE, False),
+]
+
+# (callback_data, состояние, вес)
+CLICKS = [
+    ('type_kirim', 'Form:type', 10),
+    ('o:12', 'Form:object_name', 10),
+    ('pg:o:1', 'Form:object_name', 3),
+    ('e:7', 'Form:expense_type', 10),
+    ('currency_som', 'Form:currency_type', 10),
+    ('payment_naxt', 'Form:payment_type', 10),
+    ('skip_comment', 'Form:comment', 5),
+    ('confirm_yes', 'confirm', 10),
+    ('approve_large_5657091547_1735689600', None, 1),
+    ('reject_large_5657091547_1735689600', None, 1),
+    ('approveuser_5048593195', None, 1),
+    ('pending_page_20250101120000000000_42', None, 1),
+]
+
+
+def chain_filter(prefix, exact):
+    """Фильтр в стиле прежних лямбд bot.py"""
+    if prefix == 'approve_':
+        return lambda data: ((data.startswith('approve_') or data.startswith('deny_'))
+                             and not data.startswith('approve_large_') and not data.startswith('reject_large_'))
+    if exact:
+        return lambda data: data == prefix
+    return lambda data: data.startswith(prefix)
+
+
+def build_chain():
+    chain = []
+    for prefix, state, exact in ROUTES:
+        if prefix == 'deny_':
+            continue  # в bot.py входит в фильтр 'approve_'
+        chain.append((normalize_states(state), chain_filter(prefix, exact), prefix))
+    return chain
+
+
+def resolve_chain(chain, data, current_state):
+    for states, check, name in chain:
+        if (states == ANY_STATE or current_state in states) and check(data):
+            return name
+    return None
+
+
+def build_router():
+    router = CallbackRouter()
+    for prefix, state, exact in ROUTES:
+        async def handler(call, state=None, prefix=prefix):
+            pass
+        router.add(prefix, handler, state, exact)
+    return router
+
+
+async def noop(call, state=None):
+    pass
+
+
+def build_dispatchers():
+    """Два диспетчера: с цепочкой обработчиков aiogram и с одним обработчиком-роутером"""
+    bot = Bot('42:BENCHMARK')
+    chain_dp = Dispatcher(bot, storage=MemoryStorage())
+    for prefix, state, exact in ROUTES:
+        if prefix == 'deny_':
+            continue
+        check = chain_filter(prefix, exact)
+        chain_dp.register_callback_query_handler(noop, lambda c, check=check: check(c.data), state=state)
+    router_dp = Dispatcher(bot, storage=MemoryStorage())
+    router = CallbackRouter()
+    for prefix, state, exact in ROUTES:
+        router.add(prefix, noop, state, exact)
+    router.setup(router_dp)
+    return bot, chain_dp, router_dp
+
+
+def make_update(i, data, user_id):
+    return types.Update(**{'update_id': i, 'callback_query': {
+        'id': str(i), 'chat_instance': '1', 'data': data,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+        'message': {'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}},
+    }})
+
+
+async def measure_dispatch(dp, clicks):
+    # У каждого вида нажатия свой пользователь в нужном состоянии FSM
+    users = {}
+    for data, state in clicks:
+        if (data, state) not in users:
+            user_id = len(users) + 1
+            users[(data, state)] = user_id
+            await dp.storage.set_state(chat=user_id, user=user_id, state=state)
+    updates = [make_update(i, data, users[(data, state)]) for i, (data, state) in enumerate(clicks)]
+    started = time.perf_counter()
+    for update in updates:
+        await dp.process_update(update)
+    return time.perf_counter() - started
+
+
+async def measure_aiogram(clicks, repeat):
+    bot, chain_dp, router_dp = build_dispatchers()
+    try:
+        chain_time = min([await measure_dispatch(chain_dp, clicks) for _ in range(repeat)])
+        router_time = min([await measure_dispatch(router_dp, clicks) for _ in range(repeat)])
+    finally:
+        session = await bot.get_session()
+        await session.close()
+    return chain_time, router_time
+
+
+def measure(resolve, clicks):
+    started = time.perf_counter()
+    for data, current_state in clicks:
+        resolve(data, current_state)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lookups', type=int, default=200000)
+    parser.add_argument('--updates', type=int, default=20000, help='апдейтов для замера через aiogram')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    population = [(data, state) for data, state, _ in CLICKS]
+    weights = [weight for _, _, weight in CLICKS]
+    clicks = rng.choices(population, weights, k=args.lookups)
+
+    chain = build_chain()
+    router = build_router()
+    # Обе схемы должны выбирать одни и те же обработчики
+    for data, state in population:
+        route = router.resolve(data, state)
+        assert route is not None and resolve_chain(chain, data, state) is not None, data
+
+    chain_time = min(measure(lambda d, s: resolve_chain(chain, d, s), clicks) for _ in range(args.repeat))
+    router_time = min(measure(router.resolve, clicks) for _ in range(args.repeat))
+    print(f"Маршрутов: {len(router)}")
+    print(f"Поиск, {args.lookups} нажатий:")
+    print(f"  цепочка фильтров: {chain_time / args.lookups * 1e6:7.2f} мкс на нажатие")
+    print(f"  CallbackRouter:   {router_time / args.lookups * 1e6:7.2f} мкс на нажатие "
+          f"({chain_time / router_time:.1f}x)")
+
+    if args.updates:
+        chain_time, router_time = asyncio.run(measure_aiogram(clicks[:args.updates], args.repeat))
+        updates = min(args.updates, len(clicks))
+        print(f"aiogram Dispatcher.process_update, {updates} апдейтов:")
+        print(f"  цепочка обработчиков: {chain_time / updates * 1e6:7.2f} мкс на апдейт")
+        print(f"  CallbackRouter:       {router_time / updates * 1e6:7.2f} мкс на апдейт "
+              f"({chain_time / router_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
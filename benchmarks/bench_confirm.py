@@ -0,0 +1,137 @@
+"""
+Пропускная способность записи подтверждённых операций в Google Sheets.
+
+Вместо рабочей таблицы используется FakeSheetsBackend с настраиваемой
+задержкой запросов и долей ответов 429. Для каждого числа одновременных
+пользователей (--users) каждый пользователь подтверждает --entries
+операций подряд; строка уходит в SheetsBatchWriter, как это делает
+outbox-воркер, временные ошибки повторяются с экспоненциальной паузой.
+
+Задержка подтверждения — время от отправки строки до её записи в лист.
+Выводятся записей в секунду, p50/p99 задержки и число запросов к API.
+
+    python benchmarks/bench_confirm.py --latency 0.2 --jitter 0.1 --quota-error-rate 0.02
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import blocking  # noqa: E402
+from blocking import run_blocking  # noqa: E402
+from fake_sheets import FakeSheetsBackend  # noqa: E402
+from sheets import (ROW_WIDTH, WRITE_MODES, SheetsBatchWriter, SheetsQuotaExceeded,  # noqa: E402
+                    SheetsRateLimiter, is_retryable_error)
+
+SHEET_NAME = 'КиримЧиким'
+HEADER = ['Объект', 'Тур', 'Харажат', 'Изох', '$', 'Курс', 'Сом', 'Сана', 'Масул', '', 'Тулов']
+
+
+def make_row(user, i):
+    row = [f'bench {user}', 'Чиқим', 'Прочие расходы', '-', '', '', 1000 + i, '1/1/2025', f'user {user}', '', 'Нахт']
+    assert len(row) == ROW_WIDTH
+    return row
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def confirm_entries(writer, user, args, latencies, failures):
+    """Один пользователь: подтверждает операции одну за другой"""
+    for i in range(args.entries):
+        row = make_row(user, i)
+        started = time.perf_counter()
+        for attempt in range(args.max_attempts):
+            try:
+                await writer.submit(row)
+                latencies.append(time.perf_counter() - started)
+                break
+            except Exception as e:
+                if not (is_retryable_error(e) or isinstance(e, SheetsQuotaExceeded)) or attempt == args.max_attempts - 1:
+                    failures.append(e)
+                    break
+                await asyncio.sleep(args.retry_base * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+async def run_level(users, args):
+    limiter = None
+    if args.writes_per_minute:
+        limiter = SheetsRateLimiter(reads_per_minute=args.reads_per_minute,
+                                    writes_per_minute=args.writes_per_minute, burst=args.burst)
+    backend = FakeSheetsBackend(
+        sheet_names=[SHEET_NAME], rows=args.prefill + 20, cols=ROW_WIDTH,
+        latency=args.latency, jitter=args.jitter, quota_error_rate=args.quota_error_rate,
+        limiter=limiter, seed=args.seed
+    )
+    prefill = [HEADER] + [make_row('prefill', i) for i in range(args.prefill)]
+    backend.worksheet(SHEET_NAME).update('A1', prefill)
+
+    writer = SheetsBatchWriter(backend, SHEET_NAME, flush_interval=args.flush_interval,
+                               max_batch=args.max_batch, mode=args.mode)
+    await run_blocking(writer.prepare)
+    before = backend.stats()
+
+    latencies, failures = [], []
+    started = time.perf_counter()
+    await asyncio.gather(*(confirm_entries(writer, user, args, latencies, failures) for user in range(users)))
+    elapsed = time.perf_counter() - started
+    await writer.close()
+
+    after = backend.stats()
+    requests_made = (after['read'] - before['read']) + (after['write'] - before['write'])
+    written = len(latencies)
+    line = (f"{users:>4} польз.: {written / elapsed:8.1f} зап./с, "
+            f"p50 {percentile(latencies, 0.5) * 1000:7.0f} мс, "
+            f"p99 {percentile(latencies, 0.99) * 1000:7.0f} мс, "
+            f"{requests_made / max(written, 1):.2f} запр./запись, "
+            f"429: {after['quota_errors'] - before['quota_errors']}, ошибок: {len(failures)}")
+    if limiter is not None:
+        write_stats = limiter.stats()['write']
+        line += f", ждали квоту: {write_stats['delayed']}"
+    print(line)
+
+
+async def main_async(args):
+    print(f"Режим {args.mode}, задержка {args.latency * 1000:.0f}±{args.jitter * 1000:.0f} мс, "
+          f"429: {args.quota_error_rate:.1%}, операций на пользователя: {args.entries}")
+    for users in args.users:
+        await run_level(users, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--entries', type=int, default=20, help='операций на пользователя')
+    parser.add_argument('--mode', default='cursor', choices=WRITE_MODES)
+    parser.add_argument('--prefill', type=int, default=2000, help='строк в листе до начала замера')
+    parser.add_argument('--latency', type=float, default=0.2, help='задержка одного запроса, с')
+    parser.add_argument('--jitter', type=float, default=0.1, help='случайная добавка к задержке, с')
+    parser.add_argument('--quota-error-rate', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--flush-interval', type=float, default=0.5)
+    parser.add_argument('--max-batch', type=int, default=50)
+    parser.add_argument('--reads-per-minute', type=int, default=60)
+    parser.add_argument('--writes-per-minute', type=int, default=0,
+                        help='включить ограничитель квоты (0 — без ограничителя)')
+    parser.add_argument('--burst', type=int, default=10)
+    parser.add_argument('--max-attempts', type=int, default=5)
+    parser.add_argument('--retry-base', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('-v', '--verbose', action='store_true', help='показывать журнал писателя')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    try:
+        asyncio.run(main_async(args))
+    finally:
+        blocking.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Сравнение способов выбора строки для записи в Google Sheets.
+
+- scan:   get_all_values() и поиск пустой строки перед каждой партией (прежний способ);
+- cursor: локальный курсор RowCursor + проверка только записываемых строк;
+- append: values.append с INSERT_ROWS.
+
+Для каждого режима создаётся временный лист, заполняется --prefill строками
+(имитация накопленного журнала), затем пишется --batches партий по --batch-size
+строк. Выводится время на партию и число HTTP-запросов к API.
+
+Рабочую таблицу не трогает: нужен отдельный тестовый документ.
+
+    BENCH_SHEET_ID=<id> python benchmarks/bench_row_allocation.py --prefill 5000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sheets import ROW_WIDTH, WRITE_MODES, SheetsBatchWriter, SheetsSession  # noqa: E402
+
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+
+
+def count_requests(session):
+    """Подменяет client.request счётчиком HTTP-запросов"""
+    client = session.spreadsheet().client
+    original = client.request
+    counter = {'requests': 0}
+
+    def request(*args, **kwargs):
+        counter['requests'] += 1
+        return original(*args, **kwargs)
+
+    client.request = request
+    return counter
+
+
+def make_row(i):
+    row = [f'bench {i}', 'Чиқим', 'Прочие расходы', '-', '', '', 1000 + i, '1/1/2025', 'bench', '', 'Нахт']
+    assert len(row) == ROW_WIDTH
+    return row
+
+
+def run_mode(session, mode, args):
+    spreadsheet = session.spreadsheet()
+    title = f'bench_{mode}_{int(time.time())}'
+    worksheet = spreadsheet.add_worksheet(title, rows=args.prefill + 20, cols=11)
+    try:
+        header = [['Объект', 'Тур', 'Харажат', 'Изох', '$', 'Курс', 'Сом', 'Сана', 'Масул', '', 'Тулов']]
+        prefill = [make_row(i) for i in range(args.prefill)]
+        worksheet.update('A1', header + prefill)
+
+        writer = SheetsBatchWriter(session, title, mode=mode)
+        counter = count_requests(session)
+        started = time.perf_counter()
+        writer.prepare()
+        prepare_time = time.perf_counter() - started
+        prepare_requests = counter['requests']
+
+        timings = []
+        for b in range(args.batches):
+            rows = [make_row(args.prefill + b * args.batch_size + i) for i in range(args.batch_size)]
+            started = time.perf_counter()
+            results = writer._write_batch(rows)
+            timings.append(time.perf_counter() - started)
+            errors = [r for r in results if isinstance(r, Exception)]
+            if errors:
+                raise errors[0]
+
+        write_requests = counter['requests'] - prepare_requests
+        timings.sort()
+        print(
+            f"{mode:>6}: старт {prepare_time * 1000:7.0f} мс ({prepare_requests} запр.), "
+            f"партия p50 {timings[len(timings) // 2] * 1000:7.0f} мс, "
+            f"max {timings[-1] * 1000:7.0f} мс, "
+            f"{write_requests / args.batches:.1f} запр./партию"
+        )
+    finally:
+        if not args.keep:
+            spreadsheet.del_worksheet(worksheet)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sheet-id', default=os.environ.get('BENCH_SHEET_ID'))
+    parser.add_argument('--credentials', default=os.environ.get('BENCH_CREDENTIALS', 'credentials.json'))
+    parser.add_argument('--prefill', type=int, default=2000)
+    parser.add_argument('--batches', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=5)
+    parser.add_argument('--modes', nargs='+', default=list(WRITE_MODES), choices=WRITE_MODES)
+    parser.add_argument('--keep', action='store_true', help='не удалять временные листы')
+    args = parser.parse_args()
+    if not args.sheet_id:
+        parser.error('укажите --sheet-id или BENCH_SHEET_ID')
+
+    session = SheetsSession(args.credentials, SCOPES, args.sheet_id)
+    print(f"Строк в листе: {args.prefill}, партий: {args.batches} x {args.batch_size}")
+    for mode in args.modes:
+        run_mode(session, mode, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Пропускная способность webhook: синтетические апдейты в локальный сервер.
+
+Поднимает приложение из webhook.create_app на 127.0.0.1 с диспетчером
+aiogram, у которого один обработчик сообщений: он ждёт --handler-latency
+секунд (как запрос к БД или к API Telegram).
+Клиент отправляет --updates апдейтов от --users пользователей по
+--connections параллельных соединений (у Telegram по умолчанию до 40), с
+секретным заголовком, как настоящий webhook. Для каждого значения
+--concurrency печатает скорость приёма, скорость обработки, задержку от
+отправки до конца обработки и проверяет, что апдейты каждого пользователя
+обработаны в том порядке, в котором сервер их принял. --concurrency 1 —
+последовательная обработка по одному апдейту. Апдейты одного пользователя
+идут друг за другом, поэтому самый активный пользователь ограничивает
+общее время снизу. Сеть наружу не используется.
+
+    python benchmarks/bench_webhook.py --updates 5000 --users 200 --concurrency 1 8 32 128
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict, deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp  # noqa: E402
+from aiogram import Bot, Dispatcher, types  # noqa: E402
+from aiogram.contrib.fsm_storage.memory import MemoryStorage  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+from webhook import SECRET_HEADER, UpdateScheduler, create_app  # noqa: E402
+
+PATH = '/telegram/webhook'
+SECRET = 'bench-secret'
+
+
+class RecordingScheduler(UpdateScheduler):
+    """Запоминает порядок приёма апдейтов каждого пользователя"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.arrivals = defaultdict(deque)
+
+    def submit(self, update):
+        accepted = super().submit(update)
+        if accepted:
+            self.arrivals[update.message.from_user.id].append(update.message.message_id)
+        return accepted
+
+
+def make_update(update_id, user_id):
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': 'bench',
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+        'chat': {'id': user_id, 'type': 'private'},
+    }}
+
+
+async def run_case(bot, args, concurrency, updates):
+    dp = Dispatcher(bot, storage=MemoryStorage())
+    sent_at = {}
+    latencies = []
+    out_of_order = 0
+
+    async def handler(message: types.Message):
+        nonlocal out_of_order
+        # Обработка должна начинаться в порядке приёма
+        if scheduler.arrivals[message.from_user.id].popleft() != message.message_id:
+            out_of_order += 1
+        await asyncio.sleep(args.handler_latency)
+        latencies.append(time.perf_counter() - sent_at[message.message_id])
+
+    dp.register_message_handler(handler)
+    scheduler = RecordingScheduler(dp, max_concurrency=concurrency, max_pending=len(updates))
+    runner = web.AppRunner(create_app(scheduler, PATH, SECRET), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    url = f'http://127.0.0.1:{port}{PATH}'
+
+    rejected = 0
+    # Соединения разбирают общую очередь апдейтов по порядку, как Telegram
+    # отдаёт апдейты из своей очереди
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+
+    async def sender(session):
+        nonlocal rejected
+        while not queue.empty():
+            update = queue.get_nowait()
+            sent_at[update['update_id']] = time.perf_counter()
+            async with session.post(url, json=update, headers={SECRET_HEADER: SECRET}) as response:
+                if response.status != 200:
+                    rejected += 1
+
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    started = time.perf_counter()
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(sender(session) for _ in range(args.connections)))
+    accepted_in = time.perf_counter() - started
+    await scheduler.wait_idle()
+    done_in = time.perf_counter() - started
+    await runner.cleanup()
+
+    latencies.sort()
+    return {
+        'accept_rate': len(updates) / accepted_in,
+        'rate': len(latencies) / done_in,
+        'p50': statistics.median(latencies) if latencies else 0,
+        'p95': latencies[int(len(latencies) * 0.95) - 1] if latencies else 0,
+        'rejected': rejected,
+        'out_of_order': out_of_order,
+        'stats': scheduler.stats(),
+    }
+
+
+async def main_async(args):
+    rng = random.Random(args.seed)
+    # Часть пользователей активнее остальных, как в обычной работе
+    user_ids = [1000 + i for i in range(args.users)]
+    weights = [1 / (rank + 1) ** 0.5 for rank in range(args.users)]
+    updates = [make_update(update_id, user_id)
+               for update_id, user_id in enumerate(rng.choices(user_ids, weights, k=args.updates), 1)]
+
+    bot = Bot('42:BENCHMARK')
+    Bot.set_current(bot)
+    print(f"Апдейтов: {args.updates}, пользователей: {args.users}, соединений: {args.connections}, "
+          f"обработчик: {args.handler_latency * 1000:.0f} мс")
+    try:
+        for concurrency in args.concurrency:
+            result = await run_case(bot, args, concurrency, updates)
+            print(f"  concurrency={concurrency:<4} приём {result['accept_rate']:8.0f} апд/с, "
+                  f"обработка {result['rate']:7.0f} апд/с, "
+                  f"p50 {result['p50'] * 1000:7.1f} мс, p95 {result['p95'] * 1000:7.1f} мс, "
+                  f"отклонено {result['rejected']}, нарушений порядка {result['out_of_order']}")
+            assert result['out_of_order'] == 0, "апдейты пользователя обработаны не по порядку"
+    finally:
+        session = await bot.get_session()
+        await session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--connections', type=int, default=40)
+    parser.add_argument('--handler-latency', type=float, default=0.02, help='секунд на апдейт в обработчике')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 128])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
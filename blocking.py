@@ -0,0 +1,62 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Общий ограниченный пул потоков для блокирующих вызовов (gspread)
+_executor = None
+_max_workers = 8
+
+
+def configure(max_workers):
+    """Задаёт размер пула; вызывать до первого блокирующего вызова"""
+    global _max_workers
+    if _executor is not None:
+        raise RuntimeError("Пул потоков уже создан")
+    _max_workers = max_workers
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_max_workers, thread_name_prefix='blocking')
+        logger.info(f"Пул потоков для блокирующих вызовов: {_max_workers} потоков")
+    return _executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Выполняет синхронную функцию в пуле потоков, не блокируя цикл событий"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+class AsyncFacade:
+    """
+    Асинхронный фасад над набором синхронных функций.
+
+    Для каждой функции создаётся одноимённый awaitable-метод, который
+    выполняет её в общем пуле потоков:
+
+        sheets_async = AsyncFacade(get_sheet_names, get_e1_g1_values)
+        names = await sheets_async.get_sheet_names()
+    """
+
+    def __init__(self, *funcs):
+        for func in funcs:
+            setattr(self, func.__name__, self._wrap(func))
+
+    @staticmethod
+    def _wrap(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await run_blocking(func, *args, **kwargs)
+        return wrapper
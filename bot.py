@@ -1,21 +1,35 @@
 import logging
 from aiogram import Bot, Dispatcher, executor, types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ParseMode
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.dispatcher.filters import CommandStart
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
 import os
 from environs import Env
-import gspread
-from google.oauth2.service_account import Credentials
 import platform
 import sqlite3
-import psycopg2
-from psycopg2 import sql, IntegrityError
 import re
 import json
+import random
+import asyncio
+import blocking
+from blocking import AsyncFacade, run_blocking
+from repository import Repository
+from fake_sheets import FakeSheetsBackend
+from migrations import migrate, seed, seed_admins, seed_reference_lists
+from update_context import UpdateContextMiddleware
+from webhook import UpdateScheduler, run_webhook
+from notifier import AdminNotifier, MessageSender
+from broadcast import BroadcastEngine
+from fsm_storage import PostgresStorage
+from cache import MISSING, TTLCache
+from callback_router import CallbackRouter
+from callbacks import (PAGE_PREFIX, RECENT_PAGE, SEPARATOR, page_callback, parse_page_callback,
+                       parse_reference_callback, reference_callback, reference_prefix)
+from sheets import (SheetsBatchWriter, SheetsRateLimiter, SheetsSession, is_retryable_error,
+                    iter_sheet_chunks, normalize_row, row_hash, row_ranges, ROW_WIDTH)
 
 # Загрузка переменных окружения
 env = Env()
@@ -34,7 +48,10 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 bot = Bot(token=API_TOKEN, parse_mode=ParseMode.HTML)
-dp = Dispatcher(bot, storage=MemoryStorage())
+dp = Dispatcher(bot)
+# Все нажатия inline-кнопок разбираются одним обработчиком по префиксу callback_data
+router = CallbackRouter()
+router.setup(dp)
 
 # Состояния
 class Form(StatesGroup):
@@ -149,20 +166,91 @@ def get_category_with_emoji(category_name):
     emoji = category_emojis.get(category_name, "")
     return f"{emoji} {category_name}".strip()
 
-def get_object_names_kb():
+# Клавиатуры справочников собираются один раз на версию справочников
+# (Repository.get_reference_lists) и дальше отдаются готовыми
+reference_keyboards = {}
+
+async def reference_keyboard(key, table, build):
+    version, lists = await db_async.get_reference_lists()
+    cached = reference_keyboards.get(key)
+    if cached is None or cached[0] != version:
+        cached = (version, build(lists['items'][table]))
+        reference_keyboards[key] = cached
+    return cached[1]
+
+def build_list_kb(items, action, label=None):
     kb = InlineKeyboardMarkup(row_width=2)
-    for name in get_object_names():
-        cb = f"object_{name}"
-        kb.add(InlineKeyboardButton(name, callback_data=cb))
+    for item_id, name in items:
+        kb.add(InlineKeyboardButton(label(name) if label else name, callback_data=reference_callback(action, item_id)))
     return kb
 
-def get_expense_types_kb():
-    kb = InlineKeyboardMarkup(row_width=2)
-    for name in get_expense_types():
-        cb = f"expense_{name}"
-        kb.add(InlineKeyboardButton(name, callback_data=cb))
+# Объекты и типы расходов показываются страницами: собирается только
+# запрошенная страница, поэтому размер клавиатуры не растёт вместе со списком.
+# Первой показывается страница недавно выбранных пользователем значений
+REFERENCE_PAGE_SIZE = env.int('REFERENCE_PAGE_SIZE', 8)
+REFERENCE_RECENT_COUNT = env.int('REFERENCE_RECENT_COUNT', 4)
+# (user_id, справочник) -> id последних выбранных значений, новые первыми
+recent_choices = TTLCache(ttl=30 * 86400)
+
+def build_page_kb(items, action, page):
+    """Клавиатура страницы page (с 0) и кнопки листания"""
+    pages = max(1, -(-len(items) // REFERENCE_PAGE_SIZE))
+    page = min(page, pages - 1)
+    kb = build_list_kb(items[page * REFERENCE_PAGE_SIZE:(page + 1) * REFERENCE_PAGE_SIZE], action)
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton('⬅️', callback_data=page_callback(action, page - 1)))
+    elif REFERENCE_RECENT_COUNT > 0:
+        nav.append(InlineKeyboardButton('⭐', callback_data=page_callback(action, RECENT_PAGE)))
+    if pages > 1:
+        nav.append(InlineKeyboardButton(f'{page + 1}/{pages}', callback_data=page_callback(action, page)))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton('➡️', callback_data=page_callback(action, page + 1)))
+    if nav:
+        kb.row(*nav)
     return kb
 
+async def reference_page_kb(table, action, page, user_id=None):
+    """Страница клавиатуры справочника; RECENT_PAGE — недавно выбранные (если их нет, первая страница)"""
+    if page == RECENT_PAGE:
+        recent = recent_choices.get((user_id, table))
+        if recent is not MISSING:
+            items = []
+            for item_id in recent:
+                name = await db_async.get_reference_name(table, item_id)
+                if name is not None:
+                    items.append((item_id, name))
+            if items:
+                kb = build_list_kb(items, action)
+                kb.row(InlineKeyboardButton('📋 Hammasi ➡️', callback_data=page_callback(action, 0)))
+                return kb
+        page = 0
+    return await reference_keyboard((table, action, page), table, lambda items: build_page_kb(items, action, page))
+
+def remember_choice(user_id, table, item_id):
+    if REFERENCE_RECENT_COUNT <= 0:
+        return
+    recent = recent_choices.get((user_id, table))
+    recent = [] if recent is MISSING else [i for i in recent if i != item_id]
+    recent_choices.set((user_id, table), tuple([item_id] + recent)[:REFERENCE_RECENT_COUNT])
+
+# Кнопка ссылается на значение справочника, которое уже удалили
+REFERENCE_GONE_TEXT = "Ro'yxat yangilandi, qaytadan tanlang."
+
+async def decode_reference(call):
+    """(id, название) из callback_data кнопки справочника; название None, если значение уже удалено"""
+    parsed = parse_reference_callback(call.data)
+    if parsed is None:
+        return None, None
+    _, table, item_id = parsed
+    return item_id, await db_async.get_reference_name(table, item_id)
+
+async def get_object_names_kb(user_id=None):
+    return await reference_page_kb('object_names', 'object', RECENT_PAGE, user_id)
+
+async def get_expense_types_kb(user_id=None):
+    return await reference_page_kb('expense_types', 'expense', RECENT_PAGE, user_id)
+
 def get_currency_types_kb():
     kb = InlineKeyboardMarkup(row_width=2)
     for name, cb in currency_types:
@@ -175,14 +263,9 @@ def get_payment_types_kb():
         kb.add(InlineKeyboardButton(name, callback_data=cb))
     return kb
 
-def get_categories_kb():
-    kb = InlineKeyboardMarkup(row_width=2)
-    for name in get_categories():
-        cb = f"cat_{name}"
-        # Показываем эмодзи в меню
-        btn_text = get_category_with_emoji(name)
-        kb.add(InlineKeyboardButton(btn_text, callback_data=cb))
-    return kb
+async def get_categories_kb():
+    # Показываем эмодзи в меню
+    return await reference_keyboard('categories', 'categories', lambda items: build_list_kb(items, 'category', get_category_with_emoji))
 
 # Тип оплаты
 pay_types = [
@@ -192,12 +275,8 @@ pay_types = [
     ("Bank", "pay_bank")
 ]
 
-def get_pay_types_kb():
-    kb = InlineKeyboardMarkup(row_width=2)
-    for name in get_pay_types():
-        cb = f"pay_{name}"
-        kb.add(InlineKeyboardButton(name, callback_data=cb))
-    return kb
+async def get_pay_types_kb():
+    return await reference_keyboard('pay_types', 'pay_types', lambda items: build_list_kb(items, 'pay'))
 
 # Кнопка пропуска для Izoh
 skip_kb = InlineKeyboardMarkup().add(InlineKeyboardButton("Пропустить", callback_data="skip_comment"))
@@ -215,13 +294,37 @@ SHEET_NAME = 'КиримЧиким'
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 CREDENTIALS_FILE = 'credentials.json'
 
+# Все запросы к Sheets API проходят через общий ограничитель квоты чтения и записи
+sheets_limiter = SheetsRateLimiter(
+    reads_per_minute=env.int('SHEETS_READS_PER_MINUTE', 60),
+    writes_per_minute=env.int('SHEETS_WRITES_PER_MINUTE', 60),
+    burst=env.int('SHEETS_BURST', 10),
+    max_wait=env.float('SHEETS_MAX_QUEUE_WAIT', 120)
+)
+
+# Один авторизованный клиент и кэш дескрипторов листов на весь процесс.
+# SHEETS_BACKEND=fake — листы в памяти или в локальном файле вместо Google Sheets
+SHEETS_BACKEND = env.str('SHEETS_BACKEND', 'google')
+if SHEETS_BACKEND == 'fake':
+    sheets_session = FakeSheetsBackend(
+        sheet_names=[SHEET_NAME],
+        path=env.str('SHEETS_FAKE_FILE', '') or None,
+        latency=env.float('SHEETS_FAKE_LATENCY', 0.0),
+        quota_error_rate=env.float('SHEETS_FAKE_QUOTA_ERROR_RATE', 0.0),
+        limiter=sheets_limiter
+    )
+else:
+    sheets_session = SheetsSession(
+        CREDENTIALS_FILE, SCOPES, SHEET_ID,
+        refresh_margin=env.int('SHEETS_TOKEN_REFRESH_MARGIN', 300),
+        limiter=sheets_limiter
+    )
+
 # Добавляем функцию для получения списка листов
 def get_sheet_names():
     try:
-        creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
-        gc = gspread.authorize(creds)
-        sh = gc.open_by_key(SHEET_ID)
-        return [ws.title for ws in sh.worksheets()]
+        worksheets = sheets_session.run(lambda: sheets_session.spreadsheet().worksheets())
+        return [ws.title for ws in worksheets]
     except Exception as e:
         print(f"Ошибка при получении списка листов: {e}")
         return []
@@ -229,14 +332,13 @@ def get_sheet_names():
 def get_e1_g1_values():
     """Возвращает числовые значения из ячеек E1 и G1 (результат формул, не сами формулы)."""
     try:
-        creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
-        gc = gspread.authorize(creds)
-        sh = gc.open_by_key(SHEET_ID)
-        worksheet = sh.worksheet(SHEET_NAME)
+        def read():
+            worksheet = sheets_session.worksheet(SHEET_NAME)
+            # Читаем как неконвертированные значения (без формул), обе ячейки одним запросом
+            e1, g1 = worksheet.batch_get(['E1', 'G1'], value_render_option='UNFORMATTED_VALUE')
+            return e1, g1
 
-        # Читаем как неконвертированные значения (без формул)
-        e1 = worksheet.get('E1', value_render_option='UNFORMATTED_VALUE')
-        g1 = worksheet.get('G1', value_render_option='UNFORMATTED_VALUE')
+        e1, g1 = sheets_session.run(read)
 
         def extract_single(val):
             try:
@@ -280,8 +382,62 @@ async def safe_answer_callback(call, **kwargs):
             logging.warning(f"Не удалось ответить на callback query: {e}")
         # Игнорируем ошибку, так как callback уже устарел или недействителен
 
-def add_to_google_sheet(data):
-    from datetime import datetime
+# Общий писатель: собирает строки всех пользователей и пишет их одним запросом
+sheet_writer = SheetsBatchWriter(
+    sheets_session, SHEET_NAME,
+    flush_interval=env.float('SHEETS_FLUSH_INTERVAL', 0.5),
+    max_batch=env.int('SHEETS_MAX_BATCH', 50),
+    mode=env.str('SHEETS_WRITE_MODE', 'cursor')
+)
+
+def build_sheet_row(data, user_name):
+    """Собирает значения для столбцов A-K листа КиримЧиким"""
+    # Дата операции, а не момент записи: из outbox строка может уйти позже
+    date_str = data.get('dt_for_sheet')
+    if not date_str:
+        now = datetime.now()
+        if platform.system() == 'Windows':
+            date_str = now.strftime('%m/%d/%Y')
+        else:
+            date_str = now.strftime('%-m/%-d/%Y')
+    # Определяем данные для столбцов в зависимости от валюты
+    currency_type = data.get('currency_type', '')
+    amount = data.get('amount', '')
+    exchange_rate = data.get('exchange_rate', '')
+    
+    if currency_type == 'Доллар':
+        # Если доллар: Курс = курс, $ = сумма в долларах, Сом = пусто
+        som_amount = ''
+        dollar_amount = int(float(amount)) if amount else ''
+        exchange_rate = int(float(exchange_rate)) if exchange_rate else ''
+    else:
+        # Если сом: Курс = пусто, $ = пусто, Сом = сумма в сомах
+        som_amount = int(float(amount)) if amount else ''
+        dollar_amount = ''
+        exchange_rate = ''
+    
+    return [
+        data.get('object_name', ''),      # A: Объект номи
+        data.get('type', ''),             # B: Кирим/Чиким
+        data.get('expense_type', ''),     # C: Харажат Тури
+        data.get('comment', ''),          # D: Изох
+        dollar_amount,                    # E: $
+        exchange_rate,                    # F: Курс
+        som_amount,                       # G: Сом
+        date_str,                         # H: Сана
+        user_name,                        # I: Масул шахс
+        '',                               # J: не заполняется
+        data.get('payment_type', ''),     # K: Тулов тури
+    ]
+
+async def queue_google_sheet_write(data, dedup=True):
+    """
+    Сохраняет операцию в журнал и outbox для записи в Google Sheets.
+    Возвращает (id записи outbox, новый баланс по валюте операции) или None,
+    если это дубликат. Баланс None, пока начальные балансы не взяты из таблицы.
+    dedup=False отключает защиту от повторного нажатия — для вызывающих,
+    у которых однократность уже обеспечена (одобрение заявки забирает её из БД).
+    """
     global recent_entries
     
     # Проверяем на дублирование
@@ -292,76 +448,24 @@ def add_to_google_sheet(data):
     entry_key = f"{user_id}_{data.get('object_name', '')}_{data.get('type', '')}_{data.get('expense_type', '')}_{data.get('amount', '')}_{data.get('comment', '')}"
     
     # Проверяем, не была ли такая запись уже сделана в последние 30 секунд
-    if entry_key in recent_entries:
+    if dedup and entry_key in recent_entries:
         last_time = recent_entries[entry_key]
         if current_time - last_time < 30:  # 30 секунд
             logging.info(f"Дублирование предотвращено для пользователя {user_id}")
-            return False  # Возвращаем False если это дублирование
+            return None  # Возвращаем None если это дублирование
+    
+    # Операция сначала надёжно сохраняется в БД; ошибка здесь поднимется к вызывающему
+    entry_id, balance = await db_async.record_operation(user_id, data, balance_currency(data), operation_delta(data))
+    logging.info(f"Операция пользователя {user_id} поставлена в outbox: #{entry_id}, баланс {balance}")
+    outbox_wakeup.set()
     
     # Сохраняем время текущей записи
     recent_entries[entry_key] = current_time
     
     # Очищаем старые записи (старше 5 минут)
-    current_time = datetime.now().timestamp()
     recent_entries = {k: v for k, v in recent_entries.items() if current_time - v < 300}
     
-    creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
-    gc = gspread.authorize(creds)
-    sh = gc.open_by_key(SHEET_ID)
-    worksheet = sh.worksheet(SHEET_NAME)
-    now = datetime.now()
-    if platform.system() == 'Windows':
-        date_str = now.strftime('%m/%d/%Y')
-    else:
-        date_str = now.strftime('%-m/%-d/%Y')
-    time_str = now.strftime('%H:%M')
-    user_name = get_user_name(data.get('user_id', data.get('user_id', '')))
-    
-    # Определяем данные для столбцов в зависимости от валюты
-    currency_type = data.get('currency_type', '')
-    amount = data.get('amount', '')
-    exchange_rate = data.get('exchange_rate', '')
-    
-    if currency_type == 'Доллар':
-        # Если доллар: Курс = курс, $ = сумма в долларах, Сом = пусто
-        som_amount = ''
-        dollar_amount = int(float(amount)) if amount else ''
-        exchange_rate = int(float(exchange_rate)) if exchange_rate else ''
-    else:
-        # Если сом: Курс = пусто, $ = пусто, Сом = сумма в сомах
-        som_amount = int(float(amount)) if amount else ''
-        dollar_amount = ''
-        exchange_rate = ''
-    
-    # Находим первую пустую строку
-    all_values = worksheet.get_all_values()
-    
-    # Ищем первую пустую строку после заголовков
-    next_row = 2  # Начинаем со строки 2 (после заголовков)
-    for i, row in enumerate(all_values[1:], 2):  # Пропускаем заголовки
-        if not any(cell.strip() for cell in row[:9]):  # Проверяем первые 9 столбцов
-            next_row = i
-            break
-    else:
-        # Если не нашли пустую строку, добавляем новую
-        next_row = len(all_values) + 1
-        # Расширяем лист если нужно
-        if next_row > 45:
-            worksheet.resize(next_row + 10, 25)  # Добавляем 10 строк
-    
-    # Записываем данные в правильные столбцы (A-J)
-    worksheet.update(f'A{next_row}', data.get('object_name', ''))      # Объект номи
-    worksheet.update(f'B{next_row}', data.get('type', ''))             # Кирим/Чиким
-    worksheet.update(f'C{next_row}', data.get('expense_type', ''))     # Харажат Тури
-    worksheet.update(f'D{next_row}', data.get('comment', ''))          # Изох
-    worksheet.update(f'E{next_row}', dollar_amount)                     # $
-    worksheet.update(f'F{next_row}', exchange_rate)                     # Курс
-    worksheet.update(f'G{next_row}', som_amount)                        # Сом
-    worksheet.update(f'H{next_row}', date_str)                         # Сана
-    worksheet.update(f'I{next_row}', user_name)                        # Масул шахс
-    worksheet.update(f'K{next_row}', data.get('payment_type', ''))     # Тулов тури
-    
-    return True  # Возвращаем True если запись успешна
+    return entry_id, balance
 
 def format_summary(data):
     tur_emoji = '🟢' if data.get('type') == 'Кирим' else '🔴'
@@ -438,241 +542,58 @@ def is_balance_message_duplicate(user_id, operation_type, amount, currency, time
     
     return False
 
-# --- Инициализация БД ---
-def get_db_conn():
-    return psycopg2.connect(
-        dbname=env.str('POSTGRES_DB', 'kapital'),
-        user=env.str('POSTGRES_USER', 'postgres'),
-        password=env.str('POSTGRES_PASSWORD', 'postgres'),
-        host=env.str('POSTGRES_HOST', 'localhost'),
-        port=env.str('POSTGRES_PORT', '5432')
-    )
+# Все запросы обработчиков к БД — через асинхронный репозиторий на пуле asyncpg
+db_async = Repository(
+    min_size=env.int('DB_POOL_MIN', 1),
+    max_size=env.int('DB_POOL_MAX', 10),
+    timeout=env.float('DB_POOL_TIMEOUT', 30),
+    check_interval=env.float('DB_POOL_CHECK_INTERVAL', 300),
+    object_order=object_names,
+    expense_order=expense_types,
+    user_status_ttl=env.float('USER_STATUS_CACHE_TTL', 60),
+    version_check_interval=env.float('CACHE_VERSION_CHECK_INTERVAL', 5),
+    database=env.str('POSTGRES_DB', 'kapital'),
+    user=env.str('POSTGRES_USER', 'postgres'),
+    password=env.str('POSTGRES_PASSWORD', 'postgres'),
+    host=env.str('POSTGRES_HOST', 'localhost'),
+    port=env.int('POSTGRES_PORT', 5432)
+)
 
-def init_db():
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        id SERIAL PRIMARY KEY,
-        user_id BIGINT UNIQUE,
-        name TEXT,
-        phone TEXT,
-        status TEXT,
-        reg_date TEXT
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS admins (
-        id SERIAL PRIMARY KEY,
-        user_id BIGINT UNIQUE,
-        name TEXT,
-        added_by BIGINT,
-        added_date TEXT
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS pay_types (
-        id SERIAL PRIMARY KEY,
-        name TEXT UNIQUE
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS categories (
-        id SERIAL PRIMARY KEY,
-        name TEXT UNIQUE
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS object_names (
-        id SERIAL PRIMARY KEY,
-        name TEXT UNIQUE
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS expense_types (
-        id SERIAL PRIMARY KEY,
-        name TEXT UNIQUE
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS pending_approvals (
-        id SERIAL PRIMARY KEY,
-        approval_key TEXT UNIQUE,
-        user_id BIGINT,
-        data JSONB,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
-    
-    # Очищаем старые данные
-    c.execute('DELETE FROM object_names')
-    c.execute('DELETE FROM expense_types')
-    
-    # Заполняем дефолтные значения, если таблицы пусты
-    c.execute('SELECT COUNT(*) FROM pay_types')
-    if c.fetchone()[0] == 0:
-        for name in ["Plastik", "Naxt", "Perevod", "Bank"]:
-            c.execute('INSERT INTO pay_types (name) VALUES (%s)', (name,))
-    c.execute('SELECT COUNT(*) FROM categories')
-    if c.fetchone()[0] == 0:
-        for name in ["🟥 Doimiy Xarajat", "🟩 Oʻzgaruvchan Xarajat", "🟪 Qarz", "⚪ Avtoprom", "🟩 Divident", "🟪 Soliq", "🟦 Ish Xaqi"]:
-            c.execute('INSERT INTO categories (name) VALUES (%s)', (name,))
-    
-    # Добавляем дефолтных админов
-    c.execute('SELECT COUNT(*) FROM admins')
-    if c.fetchone()[0] == 0:
-        from datetime import datetime
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        for admin_id in ADMINS:
-            c.execute('INSERT INTO admins (user_id, name, added_by, added_date) VALUES (%s, %s, %s, %s) ON CONFLICT (user_id) DO NOTHING',
-                      (admin_id, f'Admin {admin_id}', admin_id, current_time))
-    
-    # Заполняем объекты номи
-    for name in object_names:
-        c.execute('INSERT INTO object_names (name) VALUES (%s)', (name,))
-    
-    # Заполняем типы расходов
-    for name in expense_types:
-        c.execute('INSERT INTO expense_types (name) VALUES (%s)', (name,))
-    
-    conn.commit()
-    conn.close()
-
-init_db()
-
-# --- Проверка статуса пользователя ---
-def get_user_status(user_id):
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('SELECT status FROM users WHERE user_id=%s', (user_id,))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else None
-
-# --- Проверка является ли пользователь админом ---
-def is_admin(user_id):
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('SELECT user_id FROM admins WHERE user_id=%s', (user_id,))
-    row = c.fetchone()
-    conn.close()
-    return row is not None
-
-# --- Добавление нового админа ---
-def add_admin(user_id, name, added_by):
-    from datetime import datetime
-    conn = get_db_conn()
-    c = conn.cursor()
-    try:
-        c.execute('INSERT INTO admins (user_id, name, added_by, added_date) VALUES (%s, %s, %s, %s) ON CONFLICT (user_id) DO NOTHING',
-                  (user_id, name, added_by, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-        conn.commit()
-        return True
-    except IntegrityError:
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
-
-# --- Удаление админа ---
-def remove_admin(user_id):
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('DELETE FROM admins WHERE user_id=%s', (user_id,))
-    result = c.rowcount > 0
-    conn.commit()
-    conn.close()
-    return result
-
-# --- Получение списка всех админов ---
-def get_all_admins():
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('SELECT user_id, name, added_date FROM admins ORDER BY added_date')
-    admins = c.fetchall()
-    conn.close()
-    return admins
-
-# --- Регистрация пользователя ---
-def register_user(user_id, name, phone):
-    from datetime import datetime
-    conn = get_db_conn()
-    c = conn.cursor()
-    try:
-        c.execute('INSERT INTO users (user_id, name, phone, status, reg_date) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (user_id) DO NOTHING',
-                  (user_id, name, phone, 'pending', datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-        conn.commit()
-    except IntegrityError:
-        conn.rollback()
-    conn.close()
-
-# --- Обновление статуса пользователя ---
-def update_user_status(user_id, status):
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('UPDATE users SET status=%s WHERE user_id=%s', (status, user_id))
-    conn.commit()
-    conn.close()
-
-# --- Получение имени пользователя для Google Sheets ---
-def get_user_name(user_id):
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('SELECT name FROM users WHERE user_id=%s', (user_id,))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else ''
-
-# --- Получение актуальных списков ---
-def get_pay_types():
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('SELECT name FROM pay_types')
-    result = [row[0] for row in c.fetchall()]
-    conn.close()
-    return result
-
-def get_categories():
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('SELECT name FROM categories ORDER BY name')
-    result = [row[0] for row in c.fetchall()]
-    conn.close()
-    return result
-
-def get_object_names():
-    # Используем порядок из списка object_names
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('SELECT name FROM object_names')
-    db_names = [row[0] for row in c.fetchall()]
-    conn.close()
-    
-    # Сортируем по порядку в списке object_names
-    result = []
-    for name in object_names:
-        if name in db_names:
-            result.append(name)
-    
-    # Добавляем те, которых нет в списке (если есть)
-    for name in db_names:
-        if name not in result:
-            result.append(name)
-    
-    return result
-
-def get_expense_types():
-    # Используем порядок из списка expense_types
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('SELECT name FROM expense_types')
-    db_names = [row[0] for row in c.fetchall()]
-    conn.close()
-    
-    # Сортируем по порядку в списке expense_types
-    result = []
-    for name in expense_types:
-        if name in db_names:
-            result.append(name)
-    
-    # Добавляем те, которых нет в списке (если есть)
-    for name in db_names:
-        if name not in result:
-            result.append(name)
-    
-    return result
+# Строка отправителя и версии кэшей загружаются одним запросом на апдейт
+dp.middleware.setup(UpdateContextMiddleware(db_async))
+
+# Состояния FSM держатся в памяти и фоном сохраняются в БД, поэтому
+# начатые операции переживают перезапуск бота
+dp.storage = PostgresStorage(
+    db_async,
+    flush_interval=env.float('FSM_FLUSH_INTERVAL', 1),
+    batch_size=env.int('FSM_FLUSH_BATCH', 500),
+    max_age=env.int('FSM_STATE_MAX_AGE', 604800)
+)
+
+# --- Инициализация БД ---
+DEFAULT_PAY_TYPES = ["Plastik", "Naxt", "Perevod", "Bank"]
+DEFAULT_CATEGORIES = ["🟥 Doimiy Xarajat", "🟩 Oʻzgaruvchan Xarajat", "🟪 Qarz", "⚪ Avtoprom", "🟩 Divident", "🟪 Soliq", "🟦 Ish Xaqi"]
+
+async def init_db():
+    """Новые миграции схемы и досев справочников и админов, если списки в коде изменились"""
+    async with db_async.connection() as conn:
+        applied = await migrate(conn)
+        if applied:
+            logger.info(f"✅ Применены миграции БД: {applied}")
+        await seed(conn, 'reference_lists', {
+            'pay_types': DEFAULT_PAY_TYPES,
+            'categories': DEFAULT_CATEGORIES,
+            'object_names': object_names,
+            'expense_types': expense_types,
+        }, seed_reference_lists, cache_version='reference_lists')
+        await seed(conn, 'admins', ADMINS, seed_admins, cache_version='admins')
 
 # --- Старт с регистрацией ---
 @dp.message_handler(commands=['start'])
 async def start(msg: types.Message, state: FSMContext):
     user_id = msg.from_user.id
-    status = get_user_status(user_id)
+    status = await db_async.get_user_status(user_id)
     if status == 'approved':
         await state.finish()
         text = "<b>Qaysi turdagi operatsiya?</b>"
@@ -710,39 +631,41 @@ async def process_register_phone(msg: types.Message, state: FSMContext):
     data = await state.get_data()
     user_id = msg.from_user.id
     name = data.get('name', '')
-    register_user(user_id, name, phone)
+    await db_async.register_user(user_id, name, phone)
     await msg.answer('⏳ Arizangiz adminga yuborildi. Iltimos, kuting.', reply_markup=types.ReplyKeyboardRemove())
     # Уведомление админа
-    admins = get_all_admins()
-    for admin_id, admin_name, added_date in admins:
-        kb = InlineKeyboardMarkup(row_width=2)
-        kb.add(
-            InlineKeyboardButton('✅ Ha', callback_data=f'approve_{user_id}'),
-            InlineKeyboardButton('❌ Yoq', callback_data=f'deny_{user_id}')
-        )
-        await bot.send_message(admin_id, f'🆕 Yangi foydalanuvchi ro\'yxatdan o\'tdi:\nID: <code>{user_id}</code>\nIsmi: <b>{name}</b>\nTelefon: <code>{phone}</code>', reply_markup=kb)
+    kb = InlineKeyboardMarkup(row_width=2)
+    kb.add(
+        InlineKeyboardButton('✅ Ha', callback_data=f'approve_{user_id}'),
+        InlineKeyboardButton('❌ Yoq', callback_data=f'deny_{user_id}')
+    )
+    admin_notifier.notify_later(f'🆕 Yangi foydalanuvchi ro\'yxatdan o\'tdi:\nID: <code>{user_id}</code>\nIsmi: <b>{name}</b>\nTelefon: <code>{phone}</code>', reply_markup=kb)
     await state.finish()
 
 # --- Обработка одобрения/запрета админом ---
-@dp.callback_query_handler(lambda c: (c.data.startswith('approve_') or c.data.startswith('deny_')) and not c.data.startswith('approve_large_') and not c.data.startswith('reject_large_'), state='*')
+@router.route('approve_', state='*')
+@router.route('deny_', state='*')
 async def process_admin_approve(call: types.CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id):
+    if not await db_async.is_admin(call.from_user.id):
         await safe_answer_callback(call, text='Faqat admin uchun!', show_alert=True)
         return
     action, user_id = call.data.split('_')
     user_id = int(user_id)
     if action == 'approve':
-        update_user_status(user_id, 'approved')
+        await db_async.update_user_status(user_id, 'approved')
         await bot.send_message(user_id, '✅ Sizga botdan foydalanishga ruxsat berildi! /start')
         await call.message.edit_text('✅ Foydalanuvchi tasdiqlandi.')
     else:
-        update_user_status(user_id, 'denied')
+        await db_async.update_user_status(user_id, 'denied')
         await bot.send_message(user_id, '❌ Sizga botdan foydalanishga ruxsat berilmagan.')
         await call.message.edit_text('❌ Foydalanuvchi rad etildi.')
     await safe_answer_callback(call)
 
 # --- Ограничение доступа для всех остальных хендлеров ---
-@dp.message_handler(lambda msg: get_user_status(msg.from_user.id) != 'approved', state='*')
+async def is_not_approved(msg: types.Message):
+    return await db_async.get_user_status(msg.from_user.id) != 'approved'
+
+@dp.message_handler(is_not_approved, state='*')
 async def block_unapproved(msg: types.Message, state: FSMContext):
     await msg.answer('⏳ Sizning arizangiz ko\'rib chiqilmoqda yoki sizga ruxsat berilmagan.')
     await state.finish()
@@ -788,41 +711,76 @@ async def reboot_cmd(msg: types.Message, state: FSMContext):
     
     logging.info(f"Пользователь {msg.from_user.id} возвращен к начальному состоянию FSM")
 
+@dp.message_handler(commands=['balans'], state='*')
+async def balans_cmd(msg: types.Message, state: FSMContext):
+    """Текущие балансы из локального журнала операций"""
+    balances = await db_async.get_balances()
+    await msg.answer(
+        f"{format_balance('Сом', balances.get('Сом'))}\n"
+        f"{format_balance('Доллар', balances.get('Доллар'))}"
+    )
+
 # Кирим/Чиқим выбор
-@dp.callback_query_handler(lambda c: c.data.startswith('type_'), state=Form.type)
+@router.route('type_', state=Form.type)
 async def process_type(call: types.CallbackQuery, state: FSMContext):
     # Сразу отвечаем на callback чтобы кнопка не "зависла"
     await safe_answer_callback(call)
     
     t = 'Кирим' if call.data == 'type_kirim' else 'Чиқим'
     await state.update_data(type=t)
-    await call.message.edit_text("<b>Объект номини tanlang:</b>", reply_markup=get_object_names_kb())
+    await call.message.edit_text("<b>Объект номини tanlang:</b>", reply_markup=await get_object_names_kb(call.from_user.id))
     await Form.object_name.set()
 
+# Листание клавиатур объектов и типов расходов
+@router.route(PAGE_PREFIX + SEPARATOR, state=[Form.object_name, Form.expense_type])
+async def reference_page_cb(call: types.CallbackQuery, state: FSMContext):
+    await safe_answer_callback(call)
+    parsed = parse_page_callback(call.data)
+    if parsed is None:
+        return
+    action, table, page = parsed
+    kb = await reference_page_kb(table, action, page, call.from_user.id)
+    try:
+        await call.message.edit_reply_markup(reply_markup=kb)
+    except Exception as e:
+        # Нажата кнопка текущей страницы
+        if "Message is not modified" not in str(e):
+            raise
+
 # Объект номи выбор
-@dp.callback_query_handler(lambda c: c.data.startswith('object_'), state=Form.object_name)
+@router.route(reference_prefix('object'), state=Form.object_name)
 async def process_object_name(call: types.CallbackQuery, state: FSMContext):
+    object_id, object_name = await decode_reference(call)
+    if object_name is None:
+        await safe_answer_callback(call, text=REFERENCE_GONE_TEXT, show_alert=True)
+        await call.message.edit_reply_markup(reply_markup=await get_object_names_kb(call.from_user.id))
+        return
     # Сразу отвечаем на callback чтобы кнопка не "зависла"
     await safe_answer_callback(call)
     
-    object_name = call.data[7:]  # Убираем 'object_' префикс
     await state.update_data(object_name=object_name)
-    await call.message.edit_text("<b>Харажат турини tanlang:</b>", reply_markup=get_expense_types_kb())
+    remember_choice(call.from_user.id, 'object_names', object_id)
+    await call.message.edit_text("<b>Харажат турини tanlang:</b>", reply_markup=await get_expense_types_kb(call.from_user.id))
     await Form.expense_type.set()
 
 # Харажат тури выбор
-@dp.callback_query_handler(lambda c: c.data.startswith('expense_'), state=Form.expense_type)
+@router.route(reference_prefix('expense'), state=Form.expense_type)
 async def process_expense_type(call: types.CallbackQuery, state: FSMContext):
+    expense_id, expense_type = await decode_reference(call)
+    if expense_type is None:
+        await safe_answer_callback(call, text=REFERENCE_GONE_TEXT, show_alert=True)
+        await call.message.edit_reply_markup(reply_markup=await get_expense_types_kb(call.from_user.id))
+        return
     # Сразу отвечаем на callback чтобы кнопка не "зависла"
     await safe_answer_callback(call)
     
-    expense_type = call.data[8:]  # Убираем 'expense_' префикс
     await state.update_data(expense_type=expense_type)
+    remember_choice(call.from_user.id, 'expense_types', expense_id)
     await call.message.edit_text("<b>Qanday to'lov turi? Сом yoki $?</b>", reply_markup=get_currency_types_kb())
     await Form.currency_type.set()
 
 # Выбор валюты
-@dp.callback_query_handler(lambda c: c.data.startswith('currency_'), state=Form.currency_type)
+@router.route('currency_', state=Form.currency_type)
 async def process_currency_type(call: types.CallbackQuery, state: FSMContext):
     # Сразу отвечаем на callback чтобы кнопка не "зависла"
     await safe_answer_callback(call)
@@ -833,7 +791,7 @@ async def process_currency_type(call: types.CallbackQuery, state: FSMContext):
     await Form.amount.set()
 
 # Выбор типа оплаты
-@dp.callback_query_handler(lambda c: c.data.startswith('payment_'), state=Form.payment_type)
+@router.route('payment_', state=Form.payment_type)
 async def process_payment_type(call: types.CallbackQuery, state: FSMContext):
     # Сразу отвечаем на callback чтобы кнопка не "зависла"
     await safe_answer_callback(call)
@@ -880,7 +838,7 @@ async def process_exchange_rate(msg: types.Message, state: FSMContext):
     await Form.payment_type.set()
 
 # Кнопка пропуска комментария
-@dp.callback_query_handler(lambda c: c.data == 'skip_comment', state=Form.comment)
+@router.route('skip_comment', state=Form.comment, exact=True)
 async def skip_comment_btn(call: types.CallbackQuery, state: FSMContext):
     # Сразу отвечаем на callback чтобы кнопка не "зависла"
     await safe_answer_callback(call)
@@ -915,7 +873,8 @@ async def process_comment(msg: types.Message, state: FSMContext):
     await state.set_state('confirm')
 
 # Обработка кнопок Да/Нет
-@dp.callback_query_handler(lambda c: c.data in ['confirm_yes', 'confirm_no'], state='confirm')
+@router.route('confirm_yes', state='confirm', exact=True)
+@router.route('confirm_no', state='confirm', exact=True)
 async def process_confirm(call: types.CallbackQuery, state: FSMContext):
     # Сразу отвечаем на callback чтобы кнопка не "зависла"
     await safe_answer_callback(call)
@@ -943,6 +902,7 @@ async def process_confirm(call: types.CallbackQuery, state: FSMContext):
         data['vaqt'] = time_str
         # Гарантируем, что user_id всегда есть
         data['user_id'] = call.from_user.id
+        data['user_full_name'] = call.from_user.full_name
         
         # Проверяем сумму для одобрения админом (только для Chiqim)
         operation_type = data.get('type', '')
@@ -965,7 +925,7 @@ async def process_confirm(call: types.CallbackQuery, state: FSMContext):
             
             if needs_approval:
                 # Отправляем на одобрение админу
-                user_name = get_user_name(call.from_user.id) or call.from_user.full_name
+                user_name = await db_async.get_user_name(call.from_user.id) or call.from_user.full_name
                 summary_text = format_summary(data)
                 admin_approval_text = f"⚠️ <b>Tasdiqlash talab qilinadi!</b>\n\nFoydalanuvchi <b>{user_name}</b> tomonidan kiritilgan katta summa:\n\n{summary_text}"
                 
@@ -982,106 +942,38 @@ async def process_confirm(call: types.CallbackQuery, state: FSMContext):
                 data['approval_timestamp'] = int(dt.timestamp())
                 
                 # Сохраняем в базе данных
-                if save_pending_approval(approval_key, call.from_user.id, data):
+                if await db_async.save_pending_approval(approval_key, call.from_user.id, data):
                     logging.info(f"Данные сохранены в базе данных для одобрения. Ключ: {approval_key}")
                     logging.info(f"Сохраненные данные: {data}")
                 else:
                     logging.error(f"Ошибка сохранения данных в базе данных для ключа: {approval_key}")
                 
-                # Отправляем всем админам
-                sent_to_admin = False
-                admins = get_all_admins()
-                logging.info(f"Найдено админов в базе: {len(admins)}")
-                for admin_id, admin_name, added_date in admins:
-                    logging.info(f"Пытаемся отправить уведомление админу {admin_id} ({admin_name})")
-                    try:
-                        await bot.send_message(admin_id, admin_approval_text, reply_markup=admin_kb)
-                        sent_to_admin = True
-                        logging.info(f"✅ Уведомление успешно отправлено админу {admin_id}")
-                    except Exception as e:
-                        error_msg = str(e)
-                        if "Chat not found" in error_msg:
-                            logging.error(f"❌ Админ {admin_id} ({admin_name}) не найден в чате. Возможно, не запустил бота или заблокировал его.")
-                        elif "Forbidden" in error_msg:
-                            logging.error(f"❌ Админ {admin_id} ({admin_name}) заблокировал бота.")
-                        else:
-                            logging.error(f"❌ Ошибка отправки админу {admin_id}: {error_msg}")
-                
-                if sent_to_admin:
-                    await call.message.answer('⏳ Arizangiz administratorga yuborildi. Tasdiqlashni kuting.')
-                else:
-                    await call.message.answer('⚠️ Xatolik: tasdiqlashga yuborish amalga oshmadi. Iltimos, administrator bilan bog\'laning.')
+                # Отправляем всем админам фоном; если не дойдёт ни до кого, пользователь получит предупреждение
+                admin_notifier.detach(send_approval_request(call.from_user.id, admin_approval_text, admin_kb))
+                await call.message.answer('⏳ Arizangiz administratorga yuborildi. Tasdiqlashni kuting.')
             else:
-                # Обычная отправка в Google Sheet
-                success = add_to_google_sheet(data)
-                if success:
-                    await call.message.answer('✅ Ma\'lumotlar Google Sheets-ga muvaffaqiyatli yuborildi!')
-                                    # Jo'natilgandan so'ng, valyutaga qarab E1 yoki G1 natijaviy qiymatini yuboramiz
-                try:
-                    e1_value, g1_value = get_e1_g1_values()
+                # Сначала сохраняем операцию в outbox; в Google Sheets её запишет фоновый обработчик
+                recorded = await queue_google_sheet_write(data)
+                if recorded is not None:
+                    _, balance = recorded
+                    await call.message.answer('✅ Ma\'lumotlar qabul qilindi va Google Sheets-ga yuborilmoqda!')
+                    # Баланс берём из локального журнала, а не из формул E1/G1
+                    balance_text = format_balance(data.get('currency_type'), balance)
+                    await send_balance_message(call.from_user.id, data, balance_text)
                     
-                    # Проверяем дублирование сообщения о балансе
-                    from datetime import datetime
-                    current_time = datetime.now()
-                    is_duplicate = is_balance_message_duplicate(
-                        call.from_user.id, 
-                        data.get('type', ''), 
-                        data.get('amount', ''), 
-                        data.get('currency_type', ''), 
-                        current_time
+                    # Уведомление для админов
+                    user_name = await db_async.get_user_name(call.from_user.id) or call.from_user.full_name
+                    summary_text = format_summary(data)
+                    admin_notifier.notify_later(
+                        f"Foydalanuvchi <b>{user_name}</b> tomonidan kiritilgan yangi ma'lumot:\n\n{summary_text}"
+                        f"\n\n💰 <b>Balans:</b>\n{balance_text}"
                     )
-                    
-                    if not is_duplicate:
-                        # Отправляем только одну сумму в зависимости от валюты операции
-                        if data.get('currency_type') == 'Доллар':
-                            logging.info(f"Отправляем баланс в долларах пользователю {call.from_user.id}: {e1_value}")
-                            await call.message.answer(f"💰 Balans: dollarda {e1_value}")
-                        else:  # Сом
-                            logging.info(f"Отправляем баланс в сомах пользователю {call.from_user.id}: {g1_value}")
-                            await call.message.answer(f"💰 Balans: somda {g1_value}")
-                    else:
-                        logging.info(f"Сообщение о балансе для пользователя {call.from_user.id} пропущено как дубликат")
-                        
-                except Exception as e:
-                    logging.error(f"E1/G1 qiymatlarini yuborishda xatolik: {e}")
                 else:
                     await call.message.answer('⚠️ Bu ma\'lumot allaqachon yozilgan. Qayta urinib ko\'rmang.')
 
-                # Уведомление для админов
-                user_name = get_user_name(call.from_user.id) or call.from_user.full_name
-                summary_text = format_summary(data)
-                admin_notification_text = f"Foydalanuvchi <b>{user_name}</b> tomonidan kiritilgan yangi ma'lumot:\n\n{summary_text}"
-                
-                # Добавляем информацию о балансе для админов (только один раз)
-                try:
-                    e1_value, g1_value = get_e1_g1_values()
-                    balance_info = ""
-                    if data.get('currency_type') == 'Доллар':
-                        balance_info = f"\n\n💰 <b>Balans:</b>\n💰 Balans: dollarda {e1_value}"
-                    else:  # Сом
-                        balance_info = f"\n\n💰 <b>Balans:</b>\n💰 Balans: somda {g1_value}"
-                    admin_notification_text += balance_info
-                    logging.info(f"Информация о балансе добавлена в уведомление для админов: {balance_info.strip()}")
-                except Exception as e:
-                    logging.error(f"Balans ma'lumotlarini qo'shishda xatolik: {e}")
-                
-                admins = get_all_admins()
-                logging.info(f"Отправляем уведомления {len(admins)} админам")
-                for admin_id, admin_name, added_date in admins:
-                    try:
-                        await bot.send_message(admin_id, admin_notification_text)
-                        logging.info(f"✅ Уведомление отправлено админу {admin_id} ({admin_name})")
-                    except Exception as e:
-                        error_msg = str(e)
-                        if "Chat not found" in error_msg:
-                            logging.error(f"❌ Админ {admin_id} ({admin_name}) не найден в чате")
-                        elif "Forbidden" in error_msg:
-                            logging.error(f"❌ Админ {admin_id} ({admin_name}) заблокировал бота")
-                        else:
-                            logging.error(f"❌ Ошибка отправки админу {admin_id}: {error_msg}")
-
         except Exception as e:
-            await call.message.answer(f'⚠️ Google Sheets-ga yuborishda xatolik: {e}')
+            logging.error(f"Ошибка при сохранении операции пользователя {call.from_user.id}: {e}")
+            await call.message.answer('⚠️ Ma\'lumotni saqlashda xatolik yuz berdi. Iltimos, qayta urinib ko\'ring.')
         await state.finish()
     else:
         await call.message.answer('❌ Operatsiya bekor qilindi.')
@@ -1098,14 +990,14 @@ async def process_confirm(call: types.CallbackQuery, state: FSMContext):
     await Form.type.set()
 
 # Обработка одобрения больших сумм
-@dp.callback_query_handler(lambda c: c.data.startswith('approve_large_'), state='*')
+@router.route('approve_large_', state='*')
 async def approve_large_amount(call: types.CallbackQuery, state: FSMContext):
     # Сразу отвечаем на callback чтобы кнопка не "зависла"
     await safe_answer_callback(call)
     
     logging.info(f"Одобрение больших сумм вызвано: {call.data}")
     
-    if not is_admin(call.from_user.id):
+    if not await db_async.is_admin(call.from_user.id):
         await safe_answer_callback(call, text='Faqat admin uchun!', show_alert=True)
         return
     
@@ -1117,112 +1009,73 @@ async def approve_large_amount(call: types.CallbackQuery, state: FSMContext):
     
     logging.info(f"Approval key: {approval_key}")
     
-    # Проверяем, не был ли уже обработан этот ключ одобрения
-    if not check_approval_status(approval_key):
+    # Забираем заявку одним запросом: при одновременных нажатиях её получает только один админ
+    try:
+        saved_data = await db_async.claim_pending_approval(approval_key)
+    except Exception as e:
+        logging.error(f"Ошибка при получении заявки {approval_key}: {e}")
+        await safe_answer_callback(call, text='Xatolik yuz berdi!', show_alert=True)
+        return
+    if saved_data is None:
         logging.warning(f"Ключ одобрения {approval_key} уже был обработан или не существует")
         await safe_answer_callback(call, text='Bu ariza allaqachon ko\'rib chiqilgan yoki mavjud emas!', show_alert=True)
         return
     
     try:
-        # Получаем сохраненные данные из базы данных
-        saved_data = get_pending_approval(approval_key)
-        if saved_data:
-            logging.info(f"Найдены данные для одобрения: {saved_data}")
-            
-            # Отправляем в Google Sheet
-            success = add_to_google_sheet(saved_data)
-            if success:
-                logging.info("Данные отправлены в Google Sheet")
-                # Jo'natilgandan so'ng, valyutaga qarab E1 yoki G1 natijaviy qiymatini yuboramiz
-                try:
-                    e1_value, g1_value = get_e1_g1_values()
-                    
-                    # Проверяем дублирование сообщения о балансе
-                    from datetime import datetime
-                    current_time = datetime.now()
-                    is_duplicate = is_balance_message_duplicate(
-                        user_id, 
-                        saved_data.get('type', ''), 
-                        saved_data.get('amount', ''), 
-                        saved_data.get('currency_type', ''), 
-                        current_time
-                    )
-                    
-                    if not is_duplicate:
-                        # Отправляем только одну сумму в зависимости от валюты операции
-                        if saved_data.get('currency_type') == 'Доллар':
-                            logging.info(f"Отправляем баланс в долларах пользователю {user_id}: {e1_value}")
-                            await bot.send_message(user_id, f"💰 Balans: dollarda {e1_value}")
-                        else:  # Сом
-                            logging.info(f"Отправляем баланс в сомах пользователю {user_id}: {g1_value}")
-                            await bot.send_message(user_id, f"💰 Balans: somda {g1_value}")
-                    else:
-                        logging.info(f"Сообщение о балансе для пользователя {user_id} пропущено как дубликат")
-                        
-                except Exception as e_val:
-                    logging.error(f"E1/G1 qiymatlarini yuborishda xatolik: {e_val}")
-            else:
-                logging.info("Дублирование предотвращено при одобрении")
-            
-            # Отправляем сообщение пользователю
-            await bot.send_message(user_id, '✅ Arizangiz tasdiqlandi! Ma\'lumotlar Google Sheet-ga yozildi.')
-            
-            # Удаляем из базы данных
-            delete_pending_approval(approval_key)
-            
-            # Останавливаем FSM для пользователя, который отправил заявку
-            try:
-                # Создаем новый FSM контекст для пользователя, который отправил заявку
-                from aiogram.dispatcher import FSMContext
-                user_state = FSMContext(storage=state.storage, key=state.key)
-                user_state.key = (user_state.key[0], user_id, user_state.key[2])
-                await user_state.finish()
-                logging.info(f"FSM остановлен для пользователя {user_id}")
-            except Exception as e:
-                logging.error(f"Ошибка при остановке FSM для пользователя {user_id}: {e}")
-            
-            # Отправляем меню выбора операции
-            text = "<b>Qaysi turdagi operatsiya?</b>"
-            kb = InlineKeyboardMarkup(row_width=2)
-            kb.add(
-                InlineKeyboardButton('🟢 Кирим', callback_data='type_kirim'),
-                InlineKeyboardButton('🔴 Чиқим', callback_data='type_chiqim')
-            )
-            await bot.send_message(user_id, text, reply_markup=kb)
-            
-            # Отправляем уведомления всем админам об одобрении
-            user_name = get_user_name(user_id) or "Неизвестный пользователь"
-            admin_notification_text = f"✅ <b>Ariza tasdiqlandi!</b>\n\nFoydalanuvchi <b>{user_name}</b> tomonidan kiritilgan ma'lumot tasdiqlandi va Google Sheet-ga yozildi.\n\n{format_summary(saved_data)}"
-            
-            admins = get_all_admins()
-            for admin_id, admin_name, added_date in admins:
-                try:
-                    await bot.send_message(admin_id, admin_notification_text)
-                    logging.info(f"✅ Уведомление об одобрении отправлено админу {admin_id} ({admin_name})")
-                except Exception as e:
-                    error_msg = str(e)
-                    if "Chat not found" in error_msg:
-                        logging.error(f"❌ Админ {admin_id} ({admin_name}) не найден в чате")
-                    elif "Forbidden" in error_msg:
-                        logging.error(f"❌ Админ {admin_id} ({admin_name}) заблокировал бота")
-                    else:
-                        logging.error(f"❌ Ошибка отправки уведомления об одобрении админу {admin_id}: {error_msg}")
-        else:
-            logging.warning(f"Данные для ключа одобрения {approval_key} не найдены")
-            await safe_answer_callback(call, text='Ma\'lumotlar topilmadi!', show_alert=True)
+        logging.info(f"Найдены данные для одобрения: {saved_data}")
+        
+        # Ставим в журнал и outbox, баланс получаем сразу из БД. Заявка уже
+        # забрана из БД, поэтому повторов не будет: защита от двойного нажатия
+        # не нужна и не должна молча отбрасывать одобренную операцию
+        try:
+            _, balance = await queue_google_sheet_write(saved_data, dedup=False)
+        except Exception:
+            # Возвращаем заявку, чтобы её можно было одобрить ещё раз
+            await db_async.save_pending_approval(approval_key, user_id, saved_data)
+            raise
+        await send_balance_message(user_id, saved_data, format_balance(saved_data.get('currency_type'), balance))
+        
+        # Отправляем сообщение пользователю
+        await bot.send_message(user_id, '✅ Arizangiz tasdiqlandi! Ma\'lumotlar Google Sheet-ga yuborilmoqda.')
+        
+        # Останавливаем FSM для пользователя, который отправил заявку
+        try:
+            # Создаем новый FSM контекст для пользователя, который отправил заявку
+            from aiogram.dispatcher import FSMContext
+            user_state = FSMContext(storage=state.storage, key=state.key)
+            user_state.key = (user_state.key[0], user_id, user_state.key[2])
+            await user_state.finish()
+            logging.info(f"FSM остановлен для пользователя {user_id}")
+        except Exception as e:
+            logging.error(f"Ошибка при остановке FSM для пользователя {user_id}: {e}")
+        
+        # Отправляем меню выбора операции
+        text = "<b>Qaysi turdagi operatsiya?</b>"
+        kb = InlineKeyboardMarkup(row_width=2)
+        kb.add(
+            InlineKeyboardButton('🟢 Кирим', callback_data='type_kirim'),
+            InlineKeyboardButton('🔴 Чиқим', callback_data='type_chiqim')
+        )
+        await bot.send_message(user_id, text, reply_markup=kb)
+        
+        # Отправляем уведомления всем админам об одобрении
+        user_name = await db_async.get_user_name(user_id) or "Неизвестный пользователь"
+        admin_notifier.notify_later(
+            f"✅ <b>Ariza tasdiqlandi!</b>\n\nFoydalanuvchi <b>{user_name}</b> tomonidan kiritilgan ma'lumot tasdiqlandi va Google Sheet-ga yuborildi.\n\n{format_summary(saved_data)}"
+        )
     except Exception as e:
         logging.error(f"Ошибка при одобрении: {e}")
         await safe_answer_callback(call, text='Xatolik yuz berdi!', show_alert=True)
 
 # Обработка отклонения больших сумм
-@dp.callback_query_handler(lambda c: c.data.startswith('reject_large_'), state='*')
+@router.route('reject_large_', state='*')
 async def reject_large_amount(call: types.CallbackQuery, state: FSMContext):
     # Сразу отвечаем на callback чтобы кнопка не "зависла"
     await safe_answer_callback(call)
     
     logging.info(f"Отклонение больших сумм вызвано: {call.data}")
     
-    if not is_admin(call.from_user.id):
+    if not await db_async.is_admin(call.from_user.id):
         await safe_answer_callback(call, text='Faqat admin uchun!', show_alert=True)
         return
     
@@ -1234,8 +1087,14 @@ async def reject_large_amount(call: types.CallbackQuery, state: FSMContext):
     
     logging.info(f"Rejection key: {approval_key}")
     
-    # Проверяем, не был ли уже обработан этот ключ одобрения
-    if not check_approval_status(approval_key):
+    # Забираем заявку одним запросом: при одновременных нажатиях её получает только один админ
+    try:
+        claimed = await db_async.claim_pending_approval(approval_key)
+    except Exception as e:
+        logging.error(f"Ошибка при получении заявки {approval_key}: {e}")
+        await safe_answer_callback(call, text='Xatolik yuz berdi!', show_alert=True)
+        return
+    if claimed is None:
         logging.warning(f"Ключ одобрения {approval_key} уже был обработан или не существует")
         await safe_answer_callback(call, text='Bu ariza allaqachon ko\'rib chiqilgan yoki mavjud emas!', show_alert=True)
         return
@@ -1244,16 +1103,6 @@ async def reject_large_amount(call: types.CallbackQuery, state: FSMContext):
         # Отправляем сообщение пользователю
         await bot.send_message(user_id, '❌ Arizangiz administrator tomonidan rad etildi.')
         
-        # Удаляем из базы данных
-        if delete_pending_approval(approval_key):
-            logging.info(f"Заявка удалена из базы данных: {approval_key}")
-        else:
-            logging.warning(f"Заявка не найдена в базе данных для удаления: {approval_key}")
-            # Проверяем, может быть другой админ уже обработал заявку
-            if not check_approval_status(approval_key):
-                await call.message.edit_text('❌ Ariza ma\'lumotlari topilmadi. Boshqa admin tomonidan tasdiqlangan yoki rad etilgan bo\'lishi mumkin.', reply_markup=None)
-                return
-        
         # Останавливаем FSM для пользователя, который отправил заявку
         try:
             # Создаем новый FSM контекст для пользователя, который отправил заявку
@@ -1298,7 +1147,7 @@ async def reject_large_amount(call: types.CallbackQuery, state: FSMContext):
 # --- Команды для админа ---
 @dp.message_handler(commands=['add_tolov'], state='*')
 async def add_paytype_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()  # Сброс состояния
@@ -1308,21 +1157,15 @@ async def add_paytype_cmd(msg: types.Message, state: FSMContext):
 @dp.message_handler(state='add_paytype', content_types=types.ContentTypes.TEXT)
 async def add_paytype_save(msg: types.Message, state: FSMContext):
     name = msg.text.strip()
-    conn = get_db_conn()
-    c = conn.cursor()
-    try:
-        c.execute('INSERT INTO pay_types (name) VALUES (%s)', (name,))
-        conn.commit()
+    if await db_async.add_list_item('pay_types', name):
         await msg.answer(f'✅ Yangi To\'lov turi qo\'shildi: {name}')
-    except IntegrityError:
+    else:
         await msg.answer('❗️ Bu nom allaqachon mavjud.')
-        conn.rollback()
-    conn.close()
     await state.finish()
 
 @dp.message_handler(commands=['add_category'], state='*')
 async def add_category_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()  # Сброс состояния
@@ -1333,62 +1176,58 @@ async def add_category_cmd(msg: types.Message, state: FSMContext):
 async def add_category_save(msg: types.Message, state: FSMContext):
     # Удаляем эмодзи из названия категории
     name = clean_emoji(msg.text.strip())
-    conn = get_db_conn()
-    c = conn.cursor()
-    try:
-        c.execute('INSERT INTO categories (name) VALUES (%s)', (name,))
-        conn.commit()
+    if await db_async.add_list_item('categories', name):
         await msg.answer(f'✅ Yangi kategoriya qo\'shildi: {name}')
-    except IntegrityError:
+    else:
         await msg.answer('❗️ Bu nom allaqachon mavjud.')
-        conn.rollback()
-    conn.close()
     await state.finish()
 
 # --- Удаление и изменение To'lov turi ---
 @dp.message_handler(commands=['del_tolov'], state='*')
 async def del_tolov_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()  # Сброс состояния
     kb = InlineKeyboardMarkup(row_width=1)
-    for name in get_pay_types():
-        kb.add(InlineKeyboardButton(f'❌ {name}', callback_data=f'del_tolov_{name}'))
+    for item_id, name in await db_async.get_reference_items('pay_types'):
+        kb.add(InlineKeyboardButton(f'❌ {name}', callback_data=reference_callback('del_tolov', item_id)))
     await msg.answer('O\'chirish uchun To\'lov turini tanlang:', reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('del_tolov_'))
+@router.route(reference_prefix('del_tolov'))
 async def del_tolov_cb(call: types.CallbackQuery):
-    if not is_admin(call.from_user.id):
+    if not await db_async.is_admin(call.from_user.id):
         await call.answer('Faqat admin uchun!', show_alert=True)
         return
-    name = call.data[len('del_tolov_'):]
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('DELETE FROM pay_types WHERE name=%s', (name,))
-    conn.commit()
-    conn.close()
+    item_id, name = await decode_reference(call)
+    if name is None:
+        await call.answer(REFERENCE_GONE_TEXT, show_alert=True)
+        return
+    await db_async.delete_list_item('pay_types', item_id)
     await call.message.edit_text(f'❌ To\'lov turi o\'chirildi: {name}')
     await safe_answer_callback(call)
 
 @dp.message_handler(commands=['edit_tolov'], state='*')
 async def edit_tolov_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()  # Сброс состояния
     kb = InlineKeyboardMarkup(row_width=1)
-    for name in get_pay_types():
-        kb.add(InlineKeyboardButton(f'✏️ {name}', callback_data=f'edit_tolov_{name}'))
+    for item_id, name in await db_async.get_reference_items('pay_types'):
+        kb.add(InlineKeyboardButton(f'✏️ {name}', callback_data=reference_callback('edit_tolov', item_id)))
     await msg.answer('Tahrirlash uchun To\'lov turini tanlang:', reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('edit_tolov_'))
+@router.route(reference_prefix('edit_tolov'))
 async def edit_tolov_cb(call: types.CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id):
+    if not await db_async.is_admin(call.from_user.id):
         await call.answer('Faqat admin uchun!', show_alert=True)
         return
-    old_name = call.data[len('edit_tolov_'):]
-    await state.update_data(edit_tolov_old=old_name)
+    item_id, old_name = await decode_reference(call)
+    if old_name is None:
+        await call.answer(REFERENCE_GONE_TEXT, show_alert=True)
+        return
+    await state.update_data(edit_tolov_old=old_name, edit_tolov_id=item_id)
     await call.message.answer(f'Yangi nomini yuboring (eski: {old_name}):')
     await state.set_state('edit_tolov_new')
     await call.answer()
@@ -1398,11 +1237,7 @@ async def edit_tolov_save(msg: types.Message, state: FSMContext):
     data = await state.get_data()
     old_name = data.get('edit_tolov_old')
     new_name = msg.text.strip()
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('UPDATE pay_types SET name=%s WHERE name=%s', (new_name, old_name))
-    conn.commit()
-    conn.close()
+    await db_async.rename_list_item('pay_types', data.get('edit_tolov_id'), new_name)
     await msg.answer(f'✏️ To\'lov turi o\'zgartirildi: {old_name} -> {new_name}')
     await state.finish()
 
@@ -1414,21 +1249,20 @@ async def del_category_cmd(msg: types.Message, state: FSMContext):
         return
     await state.finish()  # Сброс состояния
     kb = InlineKeyboardMarkup(row_width=1)
-    for name in get_categories():
-        kb.add(InlineKeyboardButton(f'❌ {name}', callback_data=f'del_category_{name}'))
+    for item_id, name in await db_async.get_reference_items('categories'):
+        kb.add(InlineKeyboardButton(f'❌ {name}', callback_data=reference_callback('del_category', item_id)))
     await msg.answer('O\'chirish uchun kategoriya tanlang:', reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('del_category_'))
+@router.route(reference_prefix('del_category'))
 async def del_category_cb(call: types.CallbackQuery):
-    if not is_admin(call.from_user.id):
+    if not await db_async.is_admin(call.from_user.id):
         await call.answer('Faqat admin uchun!', show_alert=True)
         return
-    name = call.data[len('del_category_'):]
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('DELETE FROM categories WHERE name=%s', (name,))
-    conn.commit()
-    conn.close()
+    item_id, name = await decode_reference(call)
+    if name is None:
+        await call.answer(REFERENCE_GONE_TEXT, show_alert=True)
+        return
+    await db_async.delete_list_item('categories', item_id)
     await call.message.edit_text(f'❌ Kategoriya o\'chirildi: {name}')
     await call.answer()
 
@@ -1439,17 +1273,20 @@ async def edit_category_cmd(msg: types.Message, state: FSMContext):
         return
     await state.finish()  # Сброс состояния
     kb = InlineKeyboardMarkup(row_width=1)
-    for name in get_categories():
-        kb.add(InlineKeyboardButton(f'✏️ {name}', callback_data=f'edit_category_{name}'))
+    for item_id, name in await db_async.get_reference_items('categories'):
+        kb.add(InlineKeyboardButton(f'✏️ {name}', callback_data=reference_callback('edit_category', item_id)))
     await msg.answer('Tahrirlash uchun kategoriya tanlang:', reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('edit_category_'))
+@router.route(reference_prefix('edit_category'))
 async def edit_category_cb(call: types.CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id):
+    if not await db_async.is_admin(call.from_user.id):
         await call.answer('Faqat admin uchun!', show_alert=True)
         return
-    old_name = call.data[len('edit_category_'):]
-    await state.update_data(edit_category_old=old_name)
+    item_id, old_name = await decode_reference(call)
+    if old_name is None:
+        await call.answer(REFERENCE_GONE_TEXT, show_alert=True)
+        return
+    await state.update_data(edit_category_old=old_name, edit_category_id=item_id)
     await call.message.answer(f'Yangi nomini yuboring (eski: {old_name}):')
     await state.set_state('edit_category_new')
     await call.answer()
@@ -1459,18 +1296,14 @@ async def edit_category_save(msg: types.Message, state: FSMContext):
     data = await state.get_data()
     old_name = data.get('edit_category_old')
     new_name = msg.text.strip()
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('UPDATE categories SET name=%s WHERE name=%s', (new_name, old_name))
-    conn.commit()
-    conn.close()
+    await db_async.rename_list_item('categories', data.get('edit_category_id'), new_name)
     await msg.answer(f'✏️ Kategoriya o\'zgartirildi: {old_name} -> {new_name}')
     await state.finish()
 
 # --- Команды для управления объектами ---
 @dp.message_handler(commands=['add_object'], state='*')
 async def add_object_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()
@@ -1480,21 +1313,15 @@ async def add_object_cmd(msg: types.Message, state: FSMContext):
 @dp.message_handler(state='add_object', content_types=types.ContentTypes.TEXT)
 async def add_object_save(msg: types.Message, state: FSMContext):
     name = msg.text.strip()
-    conn = get_db_conn()
-    c = conn.cursor()
-    try:
-        c.execute('INSERT INTO object_names (name) VALUES (%s)', (name,))
-        conn.commit()
+    if await db_async.add_list_item('object_names', name):
         await msg.answer(f'✅ Yangi объект номи qo\'shildi: {name}')
-    except IntegrityError:
+    else:
         await msg.answer('❗️ Bu nom allaqachon mavjud.')
-        conn.rollback()
-    conn.close()
     await state.finish()
 
 @dp.message_handler(commands=['add_expense'], state='*')
 async def add_expense_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()
@@ -1504,124 +1331,152 @@ async def add_expense_cmd(msg: types.Message, state: FSMContext):
 @dp.message_handler(state='add_expense', content_types=types.ContentTypes.TEXT)
 async def add_expense_save(msg: types.Message, state: FSMContext):
     name = msg.text.strip()
-    conn = get_db_conn()
-    c = conn.cursor()
-    try:
-        c.execute('INSERT INTO expense_types (name) VALUES (%s)', (name,))
-        conn.commit()
+    if await db_async.add_list_item('expense_types', name):
         await msg.answer(f'✅ Yangi харажат тури qo\'shildi: {name}')
-    except IntegrityError:
+    else:
         await msg.answer('❗️ Bu nom allaqachon mavjud.')
-        conn.rollback()
-    conn.close()
     await state.finish()
 
 @dp.message_handler(commands=['del_object'], state='*')
 async def del_object_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()
     kb = InlineKeyboardMarkup(row_width=1)
-    for name in get_object_names():
-        kb.add(InlineKeyboardButton(f'❌ {name}', callback_data=f'del_object_{name}'))
+    for item_id, name in await db_async.get_reference_items('object_names'):
+        kb.add(InlineKeyboardButton(f'❌ {name}', callback_data=reference_callback('del_object', item_id)))
     await msg.answer('O\'chirish uchun объект номини tanlang:', reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('del_object_'))
+@router.route(reference_prefix('del_object'))
 async def del_object_cb(call: types.CallbackQuery):
-    if not is_admin(call.from_user.id):
+    if not await db_async.is_admin(call.from_user.id):
         await call.answer('Faqat admin uchun!', show_alert=True)
         return
-    name = call.data[len('del_object_'):]
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('DELETE FROM object_names WHERE name=%s', (name,))
-    conn.commit()
-    conn.close()
+    item_id, name = await decode_reference(call)
+    if name is None:
+        await call.answer(REFERENCE_GONE_TEXT, show_alert=True)
+        return
+    await db_async.delete_list_item('object_names', item_id)
     await call.message.edit_text(f'❌ Объект номи o\'chirildi: {name}')
     await call.answer()
 
 @dp.message_handler(commands=['del_expense'], state='*')
 async def del_expense_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()
     kb = InlineKeyboardMarkup(row_width=1)
-    for name in get_expense_types():
-        kb.add(InlineKeyboardButton(f'❌ {name}', callback_data=f'del_expense_{name}'))
+    for item_id, name in await db_async.get_reference_items('expense_types'):
+        kb.add(InlineKeyboardButton(f'❌ {name}', callback_data=reference_callback('del_expense', item_id)))
     await msg.answer('O\'chirish uchun харажат турини tanlang:', reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('del_expense_'))
+@router.route(reference_prefix('del_expense'))
 async def del_expense_cb(call: types.CallbackQuery):
-    if not is_admin(call.from_user.id):
+    if not await db_async.is_admin(call.from_user.id):
         await call.answer('Faqat admin uchun!', show_alert=True)
         return
-    name = call.data[len('del_expense_'):]
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute('DELETE FROM expense_types WHERE name=%s', (name,))
-    conn.commit()
-    conn.close()
+    item_id, name = await decode_reference(call)
+    if name is None:
+        await call.answer(REFERENCE_GONE_TEXT, show_alert=True)
+        return
+    await db_async.delete_list_item('expense_types', item_id)
     await call.message.edit_text(f'❌ Харажат тури o\'chirildi: {name}')
     await call.answer()
 
 @dp.message_handler(commands=['check_sheets'], state='*')
 async def check_sheets_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()
     
-    sheet_names = get_sheet_names()
+    sheet_names = await sheets_async.get_sheet_names()
     if sheet_names:
         response = "📋 Доступные листы в Google Sheet:\n\n"
         for i, name in enumerate(sheet_names, 1):
             response += f"{i}. {name}\n"
-        await msg.answer(response)
     else:
-        await msg.answer("❌ Не удалось получить список листов")
+        response = "❌ Не удалось получить список листов\n"
+    
+    # Счётчики ограничителя квоты Sheets API
+    response += "\n📊 Квота Sheets API:\n"
+    for kind, counters in sheets_limiter.stats().items():
+        response += (f"{kind}: выдано {counters['granted']}, ждали {counters['delayed']}, "
+                     f"отказано {counters['rejected']}, 429 {counters['throttled']}\n")
+    await msg.answer(response)
+
+def format_cache_stats(cache):
+    stats = cache.stats()
+    return f"попаданий {stats['hits']}, промахов {stats['misses']}, сбросов {stats['invalidations']}, записей {stats['size']}"
+
+@dp.message_handler(commands=['db_stats'], state='*')
+async def db_stats_cmd(msg: types.Message, state: FSMContext):
+    """Состояние пула соединений с БД: занятость и время ожидания соединения"""
+    if not await db_async.is_admin(msg.from_user.id):
+        await msg.answer('Faqat admin uchun!')
+        return
+    stats = db_async.stats()
+    fsm_stats = dp.storage.stats()
+    await msg.answer(
+        f"🗄 Пул соединений с БД:\n"
+        f"Открыто: {stats['size']} (свободно {stats['idle']}), занято: {stats['in_use']} из {stats['max_size']} "
+        f"({stats['utilisation']:.0%})\n"
+        f"Выдано соединений: {stats['checkouts']}, ждали: {stats['waits']}, тайм-аутов: {stats['timeouts']}\n"
+        f"Ожидание: среднее {stats['avg_wait'] * 1000:.1f} мс, макс. {stats['max_wait'] * 1000:.1f} мс\n"
+        f"Кэш статусов: {format_cache_stats(db_async.user_status_cache)}\n"
+        f"FSM: записей {fsm_stats['written']}, удалений {fsm_stats['deleted']}, "
+        f"ждут записи {fsm_stats['pending']}, ошибок {fsm_stats['errors']}, пропущено {fsm_stats['skipped']}"
+    )
 
 @dp.message_handler(commands=['update_lists'], state='*')
 async def update_lists_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     
     try:
-        conn = get_db_conn()
-        c = conn.cursor()
-        
-        # Очищаем старые данные
-        c.execute('DELETE FROM object_names')
-        c.execute('DELETE FROM expense_types')
-        
-        # Добавляем новые объекты
-        for obj in object_names:
-            c.execute('INSERT INTO object_names (name) VALUES (%s)', (obj,))
-        
-        # Добавляем новые типы расходов
-        for exp in expense_types:
-            c.execute('INSERT INTO expense_types (name) VALUES (%s)', (exp,))
-        
-        conn.commit()
-        conn.close()
-        
+        await db_async.reset_reference_lists()
         await msg.answer('✅ Списки объектов и типов расходов обновлены!')
     except Exception as e:
         await msg.answer(f'❌ Ошибка при обновлении списков: {e}')
 
+@dp.message_handler(commands=['reconcile'], state='*')
+async def reconcile_cmd(msg: types.Message, state: FSMContext):
+    """Сверка листа с журналом: /reconcile — отчёт, /reconcile repair — с исправлением"""
+    if not await db_async.is_admin(msg.from_user.id):
+        await msg.answer('Faqat admin uchun!')
+        return
+    repair = msg.get_args().strip().lower() == 'repair'
+    await msg.answer('🔍 Сверка Google Sheets с журналом запущена...')
+    try:
+        report = await reconcile_sheet(repair)
+        await msg.answer(f"📋 Результат сверки:\n{format_reconcile_report(report)}")
+    except Exception as e:
+        logging.error(f"Ошибка сверки листа с журналом: {e}")
+        await msg.answer(f'❌ Ошибка сверки: {e}')
+
+@dp.message_handler(commands=['outbox_retry'], state='*')
+async def outbox_retry_cmd(msg: types.Message, state: FSMContext):
+    """Возвращает в очередь операции, которые не удалось записать в Google Sheets"""
+    if not await db_async.is_admin(msg.from_user.id):
+        await msg.answer('Faqat admin uchun!')
+        return
+    count = await db_async.requeue_failed_outbox()
+    if count:
+        outbox_wakeup.set()
+        await msg.answer(f"🔁 Возвращено в очередь записи в Google Sheets: {count}")
+    else:
+        await msg.answer("✅ Незаписанных операций нет.")
+
 @dp.message_handler(commands=['userslist'], state='*')
 async def users_list_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()  # Сброс состояния
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute("SELECT user_id, name, phone, reg_date FROM users WHERE status='approved'")
-    rows = c.fetchall()
-    conn.close()
+    rows = await db_async.get_users_by_status('approved')
     if not rows:
         await msg.answer('Hali birorta ham tasdiqlangan foydalanuvchi yo\'q.')
         return
@@ -1632,30 +1487,26 @@ async def users_list_cmd(msg: types.Message, state: FSMContext):
 
 @dp.message_handler(commands=['block_user'], state='*')
 async def block_user_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()  # Сброс состояния
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute("SELECT user_id, name FROM users WHERE status='approved'")
-    rows = c.fetchall()
-    conn.close()
+    rows = await db_async.get_users_by_status('approved')
     if not rows:
         await msg.answer('Hali birorta ham tasdiqlangan foydalanuvchi yo\'q.')
         return
     kb = InlineKeyboardMarkup(row_width=1)
-    for user_id, name in rows:
+    for user_id, name, phone, reg_date in rows:
         kb.add(InlineKeyboardButton(f'🚫 {name} ({user_id})', callback_data=f'blockuser_{user_id}'))
     await msg.answer('Bloklash uchun foydalanuvchini tanlang:', reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('blockuser_'))
+@router.route('blockuser_')
 async def block_user_cb(call: types.CallbackQuery):
-    if not is_admin(call.from_user.id):
+    if not await db_async.is_admin(call.from_user.id):
         await call.answer('Faqat admin uchun!', show_alert=True)
         return
     user_id = int(call.data[len('blockuser_'):])
-    update_user_status(user_id, 'denied')
+    await db_async.update_user_status(user_id, 'denied')
     try:
         await bot.send_message(user_id, '❌ Sizga botdan foydalanishga ruxsat berilmagan. (Admin tomonidan bloklandi)')
     except Exception:
@@ -1665,30 +1516,26 @@ async def block_user_cb(call: types.CallbackQuery):
 
 @dp.message_handler(commands=['approve_user'], state='*')
 async def approve_user_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()  # Сброс состояния
-    conn = get_db_conn()
-    c = conn.cursor()
-    c.execute("SELECT user_id, name FROM users WHERE status='denied'")
-    rows = c.fetchall()
-    conn.close()
+    rows = await db_async.get_users_by_status('denied')
     if not rows:
         await msg.answer('Hali birorta ham bloklangan foydalanuvchi yo\'q.')
         return
     kb = InlineKeyboardMarkup(row_width=1)
-    for user_id, name in rows:
+    for user_id, name, phone, reg_date in rows:
         kb.add(InlineKeyboardButton(f'✅ {name} ({user_id})', callback_data=f'approveuser_{user_id}'))
     await msg.answer('Qayta tasdiqlash uchun foydalanuvchini tanlang:', reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('approveuser_'))
+@router.route('approveuser_')
 async def approve_user_cb(call: types.CallbackQuery):
-    if not is_admin(call.from_user.id):
+    if not await db_async.is_admin(call.from_user.id):
         await call.answer('Faqat admin uchun!', show_alert=True)
         return
     user_id = int(call.data[len('approveuser_'):])
-    update_user_status(user_id, 'approved')
+    await db_async.update_user_status(user_id, 'approved')
     try:
         await bot.send_message(user_id, '✅ Sizga botdan foydalanishga yana ruxsat berildi! /start')
     except Exception:
@@ -1699,7 +1546,7 @@ async def approve_user_cb(call: types.CallbackQuery):
 # --- Команды для управления админами ---
 @dp.message_handler(commands=['add_admin'], state='*')
 async def add_admin_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()
@@ -1708,7 +1555,7 @@ async def add_admin_cmd(msg: types.Message, state: FSMContext):
 
 @dp.message_handler(state='add_admin_id', content_types=types.ContentTypes.TEXT)
 async def add_admin_id_save(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     
@@ -1720,7 +1567,7 @@ async def add_admin_id_save(msg: types.Message, state: FSMContext):
             return
         
         # Проверяем, не является ли уже админом
-        if is_admin(user_id):
+        if await db_async.is_admin(user_id):
             await msg.answer('❌ Bu foydalanuvchi allaqachon admin!')
             await state.finish()
             return
@@ -1736,7 +1583,7 @@ async def add_admin_id_save(msg: types.Message, state: FSMContext):
 
 @dp.message_handler(state='add_admin_name', content_types=types.ContentTypes.TEXT)
 async def add_admin_name_save(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     
@@ -1744,7 +1591,7 @@ async def add_admin_name_save(msg: types.Message, state: FSMContext):
     user_id = data.get('admin_id')
     admin_name = msg.text.strip()
     
-    if add_admin(user_id, admin_name, msg.from_user.id):
+    if await db_async.add_admin(user_id, admin_name, msg.from_user.id):
         await msg.answer(f"✅ Yangi admin qo'shildi:\nID: <code>{user_id}</code>\nIsmi: <b>{admin_name}</b>")
         try:
             await bot.send_message(user_id, f'🎉 Sizga admin huquqlari berildi! Botda barcha admin funksiyalaridan foydalanishingiz mumkin.')
@@ -1757,12 +1604,12 @@ async def add_admin_name_save(msg: types.Message, state: FSMContext):
 
 @dp.message_handler(commands=['remove_admin'], state='*')
 async def remove_admin_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()
     
-    admins = get_all_admins()
+    admins = await db_async.get_all_admins()
     if not admins:
         await msg.answer("Hali birorta ham admin yo'q.")
 
@@ -1774,9 +1621,9 @@ async def remove_admin_cmd(msg: types.Message, state: FSMContext):
     
     await msg.answer("O'chirish uchun adminni tanlang:", reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('removeadmin_'))
+@router.route('removeadmin_')
 async def remove_admin_cb(call: types.CallbackQuery):
-    if not is_admin(call.from_user.id):
+    if not await db_async.is_admin(call.from_user.id):
         await call.answer('Faqat admin uchun!', show_alert=True)
         return
     
@@ -1787,7 +1634,7 @@ async def remove_admin_cb(call: types.CallbackQuery):
         await call.answer("❌ O'zingizni o'chira olmaysiz!", show_alert=True)
         return
     
-    if remove_admin(user_id):
+    if await db_async.remove_admin(user_id):
         await call.message.edit_text(f"✅ Admin o'chirildi: {user_id}")
         try:
             await bot.send_message(user_id, '❌ Sizning admin huquqlaringiz olib tashlandi.')
@@ -1800,12 +1647,12 @@ async def remove_admin_cb(call: types.CallbackQuery):
 
 @dp.message_handler(commands=['admins_list'], state='*')
 async def admins_list_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     await state.finish()
     
-    admins = get_all_admins()
+    admins = await db_async.get_all_admins()
     if not admins:
         await msg.answer("Hali birorta ham admin yo'q.")
         return
@@ -1818,11 +1665,11 @@ async def admins_list_cmd(msg: types.Message, state: FSMContext):
 
 @dp.message_handler(commands=['check_admins'], state='*')
 async def check_admins_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     
-    admins = get_all_admins()
+    admins = await db_async.get_all_admins()
     if admins:
         admin_list = "📋 <b>Ro'yxatdagi adminlar:</b>\n\n"
         for i, (admin_id, name, added_date) in enumerate(admins, 1):
@@ -1834,216 +1681,632 @@ async def check_admins_cmd(msg: types.Message, state: FSMContext):
 
 @dp.message_handler(commands=['pending_approvals'], state='*')
 async def pending_approvals_cmd(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user.id):
+    if not await db_async.is_admin(msg.from_user.id):
         await msg.answer('Faqat admin uchun!')
         return
     
-    pending_list = get_all_pending_approvals()
-    if pending_list:
-        response = "📋 <b>Kutilayotgan tasdiqlashlar:</b>\n\n"
-        for i, approval in enumerate(pending_list, 1):
-            data = approval['data']
-            user_name = get_user_name(approval['user_id']) or f"User {approval['user_id']}"
-            response += f"{i}. <b>{user_name}</b> (ID: {approval['user_id']})\n"
-            response += f"   Tur: {data.get('type', 'N/A')}\n"
-            response += f"   Summa: {data.get('amount', 'N/A')} {data.get('currency_type', '')}\n"
-            response += f"   Vaqt: {approval['created_at']}\n"
-            response += f"   Key: {approval['approval_key']}\n\n"
-        await msg.answer(response)
-    else:
-        await msg.answer("✅ Kutilayotgan tasdiqlashlar yo'q.")
+    text, kb = await pending_approvals_page()
+    await msg.answer(text, reply_markup=kb)
+
+@router.route('pending_page_', state='*')
+async def pending_approvals_page_cb(call: types.CallbackQuery, state: FSMContext):
+    await safe_answer_callback(call)
+    if not await db_async.is_admin(call.from_user.id):
+        return
+    _, _, created_at, approval_id = call.data.split('_')
+    after = (datetime.strptime(created_at, PENDING_CURSOR_FORMAT), int(approval_id))
+    text, kb = await pending_approvals_page(after)
+    await call.message.edit_text(text, reply_markup=kb)
+
+# Список заявок выводится страницами: ключ следующей страницы — (created_at, id)
+# последней показанной заявки, он передаётся в callback_data кнопки «Keyingi»
+PENDING_PAGE_SIZE = env.int('PENDING_PAGE_SIZE', 20)
+PENDING_CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+# Запас до лимита Telegram в 4096 символов на сообщение
+PENDING_PAGE_MAX_CHARS = 3500
+
+def format_pending_approval(approval):
+    user_name = approval['user_name'] or f"User {approval['user_id']}"
+    created_at = approval['created_at'].strftime('%Y-%m-%d %H:%M:%S') if approval['created_at'] else 'N/A'
+    return (f"<b>{user_name}</b> (ID: {approval['user_id']})\n"
+            f"   Tur: {approval['type'] or 'N/A'}\n"
+            f"   Summa: {approval['amount'] or 'N/A'} {approval['currency_type'] or ''}\n"
+            f"   Vaqt: {created_at}\n"
+            f"   Key: {approval['approval_key']}\n\n")
+
+async def pending_approvals_page(after=None):
+    """Текст страницы списка заявок и кнопка следующей страницы (или None)"""
+    approvals = await db_async.get_pending_approvals_page(PENDING_PAGE_SIZE + 1, after)
+    if not approvals:
+        if after is None:
+            return "✅ Kutilayotgan tasdiqlashlar yo'q.", None
+        return "✅ Boshqa kutilayotgan tasdiqlashlar yo'q.", None
+    
+    response = "📋 <b>Kutilayotgan tasdiqlashlar:</b>\n\n"
+    shown = []
+    for approval in approvals[:PENDING_PAGE_SIZE]:
+        entry = format_pending_approval(approval)
+        if shown and len(response) + len(entry) > PENDING_PAGE_MAX_CHARS:
+            break
+        response += entry
+        shown.append(approval)
+    
+    kb = None
+    if len(shown) < len(approvals):
+        last = shown[-1]
+        cursor = f"{last['created_at'].strftime(PENDING_CURSOR_FORMAT)}_{last['id']}"
+        kb = InlineKeyboardMarkup().add(InlineKeyboardButton('➡️ Keyingi', callback_data=f'pending_page_{cursor}'))
+    return response, kb
 
 async def set_user_commands(dp):
     commands = [
         types.BotCommand("start", "Botni boshlash"),
         types.BotCommand("reboot", "Qayta boshlash - FSM ni to'xtatish"),
+        types.BotCommand("balans", "Joriy balans"),
         # Здесь можно добавить другие публичные команды
     ]
     await dp.bot.set_my_commands(commands)
 
-async def notify_all_users(bot):
-    """Отправляет уведомления всем одобренным пользователям"""
-    try:
-        conn = get_db_conn()
-        c = conn.cursor()
-        c.execute("SELECT user_id FROM users WHERE status='approved'")
-        rows = c.fetchall()
-        conn.close()
-        
-        total_users = len(rows)
-        successful_sends = 0
-        failed_sends = 0
-        
-        logger.info(f"📤 Отправка уведомлений {total_users} пользователям...")
-        
-        for (user_id,) in rows:
-            try:
-                await bot.send_message(user_id, "Iltimos, /start ni bosing va botdan foydalanishni davom eting!")
-                successful_sends += 1
-                # Небольшая задержка между отправками для избежания спама
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                failed_sends += 1
-                error_msg = str(e)
-                if "bot was blocked" in error_msg.lower() or "user is deactivated" in error_msg.lower():
-                    logger.warning(f"⚠️ Пользователь {user_id} заблокировал бота или деактивирован")
-                elif "chat not found" in error_msg.lower():
-                    logger.warning(f"⚠️ Чат с пользователем {user_id} не найден")
-                else:
-                    logger.warning(f"⚠️ Не удалось отправить сообщение пользователю {user_id}: {e}")
-        
-        logger.info(f"✅ Уведомления отправлены: {successful_sends}/{total_users} успешно, {failed_sends} неудачно")
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка при отправке уведомлений: {e}")
-        raise
+NOTIFY_USERS_ON_STARTUP = env.bool('NOTIFY_USERS_ON_STARTUP', False)
 
-# --- Функции для работы с данными одобрения в базе данных ---
-def save_pending_approval(approval_key, user_id, data):
-    import json
-    conn = get_db_conn()
-    c = conn.cursor()
-    try:
-        json_data = json.dumps(data)
-        logging.info(f"Сохраняем данные в БД. Ключ: {approval_key}, JSON: {json_data[:100]}...")
-        c.execute('INSERT INTO pending_approvals (approval_key, user_id, data) VALUES (%s, %s, %s) ON CONFLICT (approval_key) DO NOTHING',
-                  (approval_key, user_id, json_data))
-        conn.commit()
-        logging.info(f"Данные успешно сохранены в БД для ключа: {approval_key}")
-        return True
-    except Exception as e:
-        logging.error(f"Ошибка сохранения данных одобрения: {e}")
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+STARTUP_BROADCAST_TEXT = "Iltimos, /start ni bosing va botdan foydalanishni davom eting!"
 
-def get_pending_approval(approval_key):
-    import json
-    conn = get_db_conn()
-    c = conn.cursor()
-    try:
-        c.execute('SELECT data FROM pending_approvals WHERE approval_key = %s', (approval_key,))
-        row = c.fetchone()
-        if row:
-            data = row[0]
-            logging.info(f"Получены данные из БД для ключа {approval_key}. Тип: {type(data)}")
-            
-            # Если данные уже словарь, возвращаем как есть
-            if isinstance(data, dict):
-                logging.info(f"Данные уже в формате словаря: {data}")
-                return data
-            # Если это строка JSON, парсим её
-            elif isinstance(data, str):
-                logging.info(f"Парсим JSON строку: {data[:100]}...")
-                return json.loads(data)
-            else:
-                logging.error(f"Неожиданный тип данных: {type(data)}, значение: {data}")
-                return None
-        else:
-            logging.info(f"Данные не найдены в БД для ключа: {approval_key}")
+async def notify_all_users():
+    """
+    Ставит в очередь рассылку всем одобренным пользователям с просьбой
+    нажать /start. Рассылку отправляет broadcast_engine в фоне; если
+    прошлая такая рассылка не закончилась, она продолжится, а новая не создаётся.
+    """
+    if await db_async.has_running_broadcast('startup'):
+        logger.info("📤 Рассылка после запуска уже в очереди, продолжаем её")
         return None
-    except Exception as e:
-        logging.error(f"Ошибка получения данных одобрения: {e}")
-        return None
-    finally:
-        conn.close()
+    return await broadcast_engine.create(STARTUP_BROADCAST_TEXT, kind='startup')
+
+BROADCAST_STATUS_NAMES = {'running': '⏳ идёт', 'done': '✅ завершена', 'cancelled': '⏹ отменена'}
+
+@dp.message_handler(commands=['broadcast'], state='*')
+async def broadcast_cmd(msg: types.Message, state: FSMContext):
+    """/broadcast <текст> — рассылка всем одобренным пользователям"""
+    if not await db_async.is_admin(msg.from_user.id):
+        await msg.answer('Faqat admin uchun!')
+        return
+    parts = msg.html_text.split(maxsplit=1)
+    if len(parts) < 2:
+        await msg.answer('Использование: /broadcast <текст сообщения>')
+        return
+    broadcast_id = await broadcast_engine.create(parts[1], created_by=msg.from_user.id)
+    await msg.answer(f"📤 Рассылка #{broadcast_id} запущена. Статус: /broadcast_status, "
+                     f"отмена: /broadcast_cancel {broadcast_id}")
 
-def delete_pending_approval(approval_key):
-    conn = get_db_conn()
-    c = conn.cursor()
+@dp.message_handler(commands=['broadcast_status'], state='*')
+async def broadcast_status_cmd(msg: types.Message, state: FSMContext):
+    if not await db_async.is_admin(msg.from_user.id):
+        await msg.answer('Faqat admin uchun!')
+        return
+    broadcasts = await db_async.get_recent_broadcasts(5)
+    if not broadcasts:
+        await msg.answer('Рассылок ещё не было.')
+        return
+    lines = ["📤 <b>Последние рассылки:</b>"]
+    for item in broadcasts:
+        status = BROADCAST_STATUS_NAMES.get(item['status'], item['status'])
+        lines.append(f"#{item['id']} ({item['kind']}) {status}: отправлено {item['sent']}, "
+                     f"неудачно {item['failed']}, создана {item['created_at']:%d.%m.%Y %H:%M}")
+    await msg.answer('\n'.join(lines))
+
+@dp.message_handler(commands=['broadcast_cancel'], state='*')
+async def broadcast_cancel_cmd(msg: types.Message, state: FSMContext):
+    if not await db_async.is_admin(msg.from_user.id):
+        await msg.answer('Faqat admin uchun!')
+        return
+    args = msg.get_args().strip()
+    if not args.isdigit():
+        await msg.answer('Использование: /broadcast_cancel <номер рассылки>')
+        return
+    if await broadcast_engine.cancel(int(args)):
+        await msg.answer(f"⏹ Рассылка #{args} отменена.")
+    else:
+        await msg.answer(f"❌ Рассылка #{args} не найдена или уже завершена.")
+
+# --- Локальный журнал операций и балансы ---
+def operation_delta(data):
+    """Изменение баланса от операции: Кирим увеличивает, Чиқим уменьшает"""
+    amount = data.get('amount', '')
+    # Так же, как в build_sheet_row: в таблицу пишется целая часть суммы
+    value = Decimal(int(float(amount))) if amount else Decimal(0)
+    return value if data.get('type') == 'Кирим' else -value
+
+def balance_currency(data):
+    return 'Доллар' if data.get('currency_type') == 'Доллар' else 'Сом'
+
+def sheet_balances():
+    """Балансы из формул E1 ($) и G1 (Сом); None, если прочитать не удалось"""
+    e1_value, g1_value = get_e1_g1_values()
     try:
-        c.execute('DELETE FROM pending_approvals WHERE approval_key = %s', (approval_key,))
-        conn.commit()
+        return {'Доллар': Decimal(str(e1_value)), 'Сом': Decimal(str(g1_value))}
+    except (InvalidOperation, ValueError):
+        logging.error(f"Не удалось разобрать E1/G1 как числа: {e1_value!r}, {g1_value!r}")
+        return None
+
+async def seed_balances_from_sheet():
+    """
+    При первом запуске берёт начальные балансы из E1/G1 с учётом ещё не
+    записанных операций. Возвращает True, если балансы уже инициализированы.
+    """
+    if await db_async.has_balances():
         return True
-    except Exception as e:
-        logging.error(f"Ошибка удаления данных одобрения: {e}")
-        conn.rollback()
+    values = await run_blocking(sheet_balances)
+    if values is None:
         return False
-    finally:
-        conn.close()
+    await db_async.seed_balances(values)
+    logging.info(f"Балансы инициализированы из Google Sheets: {values}")
+    return True
+
+BALANCE_SEED_RETRY_BASE = 30
+BALANCE_SEED_RETRY_MAX = 900
+
+async def balance_seed_worker():
+    """
+    Фоновая задача: повторяет инициализацию балансов, пока E1/G1 не прочитаются.
+    До этого операции копятся в журнале без баланса и войдут в него при инициализации.
+    """
+    delay = BALANCE_SEED_RETRY_BASE
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            if await seed_balances_from_sheet():
+                return
+        except Exception as e:
+            logging.error(f"Не удалось инициализировать балансы: {e}")
+        delay = min(delay * 2, BALANCE_SEED_RETRY_MAX)
+        logging.warning(f"Балансы ещё не инициализированы, повтор через {delay} с")
+
+# Расхождения, замеченные при прошлой проверке: исправляем только повторившиеся
+ledger_drift = {}
+
+async def check_ledger_against_sheet(resync=False):
+    """
+    Сверяет балансы журнала с E1/G1 (с поправкой на ещё не записанные операции).
+    Возвращает словарь расхождений {валюта: (в БД, ожидается по таблице)}.
+    """
+    global ledger_drift
+    values = await run_blocking(sheet_balances)
+    if values is None:
+        return {}
+    balances, pending = await db_async.ledger_state()
+    if not balances:
+        # Балансы ещё не инициализированы — сравнивать не с чем
+        return {}
+    drift = {}
+    for currency, sheet_value in values.items():
+        expected = sheet_value + pending.get(currency, 0)
+        db_value = balances.get(currency, Decimal(0))
+        if db_value != expected:
+            drift[currency] = (db_value, expected)
+    for currency, (db_value, expected) in drift.items():
+        logging.warning(f"Баланс {currency}: в журнале {db_value}, по таблице {expected}")
+        # Запись между чтением таблицы и БД даёт ложное расхождение, поэтому
+        # исправляем только то, что повторилось при двух проверках подряд
+        if resync and ledger_drift.get(currency) == (db_value, expected):
+            await db_async.adjust_balance(currency, expected - db_value)
+            logging.warning(f"Баланс {currency} исправлен по таблице: {expected}")
+    ledger_drift = drift
+    return drift
+
+LEDGER_CHECK_INTERVAL = env.int('LEDGER_CHECK_INTERVAL', 3600)
+LEDGER_CHECK_RESYNC = env.bool('LEDGER_CHECK_RESYNC', False)
+
+async def ledger_check_worker():
+    """Фоновая задача: периодически сверяет балансы журнала с E1/G1"""
+    while True:
+        await asyncio.sleep(LEDGER_CHECK_INTERVAL)
+        try:
+            await check_ledger_against_sheet(LEDGER_CHECK_RESYNC)
+        except Exception as e:
+            logging.error(f"Ошибка сверки балансов с Google Sheets: {e}")
+
+# --- Сверка листа КиримЧиким с журналом записанных операций ---
+RECONCILE_INTERVAL = env.int('RECONCILE_INTERVAL', 86400)
+RECONCILE_CHUNK_ROWS = env.int('RECONCILE_CHUNK_ROWS', 500)
+RECONCILE_REPAIR = env.bool('RECONCILE_REPAIR', False)
+# Сколько расхождений перечислять в отчёте; остальные только считаются
+RECONCILE_REPORT_LIMIT = 20
+
+def classify_row(expected, actual):
+    """
+    missing — строка пуста; partial — заполнена часть ячеек, остальные совпадают
+    (обрыв записи); changed — значения отличаются (ручная правка или сдвиг строк).
+    """
+    expected_cells = normalize_row(expected)
+    actual_cells = normalize_row(actual)
+    if not any(actual_cells):
+        return 'missing'
+    if all(a == '' or a == e for e, a in zip(expected_cells, actual_cells)):
+        return 'partial'
+    return 'changed'
+
+async def reconcile_sheet(repair=False, chunk_rows=None):
+    """
+    Сверяет строки, записанные ботом, с листом КиримЧиким. Лист читается
+    диапазонами по chunk_rows строк, поэтому память не растёт вместе с листом.
+    При repair пустые и недописанные строки записываются заново; изменённые
+    строки только попадают в отчёт, чтобы не затереть ручные правки.
+
+    Строки, которых нет в журнале, но чей хэш совпадает с записанной в другую
+    строку операцией, — повторы (outbox доставляет «хотя бы один раз»). При
+    repair они очищаются, а не удаляются, чтобы номера строк не сдвинулись.
+    """
+    chunk_rows = chunk_rows or RECONCILE_CHUNK_ROWS
+    report = {'checked': 0, 'ok': 0, 'missing': 0, 'partial': 0, 'changed': 0, 'duplicate': 0,
+              'repaired': 0, 'mismatches': []}
+    bounds = await db_async.written_rows_range()
+    if bounds is None:
+        return report
+    worksheet = await run_blocking(sheets_session.run, lambda: sheets_session.worksheet(SHEET_NAME))
+    chunks = iter_sheet_chunks(worksheet, bounds[0], bounds[1], chunk_rows)
+    while True:
+        # Каждый диапазон читается в пуле потоков, пока журнал ждёт в цикле событий
+        chunk = await run_blocking(next, chunks, None)
+        if chunk is None:
+            break
+        start, rows = chunk
+        written = await db_async.get_written_rows(start, start + len(rows) - 1)
+        repairs = []
+        for row_number, (transaction_id, expected, expected_hash) in written.items():
+            actual = rows[row_number - start]
+            report['checked'] += 1
+            if row_hash(actual) == expected_hash:
+                report['ok'] += 1
+                continue
+            kind = classify_row(expected, actual)
+            report[kind] += 1
+            if len(report['mismatches']) < RECONCILE_REPORT_LIMIT:
+                report['mismatches'].append((row_number, transaction_id, kind))
+            if repair and kind in ('missing', 'partial'):
+                repairs.extend(row_ranges(row_number, expected))
+        unknown = {row_number: row_hash(row) for row_number, row in enumerate(rows, start)
+                   if row_number not in written and any(normalize_row(row))}
+        if unknown:
+            known = await db_async.find_written_hashes(list(set(unknown.values())))
+            for row_number, actual_hash in unknown.items():
+                if actual_hash not in known:
+                    continue
+                transaction_id, original_row = known[actual_hash]
+                report['duplicate'] += 1
+                if len(report['mismatches']) < RECONCILE_REPORT_LIMIT:
+                    report['mismatches'].append((row_number, transaction_id, f'duplicate of {original_row}'))
+                if repair:
+                    repairs.extend(row_ranges(row_number, [''] * ROW_WIDTH))
+        if repairs:
+            # Дескриптор листа берётся внутри run: после ошибки сессии run пересоздаёт
+            # клиента, и повтор должен идти через новый дескриптор, а не через worksheet
+            await run_blocking(sheets_session.run, lambda: sheets_session.worksheet(SHEET_NAME).batch_update(repairs))
+            report['repaired'] += len(repairs) // 2
+            logging.warning(f"Сверка: строки {start}-{start + len(rows) - 1} дописаны заново ({len(repairs) // 2})")
+    logging.info(f"Сверка листа {SHEET_NAME}: {format_reconcile_report(report)}")
+    return report
+
+def format_reconcile_report(report):
+    text = (f"проверено {report['checked']}, совпадает {report['ok']}, пустых {report['missing']}, "
+            f"недописанных {report['partial']}, изменённых {report['changed']}, повторов {report['duplicate']}, "
+            f"исправлено {report['repaired']}")
+    for row_number, transaction_id, kind in report['mismatches']:
+        text += f"\nстрока {row_number} (операция #{transaction_id}): {kind}"
+    return text
+
+async def reconcile_worker():
+    """Фоновая задача: периодически сверяет лист с журналом и сообщает админам о расхождениях"""
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL)
+        try:
+            report = await reconcile_sheet(RECONCILE_REPAIR)
+            if report['checked'] != report['ok'] or report['duplicate']:
+                await notify_admins(f"⚠️ Сверка Google Sheets с журналом:\n{format_reconcile_report(report)}")
+        except Exception as e:
+            logging.error(f"Ошибка сверки листа с журналом: {e}")
+
+# --- Просроченные заявки на одобрение ---
+APPROVAL_EXPIRE_AFTER = env.int('APPROVAL_EXPIRE_AFTER', 259200)
+APPROVAL_SWEEP_INTERVAL = env.int('APPROVAL_SWEEP_INTERVAL', 3600)
+APPROVAL_SWEEP_BATCH = env.int('APPROVAL_SWEEP_BATCH', 100)
+
+async def expire_pending_approvals():
+    """Удаляет заявки старше APPROVAL_EXPIRE_AFTER партиями и сообщает отправителям; возвращает их число"""
+    expired_total = 0
+    while True:
+        expired = await db_async.expire_pending_approvals(APPROVAL_EXPIRE_AFTER, APPROVAL_SWEEP_BATCH)
+        for approval in expired:
+            try:
+                await bot.send_message(
+                    approval['user_id'],
+                    f"⌛ Arizangiz muddati o'tdi va bekor qilindi. Iltimos, ma'lumotni qaytadan kiriting.\n\n"
+                    f"{format_summary(approval['data'])}"
+                )
+            except Exception as e:
+                logging.warning(f"Не удалось сообщить пользователю {approval['user_id']} о просроченной заявке: {e}")
+        expired_total += len(expired)
+        if len(expired) < APPROVAL_SWEEP_BATCH:
+            return expired_total
+
+async def approval_sweeper_worker():
+    """Фоновая задача: периодически удаляет заявки, которые админы так и не рассмотрели"""
+    while True:
+        try:
+            expired = await expire_pending_approvals()
+            if expired:
+                logging.info(f"Удалено просроченных заявок на одобрение: {expired}")
+        except Exception as e:
+            logging.error(f"Ошибка удаления просроченных заявок: {e}")
+        await asyncio.sleep(APPROVAL_SWEEP_INTERVAL)
+
+# --- Фоновая запись outbox в Google Sheets ---
+OUTBOX_BATCH_SIZE = env.int('OUTBOX_BATCH_SIZE', 50)
+OUTBOX_POLL_INTERVAL = env.float('OUTBOX_POLL_INTERVAL', 5)
+OUTBOX_LEASE_SECONDS = env.int('OUTBOX_LEASE_SECONDS', 120)
+OUTBOX_RETRY_BASE = env.float('OUTBOX_RETRY_BASE', 5)
+OUTBOX_RETRY_MAX = env.float('OUTBOX_RETRY_MAX', 900)
+
+# Будит обработчик сразу после новой записи, не дожидаясь OUTBOX_POLL_INTERVAL
+outbox_wakeup = asyncio.Event()
+
+# Ключ advisory-блокировки PostgreSQL, под которой пишет в лист один процесс
+SHEET_WRITER_LOCK = 7_340_001
+
+# Уведомления админам отправляются параллельно; обработчики не ждут доставки.
+# Через тот же отправитель идут рассылки, так что общий предел частоты один
+message_sender = MessageSender(
+    bot,
+    concurrency=env.int('NOTIFY_CONCURRENCY', 8),
+    max_retries=env.int('NOTIFY_MAX_RETRIES', 3),
+    rate=env.float('TELEGRAM_RATE_LIMIT', 30)
+)
+admin_notifier = AdminNotifier(message_sender, db_async)
+broadcast_engine = BroadcastEngine(
+    db_async,
+    message_sender,
+    batch_size=env.int('BROADCAST_BATCH', 30),
+    lease_seconds=env.int('BROADCAST_LEASE_SECONDS', 120)
+)
 
-def get_all_pending_approvals():
-    import json
-    conn = get_db_conn()
-    c = conn.cursor()
+async def notify_admins(text, **kwargs):
+    """Отправляет сообщение всем админам; True, если хотя бы одному доставлено"""
+    return await admin_notifier.notify(text, **kwargs)
+
+async def send_approval_request(user_id, text, kb):
+    """Рассылает заявку на одобрение админам; если никому не доставлена — предупреждает пользователя"""
+    if not await admin_notifier.notify(text, reply_markup=kb):
+        await message_sender.send(
+            user_id, '⚠️ Xatolik: tasdiqlashga yuborish amalga oshmadi. Iltimos, administrator bilan bog\'laning.'
+        )
+
+def format_balance(currency_type, balance):
+    """Текст баланса по валюте операции; None — балансы ещё не взяты из таблицы"""
+    if balance is None:
+        value = 'hali hisoblanmagan'
+    else:
+        value = int(balance) if balance == int(balance) else balance
+    if currency_type == 'Доллар':
+        return f"💰 Balans: dollarda {value}"
+    return f"💰 Balans: somda {value}"
+
+async def send_balance_message(user_id, data, balance_text):
+    """Отправляет пользователю баланс, если такое же сообщение не ушло только что"""
+    is_duplicate = is_balance_message_duplicate(
+        user_id,
+        data.get('type', ''),
+        data.get('amount', ''),
+        data.get('currency_type', ''),
+        datetime.now()
+    )
+    if is_duplicate:
+        logging.info(f"Сообщение о балансе для пользователя {user_id} пропущено как дубликат")
+        return
     try:
-        c.execute('SELECT approval_key, user_id, data, created_at FROM pending_approvals ORDER BY created_at DESC')
-        rows = c.fetchall()
-        result = []
-        for row in rows:
-            data = row[2]
-            # Если данные уже словарь, используем как есть
-            if isinstance(data, dict):
-                parsed_data = data
-            # Если это строка JSON, парсим её
-            elif isinstance(data, str):
-                parsed_data = json.loads(data)
-            else:
-                logging.error(f"Неожиданный тип данных: {type(data)}")
-                continue
-                
-            result.append({
-                'approval_key': row[0],
-                'user_id': row[1],
-                'data': parsed_data,
-                'created_at': row[3]
-            })
-        return result
+        logging.info(f"Отправляем баланс пользователю {user_id}: {balance_text}")
+        await bot.send_message(user_id, balance_text)
     except Exception as e:
-        logging.error(f"Ошибка получения всех данных одобрения: {e}")
-        return []
-    finally:
-        conn.close()
+        logging.error(f"Balansni yuborishda xatolik: {e}")
 
-def check_approval_status(approval_key):
-    """Проверяет, существует ли заявка в базе данных"""
-    conn = get_db_conn()
-    c = conn.cursor()
+async def write_outbox_entry(entry):
+    """Записывает одну запись outbox; все записи партии уходят в Google Sheets одним запросом"""
+    entry_id = entry['id']
+    data = entry['data']
+    attempts = entry['attempts'] + 1
     try:
-        c.execute('SELECT COUNT(*) FROM pending_approvals WHERE approval_key = %s', (approval_key,))
-        count = c.fetchone()[0]
-        return count > 0
+        user_name = await db_async.get_user_name(data.get('user_id'))
     except Exception as e:
-        logging.error(f"Ошибка проверки статуса заявки: {e}")
-        return False
-    finally:
-        conn.close()
+        # Ошибка БД, а не Google Sheets: запись не трогаем, её снова возьмут после аренды
+        logging.warning(f"Outbox #{entry_id}: не удалось получить имя пользователя ({e}), повтор после аренды")
+        return
+    try:
+        row = build_sheet_row(data, user_name)
+        row_number = await sheet_writer.submit(row)
+    except Exception as e:
+        if is_retryable_error(e):
+            delay = min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+            delay *= random.uniform(0.8, 1.2)
+            logging.warning(f"Outbox #{entry_id}: попытка {attempts} не удалась ({e}), повтор через {delay:.0f} с")
+            await db_async.retry_outbox_entry(entry_id, attempts, delay, str(e))
+        else:
+            logging.error(f"Outbox #{entry_id}: запись невозможна: {e}")
+            await db_async.fail_outbox_entry(entry_id, attempts, str(e))
+            await notify_admins(
+                f"⚠️ <b>Google Sheets-ga yozib bo'lmadi</b> (outbox #{entry_id}):\n<code>{e}</code>\n\n{format_summary(data)}"
+                f"\n\nQayta yuborish: /outbox_retry"
+            )
+        return
+    
+    await complete_written_entry(entry_id, row_number, row)
+    logging.info(f"Outbox #{entry_id}: записано в строку {row_number}")
+
+async def complete_written_entry(entry_id, row_number, row):
+    """
+    Отмечает запись outbox выполненной, повторяя до успеха: строка уже в листе,
+    и если запись останется в outbox, после аренды её запишут второй раз.
+    UPDATE и DELETE по id можно повторять сколько угодно. Доставка всё равно
+    «хотя бы один раз» (бот могут остановить между записью и отметкой) —
+    такие повторы находит и очищает /reconcile по хэшу строки.
+    """
+    delay = OUTBOX_RETRY_BASE
+    while True:
+        try:
+            await db_async.complete_outbox_entry(entry_id, row_number, row, row_hash(row))
+            return
+        except Exception as e:
+            logging.error(f"Outbox #{entry_id}: строка {row_number} записана, но не отмечена в БД ({e}), "
+                          f"повтор через {delay:.0f} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, OUTBOX_RETRY_MAX)
+
+async def write_outbox_batch(entries):
+    """
+    Пишет партию outbox. В режимах cursor и scan свободные строки ищутся
+    отдельным запросом до записи, поэтому процессы бота пишут по очереди
+    под общей блокировкой в БД; append атомарен сам по себе.
+    """
+    if sheet_writer.mode == 'append':
+        await asyncio.gather(*(write_outbox_entry(entry) for entry in entries))
+        return
+    async with db_async.advisory_lock(SHEET_WRITER_LOCK):
+        await asyncio.gather(*(write_outbox_entry(entry) for entry in entries))
+
+async def outbox_worker():
+    """Фоновая задача: переносит операции из outbox в Google Sheets"""
+    logging.info("Outbox: обработчик запущен")
+    failures = 0
+    while True:
+        try:
+            entries = await db_async.claim_outbox_batch(OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS)
+            failures = 0
+            if entries:
+                await write_outbox_batch(entries)
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # БД недоступна: повторяем с растущей задержкой, новые записи не будят обработчик
+            failures += 1
+            delay = min(OUTBOX_RETRY_BASE * 2 ** (failures - 1), OUTBOX_RETRY_MAX)
+            logging.error(f"Outbox: ошибка обработчика (подряд: {failures}), повтор через {delay:.0f} с: {e}")
+            await asyncio.sleep(delay)
+            continue
+        
+        # Ждём новой записи или следующего опроса (отложенные повторы, другие процессы)
+        try:
+            await asyncio.wait_for(outbox_wakeup.wait(), OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        outbox_wakeup.clear()
+
+# --- Асинхронный фасад: блокирующие вызовы Google Sheets выполняются в пуле потоков ---
+blocking.configure(env.int('BLOCKING_POOL_SIZE', 8))
+
+sheets_async = AsyncFacade(get_sheet_names, get_e1_g1_values)
+
+# Способ получения апдейтов: polling (long-poll getUpdates) или webhook
+BOT_MODE = env.str('BOT_MODE', 'polling')
+WEBHOOK_URL = env.str('WEBHOOK_URL', '')
+WEBHOOK_PATH = env.str('WEBHOOK_PATH', '/telegram/webhook')
+WEBHOOK_HOST = env.str('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = env.int('WEBHOOK_PORT', 8080)
+WEBHOOK_SECRET = env.str('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONCURRENCY = env.int('WEBHOOK_MAX_CONCURRENCY', 32)
+WEBHOOK_MAX_PENDING = env.int('WEBHOOK_MAX_PENDING', 1000)
 
 if __name__ == '__main__':
     from aiogram import executor
-    import asyncio
+
+    if BOT_MODE not in ('polling', 'webhook'):
+        raise ValueError(f"BOT_MODE должен быть polling или webhook, а не {BOT_MODE!r}")
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        raise ValueError("Для BOT_MODE=webhook нужен WEBHOOK_URL")
+    
+    # Фоновые задачи, запущенные на время работы бота
+    background_tasks = []
     
     async def on_startup(dp):
         logger.info("🚀 Бот запускается...")
+        await db_async.connect()
+        await init_db()
+        await dp.storage.restore()
+        dp.storage.start()
         try:
             await set_user_commands(dp)
             logger.info("✅ Команды бота установлены")
-            await notify_all_users(dp.bot)
-            logger.info("✅ Уведомления отправлены")
+            # Состояния FSM восстанавливаются из БД, так что напоминать всем
+            # нажать /start после перезапуска больше не обязательно
+            if NOTIFY_USERS_ON_STARTUP:
+                await notify_all_users()
         except Exception as e:
             logger.error(f"❌ Ошибка при запуске: {e}")
+        try:
+            await run_blocking(sheet_writer.prepare)
+            logger.info("✅ Позиция записи в Google Sheets определена")
+        except Exception as e:
+            # Курсор определится при первой записи
+            logger.error(f"❌ Не удалось определить позицию записи в Google Sheets: {e}")
+        try:
+            seeded = await seed_balances_from_sheet()
+        except Exception as e:
+            seeded = False
+            logger.error(f"❌ Не удалось инициализировать балансы: {e}")
+        if not seeded:
+            background_tasks.append(asyncio.create_task(balance_seed_worker()))
+        background_tasks.append(asyncio.create_task(outbox_worker()))
+        if LEDGER_CHECK_INTERVAL > 0:
+            background_tasks.append(asyncio.create_task(ledger_check_worker()))
+        if RECONCILE_INTERVAL > 0:
+            background_tasks.append(asyncio.create_task(reconcile_worker()))
+        if APPROVAL_EXPIRE_AFTER > 0 and APPROVAL_SWEEP_INTERVAL > 0:
+            background_tasks.append(asyncio.create_task(approval_sweeper_worker()))
+        # Рассылки (в том числе незаконченные до перезапуска) идут в фоне
+        broadcast_engine.start()
         logger.info("✅ Бот успешно запущен и готов к работе")
     
     async def on_shutdown(dp):
         logger.info("🛑 Бот останавливается...")
         try:
+            for task in background_tasks:
+                task.cancel()
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+            await broadcast_engine.close()
+            await sheet_writer.close()
+            logger.info("✅ Очередь записи в Google Sheets сброшена")
+            await admin_notifier.close()
             await dp.storage.close()
             await dp.storage.wait_closed()
             logger.info("✅ Хранилище закрыто")
+            await db_async.close()
+            blocking.shutdown()
         except Exception as e:
             logger.error(f"❌ Ошибка при остановке: {e}")
     
     try:
-        logger.info("🔄 Запуск бота...")
-        executor.start_polling(
-            dp, 
-            skip_updates=True, 
-            on_startup=on_startup,
-            on_shutdown=on_shutdown,
-            timeout=60,
-            relax=0.1
-        )
+        if BOT_MODE == 'webhook':
+            logger.info(f"🔄 Запуск бота (webhook, {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH})...")
+            scheduler = UpdateScheduler(dp, WEBHOOK_MAX_CONCURRENCY, WEBHOOK_MAX_PENDING)
+            run_webhook(
+                dp,
+                scheduler,
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                path=WEBHOOK_PATH,
+                host=WEBHOOK_HOST,
+                port=WEBHOOK_PORT,
+                secret=WEBHOOK_SECRET,
+                drop_pending_updates=True,
+                on_startup=on_startup,
+                on_shutdown=on_shutdown
+            )
+        else:
+            logger.info("🔄 Запуск бота (polling)...")
+            executor.start_polling(
+                dp, 
+                skip_updates=True, 
+                on_startup=on_startup,
+                on_shutdown=on_shutdown,
+                timeout=60,
+                relax=0.1
+            )
     except KeyboardInterrupt:
         logger.info("⏹️ Бот остановлен пользователем")
     except Exception as e:
@@ -0,0 +1,95 @@
+"""
+Рассылки всем пользователям в фоне.
+
+Рассылка — строка таблицы broadcasts: текст, аудитория (статус
+пользователей) и курсор last_user_id. Фоновая задача берёт незавершённую
+рассылку в аренду и отправляет её партиями по batch_size пользователей в
+порядке user_id через общий MessageSender, который держит предел Telegram
+на число сообщений в секунду и паузы после RetryAfter. После каждой
+партии курсор и счётчики сохраняются, поэтому после перезапуска рассылка
+продолжается с того же места: повторно могут прийти только сообщения
+последней незаписанной партии. Если процесс упал, аренду через
+lease_seconds перехватит следующий запуск.
+
+    engine = BroadcastEngine(db_async, message_sender)
+    engine.start()
+    broadcast_id = await engine.create("Ertaga bot ishlamaydi", created_by=admin_id)
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastEngine:
+    def __init__(self, repository, sender, batch_size=30, lease_seconds=120, poll_interval=60):
+        self.repository = repository
+        self.sender = sender
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def create(self, text, kind='announcement', created_by=None, audience='approved'):
+        """Создаёт рассылку и будит фоновую задачу; возвращает id рассылки"""
+        broadcast_id = await self.repository.create_broadcast(kind, text, created_by, audience)
+        logger.info(f"📤 Рассылка #{broadcast_id} ({kind}) поставлена в очередь")
+        self._wakeup.set()
+        return broadcast_id
+
+    async def cancel(self, broadcast_id):
+        """Отменяет рассылку; фоновая задача остановится после текущей партии"""
+        return await self.repository.cancel_broadcast(broadcast_id)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._worker())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _worker(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                broadcast = await self.repository.claim_broadcast(self.lease_seconds)
+                if broadcast is not None:
+                    await self._run(broadcast)
+                    continue
+            except Exception as e:
+                # Аренда истечёт, и рассылку подхватят снова
+                logger.error(f"❌ Ошибка рассылки: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, broadcast):
+        broadcast_id = broadcast['id']
+        cursor, sent, failed = broadcast['last_user_id'], broadcast['sent'], broadcast['failed']
+        if cursor:
+            logger.info(f"📤 Рассылка #{broadcast_id}: продолжаем после пользователя {cursor} "
+                        f"(отправлено {sent}, неудачно {failed})")
+        while True:
+            recipients = await self.repository.get_broadcast_recipients(broadcast['audience'], cursor, self.batch_size)
+            if not recipients:
+                break
+            results = await asyncio.gather(*(self.sender.send(user_id, broadcast['text']) for user_id in recipients))
+            batch_sent = sum(results)
+            cursor = recipients[-1]
+            sent += batch_sent
+            failed += len(results) - batch_sent
+            status = await self.repository.save_broadcast_progress(
+                broadcast_id, cursor, batch_sent, len(results) - batch_sent, self.lease_seconds)
+            if status != 'running':
+                logger.info(f"⏹ Рассылка #{broadcast_id} остановлена: {status}")
+                return
+        await self.repository.finish_broadcast(broadcast_id)
+        logger.info(f"✅ Рассылка #{broadcast_id} завершена: отправлено {sent}, неудачно {failed}")
+        if broadcast['created_by']:
+            await self.sender.send(broadcast['created_by'],
+                                   f"✅ Рассылка #{broadcast_id} завершена: отправлено {sent}, неудачно {failed}")
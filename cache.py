@@ -0,0 +1,49 @@
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Кэш значений по ключу со временем жизни ttl секунд.
+
+    Рассчитан на использование из цикла событий, без блокировок. Если
+    записей больше maxsize, вытесняются самые старые. Кэшировать можно и
+    None (например, «пользователь не зарегистрирован»), поэтому промах
+    обозначается MISSING.
+    """
+
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self._stats['hits'] += 1
+            return entry[0]
+        if entry is not None:
+            del self._data[key]
+        self._stats['misses'] += 1
+        return MISSING
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        if self._data.pop(key, None) is not None:
+            self._stats['invalidations'] += 1
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return dict(self._stats, size=len(self._data))
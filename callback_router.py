@@ -0,0 +1,121 @@
+import inspect
+
+from aiogram.dispatcher.filters.state import State
+from aiogram.dispatcher.handler import SkipHandler
+
+# Маршрут подходит к любому состоянию FSM
+ANY_STATE = '*'
+
+
+def normalize_states(state):
+    """'*' -> ANY_STATE, иначе множество имён состояний (None — «без состояния»)"""
+    if state == ANY_STATE:
+        return ANY_STATE
+    if not isinstance(state, (list, tuple, set, frozenset)):
+        state = [state]
+    return frozenset(item.state if isinstance(item, State) else item for item in state)
+
+
+class Route:
+    __slots__ = ('handler', 'states', 'pass_state')
+
+    def __init__(self, handler, states):
+        self.handler = handler
+        self.states = states
+        self.pass_state = 'state' in inspect.signature(handler).parameters
+
+    def accepts(self, current_state):
+        return self.states == ANY_STATE or current_state in self.states
+
+
+class CallbackRouter:
+    """
+    Маршрутизация callback_query по префиксу callback_data.
+
+    Вместо цепочки фильтров-лямбд, которые aiogram проверяет по очереди для
+    каждого нажатия, в диспетчере регистрируется один обработчик, а маршруты
+    лежат в префиксном дереве: поиск проходит по символам callback_data не
+    глубже самого длинного префикса. Из подходящих маршрутов выбирается самый
+    длинный префикс, поэтому 'approve_large_' не нужно исключать из
+    'approve_'. Маршруты с exact=True сравниваются со всей строкой через
+    словарь. Фильтр состояния работает как у aiogram: по умолчанию только
+    без состояния, '*' — в любом.
+
+        router = CallbackRouter()
+        router.setup(dp)
+
+        @router.route('type_', state=Form.type)
+        async def process_type(call, state): ...
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._root = {}
+        self._routes = 0
+
+    def route(self, prefix, state=None, exact=False):
+        def decorator(handler):
+            self.add(prefix, handler, state, exact)
+            return handler
+        return decorator
+
+    def add(self, prefix, handler, state=None, exact=False):
+        if not prefix:
+            raise ValueError("Нужен непустой префикс callback_data")
+        route = Route(handler, normalize_states(state))
+        if exact:
+            self._exact.setdefault(prefix, []).append(route)
+        else:
+            node = self._root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append(route)
+        self._routes += 1
+
+    def _matched(self, data):
+        """Списки маршрутов на пути data по дереву, от короткого префикса к длинному"""
+        matched = []
+        node = self._root
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                matched.append(node[None])
+        return matched
+
+    def resolve(self, data, current_state):
+        """Маршрут для callback_data в состоянии current_state или None"""
+        exact = self._exact.get(data)
+        if exact:
+            for route in exact:
+                if route.accepts(current_state):
+                    return route
+        matched = self._matched(data)
+        for routes in reversed(matched):
+            for route in routes:
+                if route.accepts(current_state):
+                    return route
+        return None
+
+    async def dispatch(self, call, state):
+        """Вызывает обработчик нажатия; False, если маршрута нет"""
+        current_state = await state.get_state()
+        route = self.resolve(call.data or '', current_state)
+        if route is None:
+            return False
+        if route.pass_state:
+            await route.handler(call, state=state)
+        else:
+            await route.handler(call)
+        return True
+
+    def setup(self, dp):
+        dp.register_callback_query_handler(self._handle, state=ANY_STATE)
+
+    async def _handle(self, call, state):
+        if not await self.dispatch(call, state):
+            raise SkipHandler()
+
+    def __len__(self):
+        return self._routes
@@ -0,0 +1,91 @@
+"""
+Компактные callback_data для кнопок справочников.
+
+В кнопку кладётся короткий префикс действия и id строки справочника:
+"o:12" вместо "object_<название объекта>". Telegram ограничивает
+callback_data 64 байтами, а кириллица занимает по два байта на символ,
+так что длинное название в кнопку могло не поместиться. Обратно id
+превращается в название по таблице id -> название из снимка справочников
+(Repository.get_reference_lists), префикс — в действие по словарю PREFIXES.
+"""
+
+MAX_CALLBACK_BYTES = 64
+SEPARATOR = ':'
+
+# Действие -> (префикс в callback_data, справочник)
+REFERENCE_ACTIONS = {
+    'object': ('o', 'object_names'),
+    'expense': ('e', 'expense_types'),
+    'category': ('c', 'categories'),
+    'pay': ('p', 'pay_types'),
+    'del_object': ('do', 'object_names'),
+    'del_expense': ('de', 'expense_types'),
+    'del_category': ('dc', 'categories'),
+    'edit_category': ('ec', 'categories'),
+    'del_tolov': ('dp', 'pay_types'),
+    'edit_tolov': ('ep', 'pay_types'),
+}
+
+# Префикс -> (действие, справочник)
+PREFIXES = {prefix: (action, table) for action, (prefix, table) in REFERENCE_ACTIONS.items()}
+
+
+def pack(prefix, *parts):
+    """Собирает callback_data "prefix:part:..."; ValueError, если не влезает в лимит Telegram"""
+    data = SEPARATOR.join([prefix, *map(str, parts)])
+    if len(data.encode()) > MAX_CALLBACK_BYTES:
+        raise ValueError(f"callback_data длиннее {MAX_CALLBACK_BYTES} байт: {data}")
+    return data
+
+
+def unpack(data):
+    """(префикс, [части]) из callback_data"""
+    prefix, *parts = data.split(SEPARATOR)
+    return prefix, parts
+
+
+def reference_callback(action, item_id):
+    """callback_data кнопки справочника, например reference_callback('object', 12) -> "o:12" """
+    prefix, _ = REFERENCE_ACTIONS[action]
+    return pack(prefix, item_id)
+
+
+def parse_reference_callback(data):
+    """(действие, справочник, id) из callback_data кнопки справочника; None, если это не она"""
+    prefix, parts = unpack(data)
+    entry = PREFIXES.get(prefix)
+    if entry is None or len(parts) != 1 or not parts[0].isdigit():
+        return None
+    action, table = entry
+    return action, table, int(parts[0])
+
+
+def reference_prefix(action):
+    """Начало callback_data кнопок справочника с действием action, например "o:" """
+    prefix, _ = REFERENCE_ACTIONS[action]
+    return prefix + SEPARATOR
+
+
+# Страницы клавиатур справочников: "pg:o:2" — третья страница объектов,
+# "pg:o:r" — страница недавно выбранных
+PAGE_PREFIX = 'pg'
+RECENT_PAGE = 'r'
+
+
+def page_callback(action, page):
+    prefix, _ = REFERENCE_ACTIONS[action]
+    return pack(PAGE_PREFIX, prefix, page)
+
+
+def parse_page_callback(data):
+    """(действие, справочник, страница) из callback_data кнопки листания; None, если это не она"""
+    prefix, parts = unpack(data)
+    if prefix != PAGE_PREFIX or len(parts) != 2 or parts[0] not in PREFIXES:
+        return None
+    action, table = PREFIXES[parts[0]]
+    page = parts[1]
+    if page == RECENT_PAGE:
+        return action, table, RECENT_PAGE
+    if not page.isdigit():
+        return None
+    return action, table, int(page)
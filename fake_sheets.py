@@ -0,0 +1,284 @@
+"""
+Поддельный бэкенд Google Sheets для бенчмарков и локального запуска.
+
+Хранит листы в памяти (или в JSON-файле) и повторяет поведение тех
+вызовов gspread, которыми пользуется бот: get, get_all_values, batch_get,
+update, batch_update, append_rows, resize. Каждый вызов считается одним
+HTTP-запросом: к нему можно добавить задержку сети и случайные ответы 429.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import gspread
+import requests
+from gspread.utils import a1_range_to_grid_range, rowcol_to_a1
+
+from sheets import SheetsBackend
+
+logger = logging.getLogger(__name__)
+
+
+def api_error(status, message):
+    """APIError с тем же телом ответа, что присылает Google"""
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps({'error': {'code': status, 'message': message}}).encode()
+    return gspread.exceptions.APIError(response)
+
+
+def split_range(range_name):
+    """Отделяет имя листа: "'Лист'!A1:B2" -> "A1:B2" """
+    return range_name.rsplit('!', 1)[-1]
+
+
+def is_blank(value):
+    return value is None or value == ''
+
+
+class FakeWorksheet:
+    """Лист в памяти с подмножеством API gspread.Worksheet"""
+
+    def __init__(self, backend, title, rows=1000, cols=26, values=None):
+        self._backend = backend
+        self.title = title
+        self.row_count = rows
+        self.col_count = cols
+        self._rows = [list(row) for row in values or []]
+
+    def _last_row(self):
+        """Номер последней непустой строки (0, если лист пуст)"""
+        for i in range(len(self._rows), 0, -1):
+            if any(not is_blank(cell) for cell in self._rows[i - 1]):
+                return i
+        return 0
+
+    def _read(self, range_name, value_render_option=None):
+        grid = a1_range_to_grid_range(split_range(range_name))
+        start_row = grid.get('startRowIndex', 0)
+        end_row = min(grid.get('endRowIndex', self.row_count), self.row_count, len(self._rows))
+        start_col = grid.get('startColumnIndex', 0)
+        end_col = grid.get('endColumnIndex', self.col_count)
+        result = []
+        for row in self._rows[start_row:end_row]:
+            cells = row[start_col:end_col]
+            while cells and is_blank(cells[-1]):
+                cells.pop()
+            if value_render_option != 'UNFORMATTED_VALUE':
+                cells = ['' if cell is None else str(cell) for cell in cells]
+            result.append(cells)
+        while result and not result[-1]:
+            result.pop()
+        return result
+
+    def _write(self, range_name, values):
+        grid = a1_range_to_grid_range(split_range(range_name))
+        start_row = grid.get('startRowIndex', 0)
+        start_col = grid.get('startColumnIndex', 0)
+        width = max((len(row) for row in values), default=0)
+        end_row = start_row + len(values)
+        end_col = start_col + width
+        if end_row > self.row_count or end_col > self.col_count:
+            raise api_error(400, f"Range ('{self.title}'!{split_range(range_name)}) exceeds grid limits. "
+                                 f"Max rows: {self.row_count}, max columns: {self.col_count}")
+        while len(self._rows) < end_row:
+            self._rows.append([])
+        for offset, row in enumerate(values):
+            target = self._rows[start_row + offset]
+            if len(target) < start_col + len(row):
+                target.extend([''] * (start_col + len(row) - len(target)))
+            target[start_col:start_col + len(row)] = row
+        updated = f"'{self.title}'!{rowcol_to_a1(start_row + 1, start_col + 1)}:{rowcol_to_a1(end_row, end_col)}"
+        return {'updatedRange': updated, 'updatedRows': len(values),
+                'updatedColumns': width, 'updatedCells': len(values) * width}
+
+    def get(self, range_name=None, **kwargs):
+        self._backend._request('read')
+        with self._backend._lock:
+            return self._read(range_name or 'A1:ZZ', kwargs.get('value_render_option'))
+
+    def batch_get(self, ranges, **kwargs):
+        self._backend._request('read')
+        with self._backend._lock:
+            return [self._read(r, kwargs.get('value_render_option')) for r in ranges]
+
+    def get_all_values(self, **kwargs):
+        self._backend._request('read')
+        with self._backend._lock:
+            rows = [list(row) for row in self._rows[:self._last_row()]]
+        width = max((len(row) for row in rows), default=0)
+        return [[('' if cell is None else str(cell)) for cell in row] + [''] * (width - len(row)) for row in rows]
+
+    def update(self, range_name, values=None, **kwargs):
+        # gspread допускает и старый порядок аргументов: update(values, range_name)
+        if isinstance(range_name, list):
+            range_name, values = values, range_name
+        self._backend._request('write')
+        with self._backend._lock:
+            response = self._write(range_name, values)
+            self._backend._save()
+        return response
+
+    def batch_update(self, data, **kwargs):
+        self._backend._request('write')
+        with self._backend._lock:
+            # Google применяет batchUpdate целиком или не применяет вовсе
+            snapshot = [list(row) for row in self._rows]
+            try:
+                responses = [self._write(item['range'], item['values']) for item in data]
+            except gspread.exceptions.APIError:
+                self._rows = snapshot
+                raise
+            self._backend._save()
+        return {'totalUpdatedRows': sum(r['updatedRows'] for r in responses), 'responses': responses}
+
+    def append_rows(self, values, value_input_option='RAW', insert_data_option=None, table_range=None, **kwargs):
+        self._backend._request('write')
+        with self._backend._lock:
+            start = self._last_row() + 1
+            end = start + len(values) - 1
+            if insert_data_option == 'INSERT_ROWS':
+                self.row_count += len(values)
+            elif end > self.row_count:
+                self.row_count = end
+            response = self._write(f'A{start}', values)
+            self._backend._save()
+        return {'tableRange': f"'{self.title}'!A1:{rowcol_to_a1(max(start - 1, 1), self.col_count)}",
+                'updates': response}
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+    def resize(self, rows=None, cols=None):
+        self._backend._request('write')
+        with self._backend._lock:
+            if rows is not None:
+                self.row_count = rows
+                del self._rows[rows:]
+            if cols is not None:
+                self.col_count = cols
+                self._rows = [row[:cols] for row in self._rows]
+            self._backend._save()
+
+    def to_dict(self):
+        return {'title': self.title, 'rows': self.row_count, 'cols': self.col_count, 'values': self._rows}
+
+
+class FakeSpreadsheet:
+    """Таблица в памяти с подмножеством API gspread.Spreadsheet"""
+
+    def __init__(self, backend, title='fake'):
+        self._backend = backend
+        self.title = title
+        self.id = 'fake'
+        self._worksheets = []
+
+    def _find(self, title):
+        for worksheet in self._worksheets:
+            if worksheet.title == title:
+                return worksheet
+        raise gspread.exceptions.WorksheetNotFound(title)
+
+    def worksheets(self):
+        self._backend._request('read')
+        return list(self._worksheets)
+
+    def worksheet(self, title):
+        self._backend._request('read')
+        with self._backend._lock:
+            return self._find(title)
+
+    def add_worksheet(self, title, rows, cols, values=None):
+        self._backend._request('write')
+        with self._backend._lock:
+            worksheet = FakeWorksheet(self._backend, title, rows, cols, values)
+            self._worksheets.append(worksheet)
+            self._backend._save()
+        return worksheet
+
+    def del_worksheet(self, worksheet):
+        self._backend._request('write')
+        with self._backend._lock:
+            self._worksheets.remove(self._find(worksheet.title))
+            self._backend._save()
+
+
+class FakeSheetsBackend(SheetsBackend):
+    """
+    Бэкенд листов в памяти вместо Google Sheets API.
+
+    latency и jitter — задержка каждого запроса в секундах, quota_error_rate —
+    доля запросов, на которые отвечаем 429. Если задан limiter
+    (SheetsRateLimiter), запросы проходят через него, как и у SheetsSession.
+    Если задан path, данные читаются из JSON-файла и сохраняются в него
+    после каждой записи.
+    """
+
+    def __init__(self, sheet_names=(), rows=1000, cols=26, latency=0.0, jitter=0.0,
+                 quota_error_rate=0.0, limiter=None, path=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.quota_error_rate = quota_error_rate
+        self.limiter = limiter
+        self.path = path
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._counters = {'read': 0, 'write': 0, 'quota_errors': 0}
+        self._spreadsheet = FakeSpreadsheet(self)
+        self._load()
+        existing = {worksheet.title for worksheet in self._spreadsheet._worksheets}
+        for title in sheet_names:
+            if title not in existing:
+                self._spreadsheet._worksheets.append(FakeWorksheet(self, title, rows, cols))
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        self._spreadsheet._worksheets = [
+            FakeWorksheet(self, item['title'], item['rows'], item['cols'], item['values'])
+            for item in data.get('worksheets', [])
+        ]
+        logger.info(f"Поддельные листы загружены из {self.path}")
+
+    def _save(self):
+        if not self.path:
+            return
+        data = {'worksheets': [worksheet.to_dict() for worksheet in self._spreadsheet._worksheets]}
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def _request(self, kind):
+        """Один «HTTP-запрос»: квота, задержка сети и, возможно, ответ 429"""
+        if self.limiter is not None:
+            self.limiter.acquire(kind)
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            self._counters[kind] += 1
+            quota_error = self.quota_error_rate and self._random.random() < self.quota_error_rate
+            if quota_error:
+                self._counters['quota_errors'] += 1
+        if quota_error:
+            if self.limiter is not None:
+                self.limiter.throttled(kind)
+            raise api_error(429, "Quota exceeded for quota metric 'Write requests' (fake)")
+
+    def spreadsheet(self):
+        return self._spreadsheet
+
+    def worksheet(self, title):
+        with self._lock:
+            return self._spreadsheet._find(title)
+
+    def stats(self):
+        """Число запросов чтения и записи и отданных ошибок 429"""
+        with self._lock:
+            return dict(self._counters)
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import logging
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+
+class PostgresStorage(MemoryStorage):
+    """
+    Хранилище FSM aiogram с копией в PostgreSQL.
+
+    Состояния и данные форм живут в памяти, как в MemoryStorage, поэтому
+    шаги диалога не ждут БД. Изменённые адреса (chat, user) помечаются и
+    раз в flush_interval секунд записываются фоновой задачей партиями до
+    batch_size штук. При старте restore() загружает сохранённые состояния,
+    и начатые операции продолжаются после перезапуска. Бакеты антифлуда не
+    сохраняются. Данные, которые нельзя записать в JSONB, пропускаются с
+    ошибкой в логе и не мешают сохранять остальные состояния.
+
+        storage = PostgresStorage(db_async)
+        await storage.restore()
+        storage.start()
+    """
+
+    def __init__(self, repository, flush_interval=1.0, batch_size=500, max_age=None):
+        super().__init__()
+        self.repository = repository
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self._dirty = set()
+        self._task = None
+        self._stats = {'flushes': 0, 'written': 0, 'deleted': 0, 'errors': 0, 'skipped': 0}
+
+    def _mark(self, chat, user):
+        self._dirty.add(tuple(map(str, self.check_address(chat=chat, user=user))))
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await super().set_state(chat=chat, user=user, state=state)
+        self._mark(chat, user)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await super().set_data(chat=chat, user=user, data=data)
+        self._mark(chat, user)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        await super().update_data(chat=chat, user=user, data=data, **kwargs)
+        self._mark(chat, user)
+
+    async def restore(self):
+        """Загружает сохранённые состояния; вызывать до начала обработки апдейтов"""
+        rows = await self.repository.load_fsm_states(self.max_age)
+        for chat_id, user_id, state, data in rows:
+            self.data.setdefault(str(chat_id), {})[str(user_id)] = {'state': state, 'data': data or {}, 'bucket': {}}
+        logger.info(f"FSM: восстановлено состояний: {len(rows)}")
+        return len(rows)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                self._stats['errors'] += 1
+                logger.error(f"FSM: не удалось сохранить состояния, повторим позже: {e}")
+
+    async def flush(self):
+        """Записывает все изменённые состояния партиями"""
+        while self._dirty:
+            batch = [self._dirty.pop() for _ in range(min(self.batch_size, len(self._dirty)))]
+            upserts, deletes = [], []
+            for chat, user in batch:
+                entry = self.data.get(chat, {}).get(user)
+                if entry is None or (entry['state'] is None and not entry['data']):
+                    deletes.append((int(chat), int(user)))
+                else:
+                    # Снимок данных через JSON: заодно проверяем, что их примет JSONB,
+                    # иначе одна такая запись ломала бы каждую следующую партию
+                    try:
+                        data = json.loads(json.dumps(entry['data']))
+                    except (TypeError, ValueError) as e:
+                        self._stats['skipped'] += 1
+                        logger.error(f"FSM: состояние chat={chat} user={user} не сохранено, данные не в JSON: {e}")
+                        continue
+                    upserts.append((int(chat), int(user), entry['state'], data))
+            try:
+                await self.repository.save_fsm_states(upserts, deletes)
+            except Exception:
+                # Изменения, сделанные за время записи, уже снова помечены
+                self._dirty.update(batch)
+                raise
+            self._stats['flushes'] += 1
+            self._stats['written'] += len(upserts)
+            self._stats['deleted'] += len(deletes)
+
+    def stats(self):
+        return dict(self._stats, pending=len(self._dirty))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"FSM: не удалось сохранить состояния при остановке: {e}")
+        await super().close()
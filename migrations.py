@@ -0,0 +1,233 @@
+"""
+Схема БД и начальные данные.
+
+Схема описана списком пронумерованных миграций MIGRATIONS. Применённые
+номера хранятся в таблице schema_migrations, поэтому при старте выполняются
+только новые миграции, а на актуальной базе — один SELECT. Новую миграцию
+добавляют в конец списка со следующим номером; уже выпущенные не меняют.
+
+Начальные данные (справочники, админы по умолчанию) досеиваются функцией
+seed, только если списки в коде изменились с прошлого запуска: контрольная
+сумма списка хранится в таблице seeds.
+"""
+import hashlib
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Одновременно стартующие процессы бота применяют миграции по очереди
+MIGRATION_LOCK_ID = 7_206_915_001
+
+MIGRATIONS = [
+    (1, 'Базовая схема', [
+        '''CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT UNIQUE,
+            name TEXT,
+            phone TEXT,
+            status TEXT,
+            reg_date TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS admins (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT UNIQUE,
+            name TEXT,
+            added_by BIGINT,
+            added_date TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS pay_types (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE
+        )''',
+        '''CREATE TABLE IF NOT EXISTS categories (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE
+        )''',
+        '''CREATE TABLE IF NOT EXISTS object_names (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE
+        )''',
+        '''CREATE TABLE IF NOT EXISTS expense_types (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE
+        )''',
+        '''CREATE TABLE IF NOT EXISTS pending_approvals (
+            id SERIAL PRIMARY KEY,
+            approval_key TEXT UNIQUE,
+            user_id BIGINT,
+            data JSONB,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+    ]),
+    (2, 'Журнал операций, балансы и outbox для Google Sheets', [
+        '''CREATE TABLE IF NOT EXISTS transactions (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            type TEXT,
+            object_name TEXT,
+            expense_type TEXT,
+            currency TEXT,
+            amount NUMERIC,
+            exchange_rate NUMERIC,
+            payment_type TEXT,
+            comment TEXT,
+            delta NUMERIC NOT NULL,
+            outbox_id INTEGER,
+            data JSONB,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS balances (
+            currency TEXT PRIMARY KEY,
+            amount NUMERIC NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS sheet_outbox (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            data JSONB,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+    ]),
+    (3, 'Куда и что записано в Google Sheets — для сверки листа с журналом', [
+        'ALTER TABLE transactions ADD COLUMN IF NOT EXISTS sheet_row INTEGER',
+        'ALTER TABLE transactions ADD COLUMN IF NOT EXISTS sheet_values JSONB',
+        'ALTER TABLE transactions ADD COLUMN IF NOT EXISTS row_hash TEXT',
+        'ALTER TABLE transactions ADD COLUMN IF NOT EXISTS written_at TIMESTAMP',
+        'CREATE INDEX IF NOT EXISTS transactions_sheet_row_idx ON transactions (sheet_row)',
+    ]),
+    (4, 'Версии данных, которые процессы бота держат в памяти', [
+        '''CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        )''',
+    ]),
+    (5, 'Контрольные суммы начальных данных', [
+        '''CREATE TABLE IF NOT EXISTS seeds (
+            name TEXT PRIMARY KEY,
+            checksum TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+    ]),
+    (6, 'Индекс заявок по времени — для постраничного списка и удаления просроченных', [
+        'CREATE INDEX IF NOT EXISTS pending_approvals_created_at_idx ON pending_approvals (created_at, id)',
+    ]),
+    (7, 'Состояния FSM, переживающие перезапуск бота', [
+        '''CREATE TABLE IF NOT EXISTS fsm_states (
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            state TEXT,
+            data JSONB,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, user_id)
+        )''',
+    ]),
+    (8, 'Рассылки пользователям с сохранением прогресса', [
+        '''CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            kind TEXT NOT NULL,
+            text TEXT NOT NULL,
+            audience TEXT NOT NULL DEFAULT 'approved',
+            status TEXT NOT NULL DEFAULT 'running',
+            created_by BIGINT,
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            locked_until TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )''',
+        'CREATE INDEX IF NOT EXISTS users_status_user_id_idx ON users (status, user_id)',
+    ]),
+    (9, 'Индекс по хэшу записанной строки — для поиска повторов при сверке', [
+        'CREATE INDEX IF NOT EXISTS transactions_row_hash_idx ON transactions (row_hash)',
+    ]),
+]
+
+
+async def migrate(conn, migrations=MIGRATIONS):
+    """Применяет ещё не применённые миграции; возвращает список их номеров"""
+    await conn.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    latest = max(version for version, _, _ in migrations)
+    current = await conn.fetchval('SELECT max(version) FROM schema_migrations') or 0
+    if current >= latest:
+        return []
+
+    applied = []
+    async with conn.transaction():
+        await conn.execute('SELECT pg_advisory_xact_lock($1)', MIGRATION_LOCK_ID)
+        # Пока ждали блокировку, миграции мог применить другой процесс
+        done = {row['version'] for row in await conn.fetch('SELECT version FROM schema_migrations')}
+        for version, description, statements in sorted(migrations):
+            if version in done:
+                continue
+            for statement in statements:
+                await conn.execute(statement)
+            await conn.execute('INSERT INTO schema_migrations (version, description) VALUES ($1, $2)',
+                               version, description)
+            applied.append(version)
+            logger.info(f"Миграция {version} применена: {description}")
+    return applied
+
+
+def checksum(payload):
+    return hashlib.sha1(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+
+async def seed(conn, name, payload, apply, cache_version=None):
+    """
+    Выполняет apply(conn, payload), если payload изменился с прошлого раза.
+
+    Всё происходит в одной транзакции вместе с записью новой контрольной
+    суммы и, если задано cache_version, с увеличением версии этих данных
+    в cache_versions. Возвращает True, если данные были досеяны.
+    """
+    digest = checksum(payload)
+    if await conn.fetchval('SELECT checksum FROM seeds WHERE name = $1', name) == digest:
+        return False
+    async with conn.transaction():
+        await conn.execute('SELECT pg_advisory_xact_lock($1)', MIGRATION_LOCK_ID)
+        if await conn.fetchval('SELECT checksum FROM seeds WHERE name = $1', name) == digest:
+            return False
+        await apply(conn, payload)
+        await conn.execute('''INSERT INTO seeds (name, checksum) VALUES ($1, $2)
+            ON CONFLICT (name) DO UPDATE SET checksum = EXCLUDED.checksum, applied_at = CURRENT_TIMESTAMP''',
+                           name, digest)
+        if cache_version:
+            await conn.execute('''INSERT INTO cache_versions (name, version) VALUES ($1, 1)
+                ON CONFLICT (name) DO UPDATE SET version = cache_versions.version + 1''', cache_version)
+    logger.info(f"Начальные данные {name} обновлены")
+    return True
+
+
+async def seed_reference_lists(conn, lists):
+    """
+    Досеивает справочники одним INSERT на таблицу.
+
+    Объекты и типы расходов из кода добавляются, если их ещё нет; значения,
+    добавленные админами, остаются. Типы оплаты и категории по умолчанию
+    заполняются, только если таблица пуста.
+    """
+    for table in ('object_names', 'expense_types'):
+        await conn.execute(f'INSERT INTO {table} (name) SELECT unnest($1::text[]) '
+                           f'ON CONFLICT (name) DO NOTHING', lists[table])
+    for table in ('pay_types', 'categories'):
+        await conn.execute(f'INSERT INTO {table} (name) SELECT unnest($1::text[]) '
+                           f'WHERE NOT EXISTS (SELECT 1 FROM {table}) ON CONFLICT (name) DO NOTHING', lists[table])
+
+
+async def seed_admins(conn, admin_ids):
+    """Админы по умолчанию — только если в таблице ещё нет ни одного"""
+    await conn.execute('''INSERT INTO admins (user_id, name, added_by, added_date)
+        SELECT id, 'Admin ' || id, id, to_char(now(), 'YYYY-MM-DD HH24:MI:SS') FROM unnest($1::bigint[]) AS id
+        WHERE NOT EXISTS (SELECT 1 FROM admins)
+        ON CONFLICT (user_id) DO NOTHING''', admin_ids)
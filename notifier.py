@@ -0,0 +1,123 @@
+"""
+Отправка уведомлений без ожидания в обработчиках.
+
+MessageSender отправляет сообщения не больше concurrency одновременно и
+не чаще rate в секунду (у Telegram общий предел бота — около 30 сообщений
+в секунду). Ошибки Telegram, которые проходят сами, повторяются: RetryAfter
+(флуд-контроль — после него ждут все отправки бота, а не только
+получившая ошибку), сетевые сбои и перезапуск серверов Telegram.
+Заблокировавшие бота и удалённые чаты не повторяются.
+
+AdminNotifier рассылает сообщение всем админам параллельно.
+notify_later() запускает рассылку фоновой задачей, так что обработчик
+пользователя отвечает сразу, сколько бы ни было админов; close() при
+остановке бота дожидается начатых рассылок.
+
+    sender = MessageSender(bot, concurrency=8, rate=30)
+    admin_notifier = AdminNotifier(sender, db_async)
+    admin_notifier.notify_later("Yangi ma'lumot ...")
+"""
+import asyncio
+import logging
+
+from aiogram.utils.exceptions import (BadRequest, NetworkError, RestartingTelegram, RetryAfter,
+                                      Unauthorized)
+
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class MessageSender:
+    def __init__(self, bot, concurrency=8, max_retries=3, retry_delay=1.0, rate=None):
+        self.bot = bot
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # Без запаса на всплеск: сообщения идут равномерно
+        self._bucket = TokenBucket(rate, 1) if rate else None
+        self._resume_at = 0.0
+        self._stats = {'sent': 0, 'failed': 0, 'retries': 0, 'flood_waits': 0}
+
+    async def _wait_flood(self):
+        loop = asyncio.get_running_loop()
+        while (delay := self._resume_at - loop.time()) > 0:
+            await asyncio.sleep(delay)
+
+    async def send(self, chat_id, text, **kwargs):
+        """Отправляет сообщение; True, если доставлено"""
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self._wait_flood()
+                if self._bucket is not None:
+                    await self._bucket.acquire_async()
+                try:
+                    await self.bot.send_message(chat_id, text, **kwargs)
+                    self._stats['sent'] += 1
+                    return True
+                except RetryAfter as e:
+                    self._stats['flood_waits'] += 1
+                    loop = asyncio.get_running_loop()
+                    self._resume_at = max(self._resume_at, loop.time() + e.timeout)
+                    if self._bucket is not None:
+                        self._bucket.drain(e.timeout)
+                    logger.warning(f"Флуд-контроль Telegram: пауза {e.timeout} с перед отправкой в {chat_id}")
+                except (NetworkError, RestartingTelegram, asyncio.TimeoutError) as e:
+                    logger.warning(f"Временная ошибка отправки в {chat_id}: {e}")
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt)
+                except (Unauthorized, BadRequest) as e:
+                    # Бот заблокирован, чат не найден и т.п. — повтор не поможет
+                    logger.error(f"❌ Не удалось отправить сообщение в {chat_id}: {e}")
+                    self._stats['failed'] += 1
+                    return False
+                if attempt < self.max_retries:
+                    self._stats['retries'] += 1
+            logger.error(f"❌ Не удалось отправить сообщение в {chat_id} за {self.max_retries + 1} попыток")
+            self._stats['failed'] += 1
+            return False
+
+    def stats(self):
+        return dict(self._stats)
+
+
+class AdminNotifier:
+    def __init__(self, sender: MessageSender, repository):
+        self.sender = sender
+        self.repository = repository
+        self._tasks = set()
+
+    async def notify(self, text, **kwargs):
+        """Отправляет сообщение всем админам сразу; True, если хотя бы одному доставлено"""
+        admins = await self.repository.get_all_admins()
+        results = await asyncio.gather(*(self.sender.send(admin_id, text, **kwargs)
+                                         for admin_id, _, _ in admins))
+        return any(results)
+
+    def notify_later(self, text, **kwargs):
+        """То же, что notify, фоновой задачей"""
+        return self.detach(self.notify(text, **kwargs))
+
+    def detach(self, coro):
+        """Запускает корутину фоновой задачей; ошибки пишутся в лог"""
+        task = asyncio.create_task(self._run(coro))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    @staticmethod
+    async def _run(coro):
+        try:
+            return await coro
+        except Exception as e:
+            logger.exception(f"❌ Ошибка фоновой рассылки админам: {e}")
+
+    async def close(self, timeout=30):
+        """Дожидается начатых рассылок, не дольше timeout секунд"""
+        if not self._tasks:
+            return
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Рассылка админам: отменено незавершённых задач: {len(pending)}")
+            await asyncio.gather(*pending, return_exceptions=True)
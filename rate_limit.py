@@ -0,0 +1,55 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Потокобезопасное ведро токенов.
+
+    rate — сколько токенов добавляется в секунду, capacity — максимальный
+    запас (допустимый всплеск). Токены выдаются в порядке очереди: каждый
+    вызов reserve() резервирует токен и говорит, сколько нужно подождать.
+    """
+
+    def __init__(self, rate, capacity):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError("rate и capacity должны быть положительными")
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, tokens=1, max_wait=None):
+        """
+        Резервирует токены и возвращает время ожидания в секундах.
+        Если ждать пришлось бы дольше max_wait, ничего не резервирует и возвращает None.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            deficit = tokens - self._tokens
+            wait = deficit / self.rate if deficit > 0 else 0.0
+            if max_wait is not None and wait > max_wait:
+                return None
+            self._tokens -= tokens
+            return wait
+
+    def drain(self, seconds):
+        """Забирает токены на seconds вперёд, например после ответа 429"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+    async def acquire_async(self, tokens=1, max_wait=None):
+        """Ждёт токены, не блокируя цикл событий; False, если ждать дольше max_wait"""
+        wait = self.reserve(tokens, max_wait)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
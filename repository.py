@@ -0,0 +1,692 @@
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from decimal import Decimal
+
+import asyncpg
+
+from cache import MISSING, TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Область текущего апдейта Telegram (см. begin_update и update_context.py)
+_current_update = ContextVar('current_update', default=None)
+
+# Справочники, с которыми работают команды админа
+REFERENCE_TABLES = ('pay_types', 'categories', 'object_names', 'expense_types')
+
+
+def to_decimal(value):
+    """Сумма из формы ('1000', 12.5) для столбца NUMERIC; пустое значение — NULL"""
+    return Decimal(str(value)) if value not in (None, '') else None
+
+
+def order_like(items, order, key=lambda item: item):
+    """Сначала значения в порядке списка order, затем остальные в порядке из БД"""
+    rank = {name: i for i, name in enumerate(order)}
+    return sorted(items, key=lambda item: rank.get(key(item), len(rank)))
+
+
+class Repository:
+    """
+    Асинхронный доступ к PostgreSQL через пул asyncpg.
+
+    Методы — awaitable-аналоги прежних помощников из bot.py с теми же
+    именами и результатами, поэтому обработчики вызывают их как
+    await db_async.get_user_status(user_id). Пул создаётся в connect(),
+    который вызывается при старте бота, а не при импорте.
+    """
+
+    def __init__(self, min_size=1, max_size=10, timeout=30, check_interval=300,
+                 object_order=(), expense_order=(), user_status_ttl=60, version_check_interval=5,
+                 **connect_kwargs):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.object_order = list(object_order)
+        self.expense_order = list(expense_order)
+        self.connect_kwargs = connect_kwargs
+        # Статус пользователя проверяется на каждое сообщение; кэш сбрасывается
+        # при регистрации и смене статуса, а TTL ограничивает устаревание,
+        # если статус поменял другой процесс
+        self.user_status_cache = TTLCache(user_status_ttl)
+        # Список админов и справочники держатся в памяти целиком; изменения из
+        # других процессов замечаются по номеру версии в cache_versions, который
+        # проверяется не чаще раза в version_check_interval секунд
+        self.version_check_interval = version_check_interval
+        self._snapshots = {}
+        self._checked = {}
+        self._snapshot_locks = defaultdict(asyncio.Lock)
+        self._snapshot_loaders = {'admins': self._load_admins, 'reference_lists': self._load_reference_lists}
+        self._pool = None
+        self._stats = {'checkouts': 0, 'waits': 0, 'wait_time': 0.0, 'max_wait': 0.0, 'timeouts': 0}
+
+    async def connect(self):
+        # Простаивающие дольше check_interval соединения закрываются и при
+        # следующей выдаче открываются заново; разорванные asyncpg выбрасывает сам
+        self._pool = await asyncpg.create_pool(
+            min_size=self.min_size,
+            max_size=self.max_size,
+            max_inactive_connection_lifetime=self.check_interval,
+            init=self._init_connection,
+            **self.connect_kwargs
+        )
+        logger.info(f"Пул asyncpg: {self.min_size}-{self.max_size} соединений")
+
+    @staticmethod
+    async def _init_connection(conn):
+        # JSONB приходит словарём и принимается словарём
+        await conn.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    @asynccontextmanager
+    async def connection(self):
+        """Соединение из пула с учётом времени ожидания"""
+        if self._pool is None:
+            raise RuntimeError("Пул соединений с БД не создан: вызовите connect()")
+        started = time.monotonic()
+        waited = self._pool.get_idle_size() == 0 and self._pool.get_size() >= self.max_size
+        try:
+            conn = await self._pool.acquire(timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self._stats['timeouts'] += 1
+            raise
+        wait = time.monotonic() - started
+        self._stats['checkouts'] += 1
+        self._stats['wait_time'] += wait
+        self._stats['max_wait'] = max(self._stats['max_wait'], wait)
+        if waited:
+            self._stats['waits'] += 1
+        try:
+            yield conn
+        finally:
+            await self._pool.release(conn)
+
+    @asynccontextmanager
+    async def advisory_lock(self, key):
+        """
+        Advisory-блокировка PostgreSQL на время блока: из всех процессов бота
+        внутри блока с тем же key только один. Если процесс упадёт, блокировка
+        снимется вместе с соединением.
+        """
+        async with self.connection() as conn:
+            await conn.execute('SELECT pg_advisory_lock($1)', key)
+            try:
+                yield
+            finally:
+                await conn.execute('SELECT pg_advisory_unlock($1)', key)
+
+    def stats(self):
+        """Размер пула, занятость и время ожидания соединения"""
+        stats = dict(self._stats)
+        size = self._pool.get_size() if self._pool is not None else 0
+        idle = self._pool.get_idle_size() if self._pool is not None else 0
+        stats.update(size=size, idle=idle, in_use=size - idle, max_size=self.max_size)
+        stats['utilisation'] = stats['in_use'] / self.max_size
+        stats['avg_wait'] = stats['wait_time'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+    async def fetch(self, query, *args):
+        async with self.connection() as conn:
+            return await conn.fetch(query, *args)
+
+    async def fetchrow(self, query, *args):
+        async with self.connection() as conn:
+            return await conn.fetchrow(query, *args)
+
+    async def fetchval(self, query, *args):
+        async with self.connection() as conn:
+            return await conn.fetchval(query, *args)
+
+    async def execute(self, query, *args):
+        async with self.connection() as conn:
+            return await conn.execute(query, *args)
+
+    # --- Пользователи ---
+    async def get_user_status(self, user_id):
+        scope = self._update_scope(user_id)
+        if scope is not None and scope['user'] is not MISSING:
+            return scope['user'][0]
+        status = self.user_status_cache.get(user_id)
+        if status is not MISSING:
+            return status
+        if scope is not None:
+            await self._load_update(scope)
+            return scope['user'][0]
+        status = await self.fetchval('SELECT status FROM users WHERE user_id=$1', user_id)
+        self.user_status_cache.set(user_id, status)
+        return status
+
+    def _forget_user(self, user_id):
+        self.user_status_cache.invalidate(user_id)
+        scope = self._update_scope(user_id)
+        if scope is not None:
+            scope['user'] = MISSING
+
+    async def register_user(self, user_id, name, phone):
+        await self.execute(
+            'INSERT INTO users (user_id, name, phone, status, reg_date) VALUES ($1, $2, $3, $4, $5) '
+            'ON CONFLICT (user_id) DO NOTHING',
+            user_id, name, phone, 'pending', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        self._forget_user(user_id)
+
+    async def update_user_status(self, user_id, status):
+        await self.execute('UPDATE users SET status=$1 WHERE user_id=$2', status, user_id)
+        self._forget_user(user_id)
+
+    async def get_user_name(self, user_id):
+        scope = self._update_scope(user_id)
+        if scope is not None:
+            await self._load_update(scope)
+            return scope['user'][1]
+        name = await self.fetchval('SELECT name FROM users WHERE user_id=$1', user_id)
+        return name or ''
+
+    async def get_users_by_status(self, status):
+        rows = await self.fetch('SELECT user_id, name, phone, reg_date FROM users WHERE status=$1', status)
+        return [tuple(row) for row in rows]
+
+    # --- Область одного апдейта ---
+    def begin_update(self, user_id):
+        """
+        Открывает область апдейта от пользователя user_id. Пока она открыта,
+        строка этого пользователя и проверка версий всех кэшей загружаются
+        одним запросом при первом обращении и дальше берутся из памяти.
+        Возвращает токен для end_update.
+        """
+        return _current_update.set({'user_id': user_id, 'user': MISSING, 'lock': asyncio.Lock()})
+
+    def end_update(self, token):
+        _current_update.reset(token)
+
+    @staticmethod
+    def _update_scope(user_id=None):
+        scope = _current_update.get()
+        if scope is None or (user_id is not None and scope['user_id'] != user_id):
+            return None
+        return scope
+
+    async def _load_update(self, scope):
+        """Один запрос на апдейт: строка пользователя и версии всех кэшей"""
+        async with scope['lock']:
+            if scope['user'] is not MISSING:
+                return
+            async with self.connection() as conn:
+                row = await conn.fetchrow('''SELECT u.status, u.name, v.versions
+                    FROM (SELECT coalesce(jsonb_object_agg(name, version), '{}') AS versions FROM cache_versions) v
+                    LEFT JOIN users u ON u.user_id = $1''', scope['user_id'])
+                checked = time.monotonic()
+                for name, load in self._snapshot_loaders.items():
+                    version = row['versions'].get(name, 0)
+                    snapshot = self._snapshots.get(name)
+                    if snapshot is None or snapshot[0] != version:
+                        self._snapshots[name] = (version, await load(conn))
+                        logger.info(f"Кэш {name} загружен, версия {version}")
+                    self._checked[name] = checked
+            scope['user'] = (row['status'], row['name'] or '')
+            self.user_status_cache.set(scope['user_id'], row['status'])
+
+    def _is_fresh(self, name):
+        return name in self._snapshots and time.monotonic() - self._checked[name] < self.version_check_interval
+
+    # --- Версии кэшируемых данных ---
+    @staticmethod
+    async def _get_version(conn, name):
+        return await conn.fetchval('SELECT version FROM cache_versions WHERE name = $1', name) or 0
+
+    @staticmethod
+    async def _bump_version(conn, name):
+        """Увеличивает версию данных name; вызывать в той же транзакции, что и изменение"""
+        return await conn.fetchval('''INSERT INTO cache_versions (name, version) VALUES ($1, 1)
+            ON CONFLICT (name) DO UPDATE SET version = cache_versions.version + 1
+            RETURNING version''', name)
+
+    async def _snapshot(self, name, load):
+        """
+        Снимок данных name (версия, данные) из памяти. В БД идём, только если
+        пора сверить версию, и перечитываем данные, только если она изменилась.
+        Внутри апдейта версии сверяются общим запросом _load_update.
+        """
+        if self._is_fresh(name):
+            return self._snapshots[name]
+        scope = self._update_scope()
+        if scope is not None and scope['user'] is MISSING:
+            await self._load_update(scope)
+            if self._is_fresh(name):
+                return self._snapshots[name]
+        async with self._snapshot_locks[name]:
+            if self._is_fresh(name):
+                return self._snapshots[name]
+            snapshot = self._snapshots.get(name)
+            async with self.connection() as conn:
+                version = await self._get_version(conn, name)
+                if snapshot is None or snapshot[0] != version:
+                    snapshot = (version, await load(conn))
+                    self._snapshots[name] = snapshot
+                    logger.info(f"Кэш {name} загружен, версия {version}")
+            self._checked[name] = time.monotonic()
+            return snapshot
+
+    async def _change(self, name, load, change):
+        """
+        Выполняет change(conn) и поднимает версию name в одной транзакции,
+        затем подменяет снимок в памяти одним присваиванием.
+        """
+        async with self._snapshot_locks[name]:
+            async with self.connection() as conn:
+                async with conn.transaction():
+                    result = await change(conn)
+                    version = await self._bump_version(conn, name)
+                    snapshot = (version, await load(conn))
+            self._snapshots[name] = snapshot
+            self._checked[name] = time.monotonic()
+        return result
+
+    # --- Админы ---
+    @staticmethod
+    async def _load_admins(conn):
+        rows = await conn.fetch('SELECT user_id, name, added_date FROM admins ORDER BY added_date')
+        admins = tuple(tuple(row) for row in rows)
+        return admins, frozenset(row[0] for row in admins)
+
+    async def _change_admins(self, query, *args):
+        return await self._change('admins', self._load_admins, lambda conn: conn.execute(query, *args))
+
+    async def is_admin(self, user_id):
+        _, (_, admin_ids) = await self._snapshot('admins', self._load_admins)
+        return user_id in admin_ids
+
+    async def add_admin(self, user_id, name, added_by):
+        await self._change_admins(
+            'INSERT INTO admins (user_id, name, added_by, added_date) VALUES ($1, $2, $3, $4) '
+            'ON CONFLICT (user_id) DO NOTHING',
+            user_id, name, added_by, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        return True
+
+    async def remove_admin(self, user_id):
+        result = await self._change_admins('DELETE FROM admins WHERE user_id=$1', user_id)
+        return result != 'DELETE 0'
+
+    async def get_all_admins(self):
+        _, (admins, _) = await self._snapshot('admins', self._load_admins)
+        return list(admins)
+
+    # --- Справочники ---
+    async def _load_reference_lists(self, conn):
+        """
+        Все справочники одним запросом: items — пары (id, название) в порядке
+        показа на кнопках, by_id — таблицы id -> название для разбора callback_data
+        """
+        rows = await conn.fetch('''SELECT 'pay_types' AS list, name, id FROM pay_types
+            UNION ALL SELECT 'categories', name, id FROM categories
+            UNION ALL SELECT 'object_names', name, id FROM object_names
+            UNION ALL SELECT 'expense_types', name, id FROM expense_types
+            ORDER BY list, id''')
+        items = {table: [] for table in REFERENCE_TABLES}
+        for row in rows:
+            items[row['list']].append((row['id'], row['name']))
+        items['categories'].sort(key=lambda item: item[1])
+        items['object_names'] = order_like(items['object_names'], self.object_order, key=lambda item: item[1])
+        items['expense_types'] = order_like(items['expense_types'], self.expense_order, key=lambda item: item[1])
+        return {
+            'items': {table: tuple(pairs) for table, pairs in items.items()},
+            'by_id': {table: dict(pairs) for table, pairs in items.items()},
+        }
+
+    async def get_reference_lists(self):
+        """(версия, снимок справочников); версия меняется при любом изменении справочников"""
+        return await self._snapshot('reference_lists', self._load_reference_lists)
+
+    async def get_reference_items(self, table):
+        """Пары (id, название) справочника в порядке показа"""
+        _, lists = await self.get_reference_lists()
+        return lists['items'][table]
+
+    async def get_reference_name(self, table, item_id):
+        """
+        Название по id из снимка в памяти. Если в снимке id нет (значение
+        добавил другой процесс, а версия ещё не сверена), спрашиваем БД;
+        None — такого id уже нет.
+        """
+        _, lists = await self.get_reference_lists()
+        name = lists['by_id'][table].get(item_id)
+        if name is None:
+            name = await self.fetchval(f'SELECT name FROM {self._table(table)} WHERE id=$1', item_id)
+        return name
+
+    async def _reference_list(self, table):
+        return [name for _, name in await self.get_reference_items(table)]
+
+    async def get_pay_types(self):
+        return await self._reference_list('pay_types')
+
+    async def get_categories(self):
+        return await self._reference_list('categories')
+
+    async def get_object_names(self):
+        return await self._reference_list('object_names')
+
+    async def get_expense_types(self):
+        return await self._reference_list('expense_types')
+
+    @staticmethod
+    def _table(table):
+        if table not in REFERENCE_TABLES:
+            raise ValueError(f"Неизвестный справочник: {table}")
+        return f'"{table}"'
+
+    async def _change_reference_lists(self, change):
+        return await self._change('reference_lists', self._load_reference_lists, change)
+
+    async def add_list_item(self, table, name):
+        """Добавляет значение в справочник; False, если такое уже есть"""
+        query = f'INSERT INTO {self._table(table)} (name) VALUES ($1)'
+        try:
+            await self._change_reference_lists(lambda conn: conn.execute(query, name))
+            return True
+        except asyncpg.UniqueViolationError:
+            return False
+
+    async def delete_list_item(self, table, item_id):
+        query = f'DELETE FROM {self._table(table)} WHERE id=$1'
+        await self._change_reference_lists(lambda conn: conn.execute(query, item_id))
+
+    async def rename_list_item(self, table, item_id, new_name):
+        query = f'UPDATE {self._table(table)} SET name=$1 WHERE id=$2'
+        await self._change_reference_lists(lambda conn: conn.execute(query, new_name, item_id))
+
+    async def reset_reference_lists(self):
+        """
+        Приводит объекты и типы расходов к спискам в коде: удаляет только
+        названия, которых там нет, и добавляет недостающие. Оставшиеся строки
+        сохраняют id, так что уже отправленные кнопки "o:<id>"/"e:<id>" работают.
+        """
+        async def change(conn):
+            for table, names in (('object_names', self.object_order), ('expense_types', self.expense_order)):
+                await conn.execute(f'DELETE FROM {table} WHERE name <> ALL($1::text[])', names)
+                await conn.execute(f'INSERT INTO {table} (name) SELECT unnest($1::text[]) '
+                                   f'ON CONFLICT (name) DO NOTHING', names)
+        await self._change_reference_lists(change)
+
+    # --- Заявки на одобрение крупных сумм ---
+    async def save_pending_approval(self, approval_key, user_id, data):
+        try:
+            await self.execute(
+                'INSERT INTO pending_approvals (approval_key, user_id, data) VALUES ($1, $2, $3) '
+                'ON CONFLICT (approval_key) DO NOTHING',
+                approval_key, user_id, data)
+            logger.info(f"Данные успешно сохранены в БД для ключа: {approval_key}")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения данных одобрения: {e}")
+            return False
+
+    async def claim_pending_approval(self, approval_key):
+        """
+        Забирает заявку: удаляет её и возвращает данные одним запросом.
+        Из одновременных попыток данные получает ровно одна, остальные — None.
+        """
+        data = await self.fetchval('DELETE FROM pending_approvals WHERE approval_key = $1 RETURNING data', approval_key)
+        if data is None:
+            logger.info(f"Заявка {approval_key} уже обработана или не существует")
+        return data
+
+    async def get_pending_approvals_page(self, limit, after=None):
+        """
+        Страница заявок от новых к старым. after — (created_at, id) последней
+        показанной заявки; страница выбирается по индексу, без OFFSET, поэтому
+        её стоимость не зависит от числа заявок. Из JSONB берутся только
+        поля, нужные для списка.
+        """
+        query = '''SELECT p.id, p.approval_key, p.user_id, p.created_at, u.name AS user_name,
+                p.data->>'type' AS type, p.data->>'amount' AS amount, p.data->>'currency_type' AS currency_type
+            FROM pending_approvals p LEFT JOIN users u ON u.user_id = p.user_id
+            {where}
+            ORDER BY p.created_at DESC, p.id DESC
+            LIMIT $1'''
+        if after is None:
+            rows = await self.fetch(query.format(where=''), limit)
+        else:
+            rows = await self.fetch(query.format(where='WHERE (p.created_at, p.id) < ($2, $3)'), limit, *after)
+        return [dict(row) for row in rows]
+
+    async def expire_pending_approvals(self, max_age, limit):
+        """Удаляет до limit заявок старше max_age секунд и возвращает их (approval_key, user_id, data)"""
+        rows = await self.fetch('''DELETE FROM pending_approvals WHERE id IN (
+                SELECT id FROM pending_approvals
+                WHERE created_at < LOCALTIMESTAMP - make_interval(secs => $1)
+                ORDER BY created_at
+                LIMIT $2
+                FOR UPDATE SKIP LOCKED
+            ) RETURNING approval_key, user_id, data''', float(max_age), limit)
+        return [dict(row) for row in rows]
+
+    # --- Состояния FSM (fsm_storage.PostgresStorage) ---
+    async def load_fsm_states(self, max_age=None):
+        """Все сохранённые состояния [(chat_id, user_id, state, data)]; старше max_age секунд удаляются"""
+        async with self.connection() as conn:
+            if max_age:
+                await conn.execute('DELETE FROM fsm_states WHERE updated_at < LOCALTIMESTAMP - make_interval(secs => $1)',
+                                   float(max_age))
+            rows = await conn.fetch('SELECT chat_id, user_id, state, data FROM fsm_states')
+        return [tuple(row) for row in rows]
+
+    async def save_fsm_states(self, upserts, deletes):
+        """Записывает партию состояний [(chat_id, user_id, state, data)] и удаляет [(chat_id, user_id)]"""
+        async with self.connection() as conn:
+            async with conn.transaction():
+                if upserts:
+                    await conn.executemany('''INSERT INTO fsm_states (chat_id, user_id, state, data, updated_at)
+                        VALUES ($1, $2, $3, $4, LOCALTIMESTAMP)
+                        ON CONFLICT (chat_id, user_id) DO UPDATE
+                        SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = EXCLUDED.updated_at''', upserts)
+                if deletes:
+                    await conn.execute('''DELETE FROM fsm_states WHERE (chat_id, user_id) IN
+                        (SELECT * FROM unnest($1::bigint[], $2::bigint[]))''',
+                                       [chat for chat, _ in deletes], [user for _, user in deletes])
+
+    # --- Рассылки (broadcast.BroadcastEngine) ---
+    async def create_broadcast(self, kind, text, created_by=None, audience='approved'):
+        return await self.fetchval('''INSERT INTO broadcasts (kind, text, created_by, audience)
+            VALUES ($1, $2, $3, $4) RETURNING id''', kind, text, created_by, audience)
+
+    async def has_running_broadcast(self, kind):
+        return await self.fetchval("SELECT EXISTS (SELECT 1 FROM broadcasts WHERE kind = $1 AND status = 'running')",
+                                   kind)
+
+    async def claim_broadcast(self, lease_seconds):
+        """
+        Берёт самую старую незавершённую рассылку, которую не ведёт другой
+        процесс, и продлевает ей аренду на lease_seconds. None, если таких нет.
+        """
+        row = await self.fetchrow('''UPDATE broadcasts
+            SET locked_until = LOCALTIMESTAMP + make_interval(secs => $1)
+            WHERE id = (
+                SELECT id FROM broadcasts
+                WHERE status = 'running' AND (locked_until IS NULL OR locked_until < LOCALTIMESTAMP)
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, kind, text, audience, created_by, last_user_id, sent, failed''', float(lease_seconds))
+        return dict(row) if row else None
+
+    async def get_broadcast_recipients(self, audience, after, limit):
+        """id пользователей со статусом audience больше after, по возрастанию"""
+        rows = await self.fetch('''SELECT user_id FROM users
+            WHERE status = $1 AND user_id > $2 ORDER BY user_id LIMIT $3''', audience, after, limit)
+        return [row['user_id'] for row in rows]
+
+    async def save_broadcast_progress(self, broadcast_id, last_user_id, sent, failed, lease_seconds):
+        """Сдвигает курсор рассылки, продлевает аренду; возвращает текущий статус"""
+        return await self.fetchval('''UPDATE broadcasts
+            SET last_user_id = $2, sent = sent + $3, failed = failed + $4, updated_at = LOCALTIMESTAMP,
+                locked_until = LOCALTIMESTAMP + make_interval(secs => $5)
+            WHERE id = $1
+            RETURNING status''', broadcast_id, last_user_id, sent, failed, float(lease_seconds))
+
+    async def finish_broadcast(self, broadcast_id):
+        await self.execute('''UPDATE broadcasts
+            SET status = 'done', finished_at = LOCALTIMESTAMP, locked_until = NULL
+            WHERE status = 'running' AND id = $1''', broadcast_id)
+
+    async def cancel_broadcast(self, broadcast_id):
+        """True, если рассылка была в работе и отменена"""
+        result = await self.execute('''UPDATE broadcasts
+            SET status = 'cancelled', finished_at = LOCALTIMESTAMP, locked_until = NULL
+            WHERE status = 'running' AND id = $1''', broadcast_id)
+        return result == 'UPDATE 1'
+
+    async def get_recent_broadcasts(self, limit):
+        rows = await self.fetch('''SELECT id, kind, status, sent, failed, created_at, finished_at
+            FROM broadcasts ORDER BY id DESC LIMIT $1''', limit)
+        return [dict(row) for row in rows]
+
+    # --- Outbox записи в Google Sheets ---
+    async def claim_outbox_batch(self, limit, lease_seconds):
+        """
+        Забирает до limit готовых к записи операций и продлевает им аренду
+        на lease_seconds, чтобы их не взял другой обработчик. Ошибки БД не
+        глушатся: пустой список означает только пустой outbox.
+        """
+        rows = await self.fetch('''UPDATE sheet_outbox
+            SET next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => $1)
+            WHERE id IN (
+                SELECT id FROM sheet_outbox
+                WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                ORDER BY id
+                LIMIT $2
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, data, attempts''', float(lease_seconds), limit)
+        return sorted((dict(row) for row in rows), key=lambda entry: entry['id'])
+
+    async def complete_outbox_entry(self, entry_id, row_number=None, row=None, row_hash=None):
+        """
+        Удаляет запись из outbox после успешной записи в Google Sheets и
+        запоминает в журнале номер строки и записанные значения для сверки.
+        """
+        async with self.connection() as conn:
+            async with conn.transaction():
+                if row_number is not None and row is not None:
+                    await conn.execute('''UPDATE transactions
+                        SET sheet_row = $1, sheet_values = $2, row_hash = $3, written_at = CURRENT_TIMESTAMP
+                        WHERE outbox_id = $4''', row_number, row, row_hash, entry_id)
+                await conn.execute('DELETE FROM sheet_outbox WHERE id = $1', entry_id)
+
+    async def retry_outbox_entry(self, entry_id, attempts, delay_seconds, error):
+        """Откладывает повторную попытку записи на delay_seconds"""
+        await self.execute('''UPDATE sheet_outbox
+            SET attempts = $1, last_error = $2, next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => $3)
+            WHERE id = $4''', attempts, error, float(delay_seconds), entry_id)
+
+    async def fail_outbox_entry(self, entry_id, attempts, error):
+        """Помечает запись как не записываемую; она остаётся в таблице для разбора"""
+        await self.execute("UPDATE sheet_outbox SET status = 'failed', attempts = $1, last_error = $2 WHERE id = $3",
+                           attempts, error, entry_id)
+
+    async def requeue_failed_outbox(self):
+        """Возвращает записи со статусом failed в очередь; возвращает их число"""
+        rows = await self.fetch('''UPDATE sheet_outbox
+            SET status = 'pending', attempts = 0, next_attempt_at = CURRENT_TIMESTAMP
+            WHERE status = 'failed'
+            RETURNING id''')
+        return len(rows)
+
+    # --- Журнал операций и балансы ---
+    async def record_operation(self, user_id, data, currency, delta):
+        """
+        В одной транзакции сохраняет операцию в outbox и журнал transactions
+        и обновляет баланс по её валюте. Возвращает (id записи outbox, новый баланс).
+
+        Пока балансы не взяты из таблицы (seed_balances), строки баланса нет и
+        баланс None: операция учтётся при инициализации как ещё не записанная.
+        """
+        async with self.connection() as conn:
+            async with conn.transaction():
+                entry_id = await conn.fetchval(
+                    'INSERT INTO sheet_outbox (user_id, data) VALUES ($1, $2) RETURNING id', user_id, data)
+                await conn.execute('''INSERT INTO transactions
+                    (user_id, type, object_name, expense_type, currency, amount, exchange_rate, payment_type, comment, delta, outbox_id, data)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)''',
+                    user_id, data.get('type'), data.get('object_name'), data.get('expense_type'), currency,
+                    to_decimal(data.get('amount')), to_decimal(data.get('exchange_rate')), data.get('payment_type'),
+                    data.get('comment'), delta, entry_id, data)
+                balance = await conn.fetchval('''UPDATE balances SET amount = amount + $2, updated_at = CURRENT_TIMESTAMP
+                    WHERE currency = $1 RETURNING amount''', currency, delta)
+        return entry_id, balance
+
+    async def get_balances(self):
+        rows = await self.fetch('SELECT currency, amount FROM balances')
+        return {row['currency']: row['amount'] for row in rows}
+
+    @staticmethod
+    async def _unwritten_deltas(conn):
+        """
+        Сумма операций по валютам, которые ещё не записаны в Google Sheets.
+        Записи со статусом failed тоже остаются в outbox и учитываются: их нет в
+        таблице, но они есть в балансе, пока админ не вернёт их в очередь.
+        """
+        rows = await conn.fetch('''SELECT t.currency, COALESCE(SUM(t.delta), 0) AS delta FROM transactions t
+            JOIN sheet_outbox o ON o.id = t.outbox_id
+            GROUP BY t.currency''')
+        return {row['currency']: row['delta'] for row in rows}
+
+    async def has_balances(self):
+        """Взяты ли начальные балансы из таблицы: строки баланса создаёт только seed_balances"""
+        return await self.fetchval('SELECT COUNT(*) FROM balances') > 0
+
+    async def seed_balances(self, values):
+        """Начальные балансы по значениям таблицы с учётом ещё не записанных операций"""
+        async with self.connection() as conn:
+            async with conn.transaction():
+                # Ждём операции, уже попавшие в журнал, — они войдут в сумму
+                # незаписанных; новые подождут нас и обновят созданную строку баланса
+                await conn.execute('LOCK TABLE transactions IN SHARE MODE')
+                pending = await self._unwritten_deltas(conn)
+                for currency, value in values.items():
+                    await conn.execute(
+                        'INSERT INTO balances (currency, amount) VALUES ($1, $2) ON CONFLICT (currency) DO NOTHING',
+                        currency, value + pending.get(currency, 0))
+
+    async def ledger_state(self):
+        """Балансы журнала и сумма ещё не записанных операций, прочитанные одним снимком"""
+        async with self.connection() as conn:
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                pending = await self._unwritten_deltas(conn)
+                rows = await conn.fetch('SELECT currency, amount FROM balances')
+        return {row['currency']: row['amount'] for row in rows}, pending
+
+    async def adjust_balance(self, currency, delta):
+        await self.execute('''UPDATE balances SET amount = amount + $1, updated_at = CURRENT_TIMESTAMP
+            WHERE currency = $2''', delta, currency)
+
+    # --- Сверка листа с журналом ---
+    async def written_rows_range(self):
+        """Первая и последняя строка листа, записанные ботом; None, если таких нет"""
+        row = await self.fetchrow('SELECT MIN(sheet_row) AS first, MAX(sheet_row) AS last FROM transactions '
+                                  'WHERE sheet_row IS NOT NULL')
+        return (row['first'], row['last']) if row['first'] is not None else None
+
+    async def get_written_rows(self, first_row, last_row):
+        """Записанные ботом строки из диапазона: {номер строки: (id операции, значения, хэш)}"""
+        rows = await self.fetch('''SELECT id, sheet_row, sheet_values, row_hash FROM transactions
+            WHERE sheet_row BETWEEN $1 AND $2 ORDER BY id''', first_row, last_row)
+        # Если в одну строку писали дважды, сверяем с последней записью
+        return {row['sheet_row']: (row['id'], row['sheet_values'], row['row_hash']) for row in rows}
+
+    async def find_written_hashes(self, hashes):
+        """Записанные операции с такими хэшами строк: {хэш: (id операции, номер строки)}"""
+        rows = await self.fetch('''SELECT id, sheet_row, row_hash FROM transactions
+            WHERE row_hash = ANY($1::text[]) AND sheet_row IS NOT NULL ORDER BY id''', hashes)
+        return {row['row_hash']: (row['id'], row['sheet_row']) for row in rows}
@@ -0,0 +1,477 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import gspread
+import requests
+from google.auth.exceptions import RefreshError, TransportError
+from google.auth.transport.requests import Request
+from google.oauth2.service_account import Credentials
+
+from blocking import run_blocking
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Строка листа КиримЧиким: значения для столбцов A-K.
+# Столбец J не трогаем (там формулы), поэтому пишем A-I и K отдельными диапазонами.
+ROW_WIDTH = 11
+SKIPPED_COLUMN = 9  # индекс столбца J
+CHECK_COLUMNS = 9  # строка считается пустой, если пусты A-I
+FIRST_DATA_ROW = 2  # строка 1 — заголовки
+
+# Способы выбора строк для записи
+WRITE_MODES = ('cursor', 'append', 'scan')
+
+
+def find_free_rows(all_values, count, first_row=FIRST_DATA_ROW):
+    """Возвращает номера первых count строк с пустыми столбцами A-I"""
+    rows = []
+    for i, row in enumerate(all_values[first_row - 1:], first_row):
+        if not any(str(cell).strip() for cell in row[:CHECK_COLUMNS]):
+            rows.append(i)
+            if len(rows) == count:
+                return rows
+    # Не хватило пустых строк внутри данных — продолжаем после последней
+    next_row = max(len(all_values) + 1, first_row)
+    while len(rows) < count:
+        rows.append(next_row)
+        next_row += 1
+    return rows
+
+
+def row_ranges(row_number, row):
+    """Диапазоны для записи одной строки: A-I и K (J пропускается)"""
+    return [
+        {'range': f'A{row_number}:I{row_number}', 'values': [list(row[:SKIPPED_COLUMN])]},
+        {'range': f'K{row_number}', 'values': [[row[SKIPPED_COLUMN + 1]]]},
+    ]
+
+
+def is_empty_row(row):
+    return not any(str(cell).strip() for cell in row[:CHECK_COLUMNS])
+
+
+def normalize_row(row):
+    """
+    Значения строки для сравнения: A-I и K строками, без J. Числа,
+    прочитанные как UNFORMATTED_VALUE (1000 или 1000.0), совпадают с записанными.
+    """
+    cells = list(row[:ROW_WIDTH]) + [''] * (ROW_WIDTH - len(row))
+    result = []
+    for i, cell in enumerate(cells):
+        if i == SKIPPED_COLUMN:
+            continue
+        if isinstance(cell, float) and cell.is_integer():
+            cell = int(cell)
+        result.append('' if cell is None else str(cell).strip())
+    return result
+
+
+def row_hash(row):
+    return hashlib.sha1('\x1f'.join(normalize_row(row)).encode('utf-8')).hexdigest()
+
+
+def iter_sheet_chunks(worksheet, first_row, last_row, chunk_rows=500):
+    """
+    Читает строки first_row..last_row диапазонами по chunk_rows строк.
+    Отдаёт (первая строка диапазона, строки A-K), дополняя пустыми строками
+    то, что Google не вернул; в памяти одновременно только один диапазон.
+    """
+    for start in range(first_row, last_row + 1, chunk_rows):
+        end = min(start + chunk_rows - 1, last_row)
+        block = worksheet.get(f'A{start}:K{end}', value_render_option='UNFORMATTED_VALUE')
+        rows = [list(row) + [''] * (ROW_WIDTH - len(row)) for row in block]
+        rows.extend([[''] * ROW_WIDTH for _ in range(end - start + 1 - len(rows))])
+        yield start, rows
+
+
+def parse_updated_rows(updated_range):
+    """Номера строк из диапазона вида 'Лист'!A46:K47"""
+    match = re.search(r'![A-Z]+(\d+)(?::[A-Z]+(\d+))?$', updated_range or '')
+    if not match:
+        raise RuntimeError(f"Не удалось разобрать диапазон ответа: {updated_range}")
+    start = int(match.group(1))
+    end = int(match.group(2) or start)
+    return list(range(start, end + 1))
+
+
+class RowCursor:
+    """
+    Локально поддерживаемый номер следующей свободной строки.
+
+    Один раз при старте читается столбец A, дальше курсор сдвигается после
+    каждой записи. Перед записью проверяются только те строки, в которые
+    будем писать; если они заняты (ручная правка, другой процесс), курсор
+    сверяется узким чтением столбца A от текущей позиции.
+
+    Проверка и запись — два разных запроса, поэтому писатель должен быть
+    один: два процесса могут увидеть одни и те же пустые строки и затереть
+    друг друга. Несколько процессов бота должны пересекаться через общую
+    блокировку (в bot.py — advisory-блокировка PostgreSQL) или писать в режиме append.
+    """
+
+    def __init__(self, first_row=FIRST_DATA_ROW, max_attempts=3):
+        self.first_row = first_row
+        self.max_attempts = max_attempts
+        self.next_row = None
+        self.conflicts = 0
+
+    def probe(self, worksheet):
+        """Находит первую строку после последней заполненной в столбце A"""
+        column = worksheet.get(f'A{self.first_row}:A')
+        self.next_row = self.first_row + len(column)
+        logger.info(f"Курсор строк: следующая свободная строка {self.next_row}")
+
+    def reserve(self, worksheet, count):
+        """Возвращает count свободных строк подряд, начиная с курсора"""
+        if self.next_row is None:
+            self.probe(worksheet)
+        for _ in range(self.max_attempts):
+            start = self.next_row
+            end = start + count - 1
+            block = worksheet.get(f'A{start}:I{end}')
+            if all(is_empty_row(row) for row in block):
+                return list(range(start, end + 1))
+            self.conflicts += 1
+            logger.warning(f"Курсор строк: строки {start}-{end} уже заняты, сверяем курсор")
+            self.reconcile(worksheet, block)
+        raise RuntimeError(f"Не удалось найти {count} свободных строк после {self.next_row}")
+
+    def reconcile(self, worksheet, block=()):
+        """Сдвигает курсор за занятые строки по узкому чтению столбца A"""
+        start = self.next_row
+        occupied = [i for i, row in enumerate(block) if not is_empty_row(row)]
+        next_row = start + occupied[-1] + 1 if occupied else start
+        tail = worksheet.get(f'A{start}:A')
+        self.next_row = max(next_row, start + len(tail))
+
+    def advance(self, next_row):
+        self.next_row = max(self.next_row or self.first_row, next_row)
+
+
+def is_retryable_error(error):
+    """
+    Временные ошибки, после которых запись стоит повторить позже: 429, 5xx,
+    сеть и тайм-ауты, ошибки получения токена и отказ ограничителя квоты
+    (SheetsQuotaExceeded — очередь переполнена, а не запрос неверен).
+    """
+    if isinstance(error, gspread.exceptions.APIError):
+        status = getattr(error.response, 'status_code', None)
+        return status == 429 or (status is not None and status >= 500)
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                              TransportError, RefreshError, TimeoutError, asyncio.TimeoutError,
+                              SheetsQuotaExceeded))
+
+
+def is_session_error(error):
+    """Ошибки, после которых авторизацию и дескрипторы листов нужно пересоздать"""
+    if isinstance(error, (RefreshError, gspread.exceptions.SpreadsheetNotFound, gspread.exceptions.WorksheetNotFound)):
+        return True
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(error.response, 'status_code', None) in (401, 404)
+    return False
+
+
+class SheetsQuotaExceeded(Exception):
+    """Запрос не дождался своей очереди в ограничителе квоты"""
+
+
+class SheetsRateLimiter:
+    """
+    Общий планировщик квоты Google Sheets API: отдельные вёдра токенов
+    для чтения и записи. Запросы сверх квоты ждут своей очереди; отказ
+    только если ждать пришлось бы дольше max_wait.
+    """
+
+    KINDS = ('read', 'write')
+
+    def __init__(self, reads_per_minute=60, writes_per_minute=60, burst=10, max_wait=120, penalty=30):
+        self.max_wait = max_wait
+        self.penalty = penalty
+        self.buckets = {
+            'read': TokenBucket(reads_per_minute / 60, min(burst, reads_per_minute)),
+            'write': TokenBucket(writes_per_minute / 60, min(burst, writes_per_minute)),
+        }
+        self._counters = {kind: {'granted': 0, 'delayed': 0, 'rejected': 0, 'throttled': 0} for kind in self.KINDS}
+        self._lock = threading.Lock()
+
+    def _count(self, kind, name):
+        with self._lock:
+            self._counters[kind][name] += 1
+
+    def acquire(self, kind):
+        """Ждёт токен для запроса вида kind ('read' или 'write')"""
+        wait = self.buckets[kind].reserve(max_wait=self.max_wait)
+        if wait is None:
+            self._count(kind, 'rejected')
+            raise SheetsQuotaExceeded(f"Очередь {kind}-запросов к Google Sheets длиннее {self.max_wait} с")
+        if wait > 0:
+            self._count(kind, 'delayed')
+            logger.info(f"Google Sheets: {kind}-запрос ждёт квоту {wait:.1f} с")
+            time.sleep(wait)
+        self._count(kind, 'granted')
+
+    def throttled(self, kind):
+        """Google всё же ответил 429 (квоту делят и другие клиенты) — притормаживаем"""
+        self._count(kind, 'throttled')
+        self.buckets[kind].drain(self.penalty)
+
+    def stats(self):
+        """Счётчики по видам запросов: granted, delayed, rejected, throttled"""
+        with self._lock:
+            return {kind: dict(counters) for kind, counters in self._counters.items()}
+
+
+class RateLimitedClient(gspread.Client):
+    """Клиент gspread, каждый HTTP-запрос которого проходит через SheetsRateLimiter"""
+
+    def __init__(self, auth, session=None, limiter=None):
+        super().__init__(auth, session)
+        self.limiter = limiter
+
+    def request(self, method, endpoint, *args, **kwargs):
+        if self.limiter is None:
+            return super().request(method, endpoint, *args, **kwargs)
+        kind = 'read' if method.lower() == 'get' else 'write'
+        self.limiter.acquire(kind)
+        try:
+            return super().request(method, endpoint, *args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if getattr(e.response, 'status_code', None) == 429:
+                self.limiter.throttled(kind)
+            raise
+
+
+class SheetsBackend:
+    """
+    Интерфейс источника листов для бота и SheetsBatchWriter.
+
+    worksheet(title) должен возвращать объект с методами gspread.Worksheet,
+    которые использует бот: get, get_all_values, batch_get, update,
+    batch_update, append_rows, resize и атрибутом row_count.
+    Реализации: SheetsSession (Google Sheets API) и FakeSheetsBackend
+    из fake_sheets.py (память или локальный файл).
+    """
+
+    def spreadsheet(self):
+        raise NotImplementedError
+
+    def worksheet(self, title):
+        raise NotImplementedError
+
+    def reset(self):
+        """Сбрасывает кэшированные дескрипторы"""
+
+    def run(self, func, *args, **kwargs):
+        """Выполняет func; при ошибке авторизации или 404 пересобирает сессию и повторяет один раз"""
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if not is_session_error(e):
+                raise
+            logger.warning(f"Google Sheets: сессия пересоздаётся после ошибки: {e}")
+            self.reset()
+            return func(*args, **kwargs)
+
+
+class SheetsSession(SheetsBackend):
+    """
+    Общий на весь процесс авторизованный клиент Google Sheets.
+
+    Файл ключа читается и токен получается один раз, таблица и листы
+    кэшируются. Токен обновляется заранее, до истечения срока, а после
+    ошибки авторизации или 404 сессия пересобирается и вызов повторяется.
+    """
+
+    def __init__(self, credentials_file, scopes, sheet_id, refresh_margin=300, limiter=None):
+        self.credentials_file = credentials_file
+        self.scopes = scopes
+        self.sheet_id = sheet_id
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.limiter = limiter
+        self._lock = threading.RLock()
+        self._creds = None
+        self._client = None
+        self._spreadsheet = None
+        self._worksheets = {}
+
+    def _ensure_client(self):
+        if self._client is None:
+            self._creds = Credentials.from_service_account_file(self.credentials_file, scopes=self.scopes)
+            client_factory = functools.partial(RateLimitedClient, limiter=self.limiter)
+            self._client = gspread.authorize(self._creds, client_factory=client_factory)
+            logger.info("Google Sheets: клиент авторизован")
+        # Обновляем токен заранее, чтобы запросы не упирались в истёкший токен
+        expiry = self._creds.expiry
+        if not self._creds.token or expiry is None or expiry - datetime.utcnow() < self.refresh_margin:
+            self._creds.refresh(Request())
+            logger.info(f"Google Sheets: токен обновлён, действует до {self._creds.expiry}")
+        return self._client
+
+    def spreadsheet(self):
+        """Возвращает закэшированный дескриптор таблицы"""
+        with self._lock:
+            client = self._ensure_client()
+            if self._spreadsheet is None:
+                self._spreadsheet = client.open_by_key(self.sheet_id)
+            return self._spreadsheet
+
+    def worksheet(self, title):
+        """Возвращает закэшированный дескриптор листа"""
+        with self._lock:
+            spreadsheet = self.spreadsheet()
+            if title not in self._worksheets:
+                self._worksheets[title] = spreadsheet.worksheet(title)
+            return self._worksheets[title]
+
+    def reset(self):
+        """Сбрасывает клиента и все кэшированные дескрипторы"""
+        with self._lock:
+            self._creds = None
+            self._client = None
+            self._spreadsheet = None
+            self._worksheets = {}
+
+
+class SheetsBatchWriter:
+    """
+    Копит строки от всех пользователей в течение короткого окна и
+    отправляет их в Google Sheets одним batch-запросом.
+
+    Каждый вызывающий получает свой результат: номер записанной строки
+    или исключение, если именно его строка не записалась.
+
+    Режимы выбора строк:
+    - cursor: локальный курсор RowCursor, запись не зависит от размера листа;
+    - append: values.append с INSERT_ROWS, строки вставляет сам Google;
+    - scan: прежний способ, get_all_values() и поиск пустой строки.
+
+    cursor и scan сначала ищут пустые строки, потом пишут в них, и безопасны
+    только при одном писателе; append атомарен на стороне Google.
+    """
+
+    def __init__(self, session, sheet_name, flush_interval=0.5, max_batch=50, mode='cursor'):
+        if mode not in WRITE_MODES:
+            raise ValueError(f"Неизвестный режим записи: {mode}")
+        self.session = session
+        self.sheet_name = sheet_name
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.mode = mode
+        self.cursor = RowCursor()
+        self._grid_rows = 0
+        self._pending = []
+        self._full = None
+        self._task = None
+
+    async def submit(self, row):
+        """Ставит строку в очередь и ждёт, пока её партия будет записана"""
+        if len(row) != ROW_WIDTH:
+            raise ValueError(f"Ожидалось {ROW_WIDTH} значений в строке, получено {len(row)}")
+        loop = asyncio.get_running_loop()
+        if self._full is None:
+            self._full = asyncio.Event()
+        future = loop.create_future()
+        self._pending.append((row, future))
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return await future
+
+    def prepare(self):
+        """Один раз при старте определяет позицию курсора; выполняется в потоке"""
+        if self.mode == 'cursor':
+            self.session.run(lambda: self.cursor.probe(self.session.worksheet(self.sheet_name)))
+
+    async def close(self):
+        """Дописывает всё, что осталось в очереди"""
+        if self._full is not None:
+            self._full.set()
+        if self._task is not None:
+            await self._task
+
+    async def _run(self):
+        while self._pending:
+            if len(self._pending) < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+
+            batch = self._pending[:self.max_batch]
+            self._pending = self._pending[self.max_batch:]
+            rows = [row for row, _ in batch]
+            try:
+                results = await run_blocking(self._write_batch, rows)
+            except Exception as e:
+                logger.error(f"Ошибка batch-записи в Google Sheets ({len(rows)} строк): {e}")
+                results = [e] * len(rows)
+
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _write_batch(self, rows):
+        """Записывает партию строк одним values.batchUpdate; выполняется в потоке"""
+        return self.session.run(self._write_batch_once, rows)
+
+    def _write_batch_once(self, rows):
+        worksheet = self.session.worksheet(self.sheet_name)
+        if self.mode == 'append':
+            return self._append_batch(worksheet, rows)
+        if self.mode == 'cursor':
+            targets = self.cursor.reserve(worksheet, len(rows))
+        else:
+            targets = find_free_rows(worksheet.get_all_values(), len(rows))
+
+        # Расширяем лист, если строки выходят за его границы.
+        # Дескриптор листа закэширован, поэтому размер сетки ведём сами.
+        self._grid_rows = max(self._grid_rows, worksheet.row_count)
+        if targets[-1] > self._grid_rows:
+            worksheet.resize(rows=targets[-1] + 10)
+            self._grid_rows = targets[-1] + 10
+
+        data = []
+        for row_number, row in zip(targets, rows):
+            data.extend(row_ranges(row_number, row))
+        response = worksheet.batch_update(data) or {}
+        if self.mode == 'cursor':
+            self.cursor.advance(targets[-1] + 1)
+
+        # Каждой строке соответствуют два ответа (A-I и K)
+        responses = response.get('responses', [])
+        results = []
+        for i, row_number in enumerate(targets):
+            if len(responses) >= 2 * (i + 1):
+                results.append(row_number)
+            else:
+                results.append(RuntimeError(f"Google Sheets не подтвердил запись строки {row_number}"))
+        logger.info(f"В Google Sheets записано {len(rows)} строк одним запросом: {targets}")
+        return results
+
+    def _append_batch(self, worksheet, rows):
+        """Добавляет строки через values.append с INSERT_ROWS"""
+        # Append пишет непрерывный диапазон A-K; J в новых строках всё равно пуст
+        response = worksheet.append_rows(
+            [list(row) for row in rows],
+            value_input_option='RAW',
+            insert_data_option='INSERT_ROWS',
+            table_range='A1'
+        ) or {}
+        targets = parse_updated_rows(response.get('updates', {}).get('updatedRange'))
+        if len(targets) != len(rows):
+            raise RuntimeError(f"Google Sheets вернул {len(targets)} строк вместо {len(rows)}")
+        logger.info(f"В Google Sheets добавлено {len(rows)} строк одним запросом: {targets}")
+        return targets
@@ -0,0 +1,177 @@
+import asyncio
+
+import pytest
+from aiogram import Bot, Dispatcher, types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.handler import SkipHandler
+
+from callback_router import ANY_STATE, CallbackRouter, normalize_states
+
+
+class Form(StatesGroup):
+    type = State()
+    comment = State()
+
+
+def names(*handlers):
+    """Обработчики-заглушки; маршрут узнаём по имени"""
+    result = {}
+    for name in handlers:
+        async def handler(call, name=name):
+            return name
+        handler.__name__ = name
+        result[name] = handler
+    return result
+
+
+HANDLERS = names('approve', 'approve_large', 'type', 'skip_exact', 'skip_prefix', 'any_o', 'idle_o')
+
+
+def build_router():
+    router = CallbackRouter()
+    router.add('approve_', HANDLERS['approve'], state='*')
+    router.add('approve_large_', HANDLERS['approve_large'], state='*')
+    router.add('type_', HANDLERS['type'], state=Form.type)
+    router.add('skip', HANDLERS['skip_prefix'], state=[Form.comment, None])
+    router.add('skip_comment', HANDLERS['skip_exact'], state=Form.comment, exact=True)
+    router.add('o:', HANDLERS['idle_o'])
+    router.add('o:', HANDLERS['any_o'], state=ANY_STATE)
+    return router
+
+
+@pytest.mark.parametrize('data, state, expected', [
+    # Самый длинный префикс выигрывает независимо от порядка регистрации
+    ('approve_5', None, 'approve'),
+    ('approve_large_5_1', None, 'approve_large'),
+    ('approve_large_5_1', 'Form:comment', 'approve_large'),
+    # Точное совпадение важнее префикса, но только для всей строки
+    ('skip_comment', 'Form:comment', 'skip_exact'),
+    ('skip_comment_x', 'Form:comment', 'skip_prefix'),
+    # Точный маршрут не подходит по состоянию — ищется префиксный
+    ('skip_comment', None, 'skip_prefix'),
+    # Фильтр состояния: конкретное состояние, множество, None — без состояния
+    ('type_kirim', 'Form:type', 'type'),
+    ('type_kirim', None, None),
+    ('type_kirim', 'Form:comment', None),
+    ('skip', None, 'skip_prefix'),
+    ('skip', 'Form:type', None),
+    # Одинаковый префикс: первый подходящий по состоянию в порядке регистрации
+    ('o:12', None, 'idle_o'),
+    ('o:12', 'Form:type', 'any_o'),
+    # Нет маршрута
+    ('unknown', None, None),
+    ('', None, None),
+    ('appr', None, None),
+])
+def test_resolve(data, state, expected):
+    route = build_router().resolve(data, state)
+    assert (route.handler.__name__ if route else None) == expected
+
+
+def test_normalize_states():
+    assert normalize_states('*') == ANY_STATE
+    assert normalize_states(None) == frozenset([None])
+    assert normalize_states(Form.type) == frozenset(['Form:type'])
+    assert normalize_states([Form.type, 'x', None]) == frozenset(['Form:type', 'x', None])
+
+
+def test_empty_prefix_rejected():
+    with pytest.raises(ValueError):
+        CallbackRouter().add('', HANDLERS['type'])
+
+
+def test_len_counts_routes():
+    assert len(build_router()) == 7
+
+
+class FakeState:
+    def __init__(self, state):
+        self.state = state
+
+    async def get_state(self):
+        return self.state
+
+
+class FakeCall:
+    def __init__(self, data):
+        self.data = data
+
+
+def test_dispatch_passes_state_only_when_accepted():
+    calls = []
+
+    async def with_state(call, state):
+        calls.append(('with_state', call.data, state.state))
+
+    async def without_state(call):
+        calls.append(('without_state', call.data))
+
+    router = CallbackRouter()
+    router.add('a', with_state, state='*')
+    router.add('b', without_state, state='*')
+
+    async def main():
+        assert await router.dispatch(FakeCall('a1'), FakeState('Form:type'))
+        assert await router.dispatch(FakeCall('b1'), FakeState(None))
+        assert not await router.dispatch(FakeCall('c1'), FakeState(None))
+
+    asyncio.run(main())
+    assert calls == [('with_state', 'a1', 'Form:type'), ('without_state', 'b1')]
+
+
+def test_handle_raises_skip_handler_when_nothing_matches():
+    router = CallbackRouter()
+    router.add('a', HANDLERS['type'], state='*')
+    with pytest.raises(SkipHandler):
+        asyncio.run(router._handle(FakeCall('zzz'), FakeState(None)))
+
+
+def make_callback_update(update_id, data, user_id=1):
+    return types.Update(**{'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'chat_instance': '1', 'data': data,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'test'},
+        'message': {'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}},
+    }})
+
+
+def test_dispatcher_catch_all_and_fallthrough():
+    """Роутер — один обработчик для всех состояний; без маршрута апдейт идёт дальше по цепочке aiogram"""
+    async def main():
+        bot = Bot('42:TEST')
+        Bot.set_current(bot)
+        dp = Dispatcher(bot, storage=MemoryStorage())
+        Dispatcher.set_current(dp)
+        seen = []
+        router = CallbackRouter()
+
+        @router.route('type_', state=Form.type)
+        async def process_type(call, state):
+            seen.append(('type', call.data))
+
+        @router.route('pending_page_', state='*')
+        async def pending_page(call):
+            seen.append(('pending', call.data))
+
+        router.setup(dp)
+
+        @dp.callback_query_handler(state='*')
+        async def fallback(call):
+            seen.append(('fallback', call.data))
+
+        await dp.storage.set_state(chat=1, user=1, state=Form.type.state)
+        await dp.process_update(make_callback_update(1, 'type_kirim'))
+        await dp.process_update(make_callback_update(2, 'pending_page_1_2'))
+        await dp.process_update(make_callback_update(3, 'nothing'))
+        await dp.storage.set_state(chat=1, user=1, state=None)
+        await dp.process_update(make_callback_update(4, 'type_kirim'))
+        session = await bot.get_session()
+        await session.close()
+        return seen
+
+    assert asyncio.run(main()) == [
+        ('type', 'type_kirim'),
+        ('pending', 'pending_page_1_2'),
+        ('fallback', 'nothing'),
+        ('fallback', 'type_kirim'),
+    ]
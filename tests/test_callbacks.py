@@ -0,0 +1,55 @@
+import pytest
+
+from callbacks import (MAX_CALLBACK_BYTES, PAGE_PREFIX, PREFIXES, RECENT_PAGE, REFERENCE_ACTIONS, pack,
+                       page_callback, parse_page_callback, parse_reference_callback, reference_callback,
+                       reference_prefix, unpack)
+
+
+def test_prefixes_are_unique():
+    prefixes = [prefix for prefix, _ in REFERENCE_ACTIONS.values()]
+    assert len(prefixes) == len(set(prefixes)) == len(PREFIXES)
+    assert PAGE_PREFIX not in PREFIXES
+
+
+@pytest.mark.parametrize('prefix, parts', [
+    ('o', [12]),
+    ('pg', ['o', 2]),
+    ('x', []),
+    ('ab', ['Объект', 'r']),
+])
+def test_pack_unpack_round_trip(prefix, parts):
+    assert unpack(pack(prefix, *parts)) == (prefix, [str(part) for part in parts])
+
+
+def test_pack_limit_counts_bytes_not_characters():
+    # Кириллица — два байта на символ
+    assert len(pack('o', 'я' * 31).encode()) == MAX_CALLBACK_BYTES
+    with pytest.raises(ValueError):
+        pack('o', 'я' * 31 + 'x')
+
+
+@pytest.mark.parametrize('action', sorted(REFERENCE_ACTIONS))
+def test_reference_round_trip(action):
+    item_id = 2 ** 31 - 1
+    data = reference_callback(action, item_id)
+    assert len(data.encode()) <= MAX_CALLBACK_BYTES
+    assert data.startswith(reference_prefix(action))
+    assert parse_reference_callback(data) == (action, REFERENCE_ACTIONS[action][1], item_id)
+
+
+@pytest.mark.parametrize('data', ['o', 'o:', 'o:abc', 'o:1:2', 'zz:1', 'object_Дом', 'pg:o:1'])
+def test_parse_reference_rejects_foreign_data(data):
+    assert parse_reference_callback(data) is None
+
+
+@pytest.mark.parametrize('action', sorted(REFERENCE_ACTIONS))
+@pytest.mark.parametrize('page', [0, 7, 10 ** 6, RECENT_PAGE])
+def test_page_round_trip(action, page):
+    data = page_callback(action, page)
+    assert len(data.encode()) <= MAX_CALLBACK_BYTES
+    assert parse_page_callback(data) == (action, REFERENCE_ACTIONS[action][1], page)
+
+
+@pytest.mark.parametrize('data', ['pg', 'pg:o', 'pg:o:x', 'pg:zz:1', 'pg:o:1:2', 'o:1', 'pg:o:-1'])
+def test_parse_page_rejects_foreign_data(data):
+    assert parse_page_callback(data) is None
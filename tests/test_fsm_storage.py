@@ -0,0 +1,139 @@
+import asyncio
+import json
+from decimal import Decimal
+
+import pytest
+
+from fsm_storage import PostgresStorage
+
+
+class FakeRepository:
+    """fsm_states в памяти: {(chat_id, user_id): (state, data)}"""
+
+    def __init__(self, rows=()):
+        self.rows = {(chat, user): (state, data) for chat, user, state, data in rows}
+        self.calls = []
+        self.fail = False
+
+    async def load_fsm_states(self, max_age=None):
+        return [(chat, user, state, data) for (chat, user), (state, data) in self.rows.items()]
+
+    async def save_fsm_states(self, upserts, deletes):
+        self.calls.append((list(upserts), list(deletes)))
+        if self.fail:
+            raise ConnectionError('db is down')
+        for _, _, _, data in upserts:
+            json.dumps(data)  # как кодек JSONB в asyncpg
+        for chat, user, state, data in upserts:
+            self.rows[(chat, user)] = (state, data)
+        for key in deletes:
+            self.rows.pop(key, None)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_restore_loads_saved_states():
+    async def main():
+        repository = FakeRepository([(1, 1, 'Form:amount', {'type': 'kirim'}), (2, 3, None, {'x': 1})])
+        storage = PostgresStorage(repository)
+        assert await storage.restore() == 2
+        assert await storage.get_state(chat=1, user=1) == 'Form:amount'
+        assert await storage.get_data(chat=1, user=1) == {'type': 'kirim'}
+        assert await storage.get_data(chat=2, user=3) == {'x': 1}
+        # Восстановление не помечает записи изменёнными
+        assert storage.stats()['pending'] == 0
+
+    run(main())
+
+
+def test_flush_writes_changes_and_deletes_finished_states():
+    async def main():
+        repository = FakeRepository([(5, 5, 'Form:comment', {'a': 1})])
+        storage = PostgresStorage(repository, batch_size=2)
+        await storage.restore()
+        await storage.set_state(chat=1, user=1, state='Form:type')
+        await storage.update_data(chat=1, user=1, data={'type': 'kirim'})
+        await storage.set_data(chat=2, user=2, data={'b': 2})
+        await storage.reset_state(chat=5, user=5, with_data=True)
+        await storage.flush()
+        assert repository.rows == {
+            (1, 1): ('Form:type', {'type': 'kirim'}),
+            (2, 2): (None, {'b': 2}),
+        }
+        # Три адреса партиями по два — два запроса
+        assert len(repository.calls) == 2
+        assert storage.stats() == {'flushes': 2, 'written': 2, 'deleted': 1, 'errors': 0, 'skipped': 0,
+                                   'pending': 0}
+
+    run(main())
+
+
+def test_flush_stores_snapshot_of_data():
+    async def main():
+        repository = FakeRepository()
+        storage = PostgresStorage(repository)
+        await storage.set_data(chat=1, user=1, data={'items': ['a']})
+        await storage.flush()
+        storage.data['1']['1']['data']['items'].append('b')
+        assert repository.rows[(1, 1)] == (None, {'items': ['a']})
+
+    run(main())
+
+
+def test_unserializable_entry_does_not_block_others():
+    async def main():
+        repository = FakeRepository()
+        storage = PostgresStorage(repository)
+        await storage.set_data(chat=1, user=1, data={'amount': Decimal('1.5')})
+        await storage.set_data(chat=2, user=2, data={'amount': '1.5'})
+        await storage.flush()
+        assert repository.rows == {(2, 2): (None, {'amount': '1.5'})}
+        assert storage.stats()['skipped'] == 1
+        assert storage.stats()['pending'] == 0
+        # Следующие сохранения проходят
+        await storage.set_state(chat=3, user=3, state='Form:type')
+        await storage.flush()
+        assert (3, 3) in repository.rows
+
+    run(main())
+
+
+def test_failed_batch_is_retried():
+    async def main():
+        repository = FakeRepository()
+        storage = PostgresStorage(repository)
+        await storage.set_state(chat=1, user=1, state='Form:type')
+        repository.fail = True
+        with pytest.raises(ConnectionError):
+            await storage.flush()
+        assert storage.stats()['pending'] == 1
+        repository.fail = False
+        await storage.flush()
+        assert repository.rows == {(1, 1): ('Form:type', {})}
+
+    run(main())
+
+
+def test_background_flush_and_close():
+    async def main():
+        repository = FakeRepository()
+        storage = PostgresStorage(repository, flush_interval=0.01)
+        storage.start()
+        await storage.set_state(chat=1, user=1, state='Form:type')
+        await asyncio.sleep(0.05)
+        assert (1, 1) in repository.rows
+        # Ошибка фоновой записи считается, задача продолжает работать
+        repository.fail = True
+        await storage.set_state(chat=2, user=2, state='Form:type')
+        await asyncio.sleep(0.05)
+        assert storage.stats()['errors'] >= 1
+        repository.fail = False
+        # close() дописывает изменения, сделанные после последней записи
+        await storage.set_state(chat=3, user=3, state='Form:comment')
+        await storage.close()
+        assert set(repository.rows) == {(1, 1), (2, 2), (3, 3)}
+        assert storage.stats()['pending'] == 0
+
+    run(main())
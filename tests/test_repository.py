@@ -0,0 +1,163 @@
+import asyncio
+from decimal import Decimal
+
+import pytest
+
+from repository import Repository
+
+
+class FakeConnection:
+    """Записывает запросы; fetch отвечает из rows или падает с error"""
+
+    def __init__(self, rows=(), error=None):
+        self.rows = list(rows)
+        self.error = error
+        self.queries = []
+
+    async def fetch(self, query, *args):
+        self.queries.append((query, args))
+        if self.error is not None:
+            raise self.error
+        return self.rows
+
+
+class FakePool:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def acquire(self, timeout=None):
+        return self.conn
+
+    async def release(self, conn):
+        pass
+
+    def get_idle_size(self):
+        return 1
+
+    def get_size(self):
+        return 1
+
+
+def make_repository(conn):
+    repository = Repository()
+    repository._pool = FakePool(conn)
+    return repository
+
+
+def test_claim_outbox_batch_returns_entries_in_id_order():
+    conn = FakeConnection(rows=[{'id': 3, 'data': {}, 'attempts': 0}, {'id': 1, 'data': {}, 'attempts': 2}])
+    entries = asyncio.run(make_repository(conn).claim_outbox_batch(10, 120))
+    assert [entry['id'] for entry in entries] == [1, 3]
+    assert conn.queries[0][1] == (120.0, 10)
+
+
+def test_claim_outbox_batch_propagates_database_errors():
+    """Сбой БД не должен выглядеть для обработчика outbox как пустая очередь"""
+    conn = FakeConnection(error=ConnectionRefusedError('db is down'))
+    with pytest.raises(ConnectionRefusedError):
+        asyncio.run(make_repository(conn).claim_outbox_batch(10, 120))
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.queries = []
+
+    async def execute(self, query, *args):
+        self.queries.append((' '.join(query.split()), args))
+
+
+def test_reset_reference_lists_keeps_existing_rows():
+    """Перезаполнение не пересоздаёт строки: id уже отправленных кнопок остаются"""
+    conn = RecordingConnection()
+    repository = Repository(object_order=['Дом', 'Склад'], expense_order=['Бетон'])
+
+    async def change_reference_lists(change):
+        return await change(conn)
+
+    repository._change_reference_lists = change_reference_lists
+    asyncio.run(repository.reset_reference_lists())
+    assert conn.queries == [
+        ('DELETE FROM object_names WHERE name <> ALL($1::text[])', (['Дом', 'Склад'],)),
+        ('INSERT INTO object_names (name) SELECT unnest($1::text[]) ON CONFLICT (name) DO NOTHING',
+         (['Дом', 'Склад'],)),
+        ('DELETE FROM expense_types WHERE name <> ALL($1::text[])', (['Бетон'],)),
+        ('INSERT INTO expense_types (name) SELECT unnest($1::text[]) ON CONFLICT (name) DO NOTHING',
+         (['Бетон'],)),
+    ]
+
+
+def test_find_written_hashes_maps_hash_to_operation_and_row():
+    conn = FakeConnection(rows=[{'id': 7, 'sheet_row': 120, 'row_hash': 'a'}, {'id': 9, 'sheet_row': 131, 'row_hash': 'b'}])
+    known = asyncio.run(make_repository(conn).find_written_hashes(['a', 'b', 'c']))
+    assert known == {'a': (7, 120), 'b': (9, 131)}
+    assert conn.queries[0][1] == (['a', 'b', 'c'],)
+
+
+
+class NullTransaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class TransactionConnection(RecordingConnection):
+    """Соединение с транзакциями: fetchval отвечает по очереди из values, fetch — из rows"""
+
+    def __init__(self, values=(), rows=()):
+        super().__init__()
+        self.values = list(values)
+        self.rows = list(rows)
+
+    def transaction(self, **kwargs):
+        return NullTransaction()
+
+    async def fetchval(self, query, *args):
+        self.queries.append((' '.join(query.split()), args))
+        return self.values.pop(0)
+
+    async def fetch(self, query, *args):
+        self.queries.append((' '.join(query.split()), args))
+        return self.rows
+
+
+def test_record_operation_does_not_create_unseeded_balance():
+    """До инициализации из таблицы операция не создаёт строку баланса с нуля"""
+    conn = TransactionConnection(values=[5, None])
+    entry_id, balance = asyncio.run(make_repository(conn).record_operation(1, {'type': 'Кирим'}, 'Сом', Decimal(100)))
+    assert (entry_id, balance) == (5, None)
+    query, args = conn.queries[-1]
+    assert query.startswith('UPDATE balances SET amount = amount + $2')
+    assert args == ('Сом', Decimal(100))
+    assert not any(query.startswith('INSERT INTO balances') for query, _ in conn.queries)
+
+
+def test_seed_balances_counts_unwritten_operations():
+    conn = TransactionConnection(rows=[{'currency': 'Сом', 'delta': Decimal(-300)}])
+    asyncio.run(make_repository(conn).seed_balances({'Сом': Decimal(1000), 'Доллар': Decimal(50)}))
+    assert conn.queries[0] == ('LOCK TABLE transactions IN SHARE MODE', ())
+    inserts = [args for query, args in conn.queries if query.startswith('INSERT INTO balances')]
+    assert inserts == [('Сом', Decimal(700)), ('Доллар', Decimal(50))]
+
+
+def test_unwritten_deltas_include_failed_outbox_entries():
+    """failed-записи есть в балансе, но не в таблице — сверка должна их учитывать"""
+    conn = TransactionConnection(rows=[])
+    asyncio.run(Repository._unwritten_deltas(conn))
+    query, _ = conn.queries[0]
+    assert 'JOIN sheet_outbox' in query
+    assert 'status' not in query
+
+
+def test_advisory_lock_is_released_after_error():
+    conn = RecordingConnection()
+    repository = make_repository(conn)
+
+    async def fail_inside_lock():
+        async with repository.advisory_lock(42):
+            raise RuntimeError('sheets write failed')
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(fail_inside_lock())
+    assert conn.queries == [('SELECT pg_advisory_lock($1)', (42,)), ('SELECT pg_advisory_unlock($1)', (42,))]
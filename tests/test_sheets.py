@@ -0,0 +1,50 @@
+import asyncio
+
+import gspread
+import pytest
+import requests
+from google.auth.exceptions import RefreshError, TransportError
+
+from sheets import SheetsQuotaExceeded, is_retryable_error
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def json(self):
+        return {'error': {'code': self.status_code, 'message': 'test', 'status': 'TEST'}}
+
+    @property
+    def text(self):
+        return 'test'
+
+
+def api_error(status):
+    return gspread.exceptions.APIError(FakeResponse(status))
+
+
+@pytest.mark.parametrize('error', [
+    api_error(429),
+    api_error(500),
+    api_error(503),
+    requests.exceptions.ConnectionError('reset'),
+    requests.exceptions.Timeout('slow'),
+    TransportError('dns'),
+    RefreshError('token endpoint unavailable'),
+    asyncio.TimeoutError(),
+    TimeoutError(),
+    SheetsQuotaExceeded('queue is full'),
+])
+def test_retryable_errors(error):
+    assert is_retryable_error(error)
+
+
+@pytest.mark.parametrize('error', [
+    api_error(400),
+    api_error(403),
+    ValueError('bad row'),
+    KeyError('amount'),
+])
+def test_permanent_errors(error):
+    assert not is_retryable_error(error)
@@ -0,0 +1,183 @@
+import asyncio
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher import FSMContext
+
+from webhook import UpdateScheduler
+
+
+def make_update(update_id, user_id, text='x'):
+    return types.Update(**{'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'test'},
+        'chat': {'id': user_id, 'type': 'private'},
+    }})
+
+
+def make_dispatcher():
+    bot = Bot('42:TEST')
+    Bot.set_current(bot)
+    return Dispatcher(bot, storage=MemoryStorage())
+
+
+def test_same_user_updates_keep_order():
+    async def main():
+        dp = make_dispatcher()
+        seen = []
+
+        async def handler(message: types.Message):
+            # Первый апдейт обрабатывается дольше — второй не должен его обогнать
+            await asyncio.sleep(0.02 if message.text == '0' else 0)
+            seen.append((message.from_user.id, message.text))
+
+        dp.register_message_handler(handler)
+        scheduler = UpdateScheduler(dp, max_concurrency=8)
+        for i in range(3):
+            assert scheduler.submit(make_update(i * 2, 1, str(i)))
+            assert scheduler.submit(make_update(i * 2 + 1, 2, str(i)))
+        await scheduler.wait_idle()
+        assert [text for user, text in seen if user == 1] == ['0', '1', '2']
+        assert [text for user, text in seen if user == 2] == ['0', '1', '2']
+        assert scheduler.stats()['processed'] == 6
+
+    asyncio.run(main())
+
+
+def test_burst_sees_state_set_by_previous_update():
+    """Два сообщения подряд: второе должно попасть в обработчик нового состояния"""
+    async def main():
+        dp = make_dispatcher()
+        result = {}
+
+        async def process_amount(message: types.Message, state: FSMContext):
+            await state.update_data(amount=message.text)
+            await state.set_state('Form:exchange_rate')
+
+        async def process_rate(message: types.Message, state: FSMContext):
+            await state.update_data(exchange_rate=message.text)
+            await state.set_state('Form:comment')
+
+        dp.register_message_handler(process_amount, state='Form:amount')
+        dp.register_message_handler(process_rate, state='Form:exchange_rate')
+        await dp.storage.set_state(chat=7, user=7, state='Form:amount')
+
+        scheduler = UpdateScheduler(dp)
+        scheduler.submit(make_update(1, 7, '100'))
+        scheduler.submit(make_update(2, 7, '12500'))
+        await scheduler.wait_idle()
+        result.update(await dp.storage.get_data(chat=7, user=7))
+        assert await dp.storage.get_state(chat=7, user=7) == 'Form:comment'
+        assert result == {'amount': '100', 'exchange_rate': '12500'}
+
+    asyncio.run(main())
+
+
+def test_concurrency_is_capped():
+    async def main():
+        dp = make_dispatcher()
+        active = peak = 0
+
+        async def handler(message: types.Message):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+
+        dp.register_message_handler(handler)
+        scheduler = UpdateScheduler(dp, max_concurrency=3)
+        for i in range(10):
+            scheduler.submit(make_update(i, 100 + i))
+        await scheduler.wait_idle()
+        assert peak == 3
+
+    asyncio.run(main())
+
+
+def test_rejects_over_max_pending():
+    async def main():
+        dp = make_dispatcher()
+        release = asyncio.Event()
+
+        async def handler(message: types.Message):
+            await release.wait()
+
+        dp.register_message_handler(handler)
+        scheduler = UpdateScheduler(dp, max_pending=2)
+        assert scheduler.submit(make_update(1, 1))
+        assert scheduler.submit(make_update(2, 1))
+        assert not scheduler.submit(make_update(3, 2))
+        assert scheduler.stats()['rejected'] == 1
+        release.set()
+        await scheduler.wait_idle()
+        # Место освободилось — апдейты снова принимаются
+        assert scheduler.submit(make_update(4, 2))
+        await scheduler.wait_idle()
+        assert scheduler.stats()['processed'] == 3
+
+    asyncio.run(main())
+
+
+def test_handler_error_does_not_stop_user_queue():
+    async def main():
+        dp = make_dispatcher()
+        seen = []
+
+        async def handler(message: types.Message):
+            if message.text == 'boom':
+                raise RuntimeError('boom')
+            seen.append(message.text)
+
+        dp.register_message_handler(handler)
+        scheduler = UpdateScheduler(dp)
+        scheduler.submit(make_update(1, 1, 'boom'))
+        scheduler.submit(make_update(2, 1, 'ok'))
+        await scheduler.wait_idle()
+        assert seen == ['ok']
+        assert scheduler.stats()['errors'] == 1
+
+    asyncio.run(main())
+
+
+def test_close_waits_for_accepted_updates():
+    async def main():
+        dp = make_dispatcher()
+        seen = []
+
+        async def handler(message: types.Message):
+            await asyncio.sleep(0.01)
+            seen.append(message.text)
+
+        dp.register_message_handler(handler)
+        scheduler = UpdateScheduler(dp)
+        for i in range(3):
+            scheduler.submit(make_update(i, 1, str(i)))
+        await scheduler.close(timeout=5)
+        assert seen == ['0', '1', '2']
+        assert scheduler.stats()['pending'] == 0
+
+    asyncio.run(main())
+
+
+def test_close_cancels_after_timeout_and_resets_pending():
+    async def main():
+        dp = make_dispatcher()
+
+        async def handler(message: types.Message):
+            await asyncio.sleep(10)
+
+        dp.register_message_handler(handler)
+        scheduler = UpdateScheduler(dp)
+        for i in range(3):
+            scheduler.submit(make_update(i, 1))
+        scheduler.submit(make_update(3, 2))
+        await scheduler.close(timeout=0.05)
+        stats = scheduler.stats()
+        assert stats['pending'] == 0
+        assert stats['users'] == 0
+        assert stats['active'] == 0
+        # После отмены очередь пуста, и wait_idle не зависает
+        await asyncio.wait_for(scheduler.wait_idle(), 1)
+
+    asyncio.run(main())
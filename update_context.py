@@ -0,0 +1,41 @@
+"""
+Область одного апдейта Telegram для Repository.
+
+Обработка апдейта обычно спрашивает о его отправителе несколько раз:
+фильтр проверяет статус, обработчик берёт имя, список админов и
+справочники. Middleware открывает на время апдейта область
+Repository.begin_update: первое обращение загружает строку пользователя и
+сверяет версии всех кэшей одним запросом, остальные отвечаются из памяти.
+"""
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# Поля апдейта, у которых есть отправитель
+USER_EVENTS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+               'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request')
+
+
+def update_user_id(update: types.Update):
+    """id отправителя апдейта или None"""
+    for kind in USER_EVENTS:
+        event = getattr(update, kind, None)
+        user = getattr(event, 'from_user', None) if event is not None else None
+        if user is not None:
+            return user.id
+    return None
+
+
+class UpdateContextMiddleware(BaseMiddleware):
+    def __init__(self, repository):
+        super().__init__()
+        self.repository = repository
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        user_id = update_user_id(update)
+        if user_id is not None:
+            data['update_scope'] = self.repository.begin_update(user_id)
+
+    async def on_post_process_update(self, update: types.Update, result, data: dict):
+        token = data.pop('update_scope', None)
+        if token is not None:
+            self.repository.end_update(token)
@@ -0,0 +1,171 @@
+"""
+Приём апдейтов через webhook на aiohttp.
+
+Telegram присылает апдейты POST-запросами на WEBHOOK_PATH. Сервер
+проверяет секретный заголовок, сразу отвечает 200 и передаёт апдейт в
+UpdateScheduler: обработка идёт параллельно, но не больше max_concurrency
+апдейтов одновременно, а апдейты одного пользователя обрабатываются строго
+по очереди — шаги формы не обгоняют друг друга. Если в очереди уже
+max_pending апдейтов, сервер отвечает 503, и Telegram повторит доставку
+позже.
+
+    scheduler = UpdateScheduler(dp, max_concurrency=32)
+    run_webhook(dp, scheduler, url='https://bot.example.com/telegram/webhook', ...)
+"""
+import asyncio
+import hmac
+import logging
+from collections import deque
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+from update_context import update_user_id
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class UpdateScheduler:
+    """
+    Параллельная обработка апдейтов с порядком внутри пользователя.
+
+    У каждого пользователя своя очередь и не больше одной задачи, которая
+    её разбирает; общий семафор ограничивает число апдейтов в обработке.
+    Апдейты без отправителя (посты каналов и т.п.) не упорядочиваются.
+    """
+
+    def __init__(self, dp: Dispatcher, max_concurrency=32, max_pending=1000):
+        self.dp = dp
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._queues = {}
+        self._tasks = set()
+        self._pending = 0
+        self._active = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._stats = {'accepted': 0, 'rejected': 0, 'processed': 0, 'errors': 0}
+
+    def submit(self, update: types.Update):
+        """Ставит апдейт в очередь; False, если очередь переполнена"""
+        if self._pending >= self.max_pending:
+            self._stats['rejected'] += 1
+            return False
+        self._stats['accepted'] += 1
+        self._pending += 1
+        self._idle.clear()
+        user_id = update_user_id(update)
+        key = user_id if user_id is not None else ('update', update.update_id)
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(update)
+            return True
+        self._queues[key] = deque([update])
+        task = asyncio.create_task(self._drain(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _drain(self, key):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        queue = self._queues[key]
+        try:
+            while queue:
+                # Апдейт остаётся в очереди до конца обработки, чтобы новые
+                # апдейты пользователя вставали за ним, а не запускали вторую задачу.
+                # Каждый апдейт — в своей задаче, то есть в своей копии контекста:
+                # aiogram кэширует состояние FSM в ContextVar, и следующий апдейт
+                # иначе увидел бы состояние до обработки предыдущего
+                async with self._semaphore:
+                    await asyncio.create_task(self._process(queue[0]))
+                queue.popleft()
+                self._pending -= 1
+        finally:
+            # При отмене оставшиеся апдейты теряются
+            self._pending -= len(queue)
+            del self._queues[key]
+            if not self._pending:
+                self._idle.set()
+
+    async def _process(self, update):
+        self._active += 1
+        try:
+            await self.dp.process_update(update)
+            self._stats['processed'] += 1
+        except Exception as e:
+            self._stats['errors'] += 1
+            logger.exception(f"Ошибка обработки апдейта {update.update_id}: {e}")
+        finally:
+            self._active -= 1
+
+    async def wait_idle(self):
+        await self._idle.wait()
+
+    async def close(self, timeout=30):
+        """Дожидается обработки принятых апдейтов, остальное отменяет"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Webhook: не дождались обработки {self._pending} апдейтов, отменяем")
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self):
+        return dict(self._stats, pending=self._pending, active=self._active, users=len(self._queues))
+
+
+def create_app(scheduler: UpdateScheduler, path, secret=None):
+    """aiohttp-приложение, принимающее апдейты на path"""
+
+    async def handle(request):
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret):
+            return web.Response(status=403)
+        try:
+            update = types.Update(**await request.json())
+        except Exception as e:
+            logger.warning(f"Webhook: некорректный апдейт: {e}")
+            return web.Response(status=400)
+        if not scheduler.submit(update):
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    return app
+
+
+def run_webhook(dp: Dispatcher, scheduler: UpdateScheduler, url, path, host='0.0.0.0', port=8080,
+                secret=None, drop_pending_updates=True, on_startup=None, on_shutdown=None):
+    """
+    Запускает сервер webhook и регистрирует url в Telegram.
+
+    on_startup(dp) отрабатывает до приёма апдейтов и до set_webhook,
+    on_shutdown(dp) — после обработки уже принятых апдейтов. Webhook при
+    остановке не снимается: пока бот перезапускается, Telegram копит
+    апдейты и доставит их позже (если не drop_pending_updates).
+    """
+    app = create_app(scheduler, path, secret)
+
+    async def startup(app):
+        Bot.set_current(dp.bot)
+        Dispatcher.set_current(dp)
+        if on_startup is not None:
+            await on_startup(dp)
+        await dp.bot.set_webhook(url, drop_pending_updates=drop_pending_updates, secret_token=secret or None)
+        logger.info(f"Webhook установлен: {url}")
+
+    async def shutdown(app):
+        await scheduler.close()
+        if on_shutdown is not None:
+            await on_shutdown(dp)
+        session = await dp.bot.get_session()
+        await session.close()
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    web.run_app(app, host=host, port=port, access_log=None)